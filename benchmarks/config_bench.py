@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Time config loading at CLI startup, and factory lookups per node.
+
+Usage: python benchmarks/config_bench.py [config file]
+
+Startup is timed in fresh python processes which load the config
+(examples/vagoth.conf by default) and look up every node type, either
+parsing it with configobj or using the compiled copy.  The lookup rows
+time Config.get_node_factory() against reading the config section
+and calling dynamic_lookup() each time, as it used to.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, TOP)
+
+from vagoth.config import Config, dynamic_lookup
+
+STARTUP = """
+import sys, time
+start = time.time()
+from vagoth.config import Config
+cache_dir = sys.argv[2] or None
+config = Config([sys.argv[1]], cache_dir=cache_dir)
+for node_type in config["node_types"]:
+    config.get_node_factory(node_type)
+print time.time() - start
+"""
+
+def startup(path, cache_dir, runs=20):
+    """Return the mean seconds a fresh process takes to load the config"""
+    env = dict(os.environ, PYTHONPATH=TOP)
+    total = 0.0
+    for i in xrange(runs):
+        out = subprocess.check_output([sys.executable, "-c", STARTUP, path, cache_dir or ""], env=env)
+        total += float(out)
+    return total / runs
+
+def lookups(path, count=100000):
+    config = Config([path])
+    start = time.time()
+    for i in xrange(count):
+        # what get_node_factory() used to do
+        node_types = config.config["node_types"]
+        if "vm" in node_types:
+            dynamic_lookup(node_types["vm"])
+    before = (time.time() - start) / count
+    start = time.time()
+    for i in xrange(count):
+        config.get_node_factory("vm")
+    after = (time.time() - start) / count
+    return before, after
+
+def main(args):
+    path = args and args[0] or os.path.join(TOP, "examples", "vagoth.conf")
+    cache_dir = tempfile.mkdtemp()
+    try:
+        parsed = startup(path, None)
+        startup(path, cache_dir, runs=1) # compile it
+        compiled = startup(path, cache_dir)
+    finally:
+        shutil.rmtree(cache_dir)
+    print "startup, configobj parse:    %7.2fms" % (parsed * 1e3,)
+    print "startup, compiled config:    %7.2fms" % (compiled * 1e3,)
+    before, after = lookups(path)
+    print "node factory, dynamic_lookup: %6.2fus" % (before * 1e6,)
+    print "node factory, memoised:       %6.2fus" % (after * 1e6,)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Time GeatsDirect calls per second against the fake agent from
+vagoth/tests/fake_geats_agent.py, and compare them with starting
+vagoth/tests/fake_geats_jsonagent.py for each call, as GeatsLocal does
+without a pool.
+
+Usage: python benchmarks/geatsdirect_bench.py [--latency L] [--calls N] [--threads T] [--connections C] [--unix]
+
+The fake agent sleeps L seconds per request (default 0.01).  GeatsDirect
+is timed with one caller, with T concurrent callers (default 16)
+pipelining over at most C connections (default 2), and with all N calls
+started at once with start_async(), from one thread.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, TOP)
+sys.path.insert(0, os.path.join(TOP, "vagoth", "tests"))
+
+from vagoth.virt.drivers.geatsdirect import GeatsDirect
+from vagoth.virt.drivers.geatslocal import local_call
+from vagoth.virt.utils.futures import gather
+from fake_geats_agent import FakeAgent
+
+FAKE_JSONAGENT = [sys.executable, os.path.join(TOP, "vagoth", "tests", "fake_geats_jsonagent.py")]
+
+class Named(object):
+    def __init__(self, node_id, definition=None):
+        self.node_id = node_id
+        self.definition = definition or {}
+
+def spawned(calls):
+    for i in xrange(calls):
+        local_call("start", 10, FAKE_JSONAGENT, vm_name="vm1")
+
+def direct(calls, address, connections, threads=1):
+    driver = GeatsDirect(None, {"address": address, "connections": str(connections)})
+    node, vm = Named("hv1"), Named("vm1")
+    driver.start(node, vm) # connect
+    def worker(count):
+        for i in xrange(count):
+            driver.start(node, vm)
+    workers = [threading.Thread(target=worker, args=(calls // threads,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    driver.cleanup()
+
+def direct_async(calls, address, connections):
+    driver = GeatsDirect(None, {"address": address, "connections": str(connections)})
+    node, vm = Named("hv1"), Named("vm1")
+    driver.start(node, vm) # connect
+    gather([driver.start_async(node, vm) for i in xrange(calls)])
+    driver.cleanup()
+
+def rate(func, calls, *args):
+    start = time.time()
+    func(calls, *args)
+    return calls / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time GeatsDirect calls through the fake agent")
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--connections", type=int, default=2)
+    parser.add_argument("--unix", action="store_true", help="use a Unix socket instead of TCP")
+    args = parser.parse_args()
+    os.environ["FAKE_AGENT_LATENCY"] = str(args.latency)
+    if args.unix:
+        tmpdir = tempfile.mkdtemp()
+        agent = FakeAgent("unix:" + os.path.join(tmpdir, "agent.sock"), args.latency).start()
+    else:
+        agent = FakeAgent("127.0.0.1:0", args.latency).start()
+    try:
+        print "spawn per call:                  %8.1f calls/s" % (rate(spawned, min(args.calls, 50)),)
+        print "direct, 1 caller:                %8.1f calls/s" % (rate(direct, args.calls, agent.address, 1),)
+        print "direct, %2d callers, %d conns:     %8.1f calls/s" % (args.threads, args.connections,
+            rate(direct, args.calls, agent.address, args.connections, args.threads))
+        print "direct, async, %d conns:          %8.1f calls/s" % (args.connections,
+            rate(direct_async, args.calls, agent.address, args.connections))
+    finally:
+        agent.stop()
+        if args.unix:
+            os.unlink(os.path.join(tmpdir, "agent.sock"))
+            os.rmdir(tmpdir)
+
+if __name__ == '__main__':
+    main()
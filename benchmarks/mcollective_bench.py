@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Compare mcollective calls per second when spawning the helper for
+each call with one persistent helper, using the fake helper from
+vagoth/tests/fake_mc_json_rpc.py in place of ruby and mcollective.
+
+Usage: python benchmarks/mcollective_bench.py [--startup S] [--latency L] [--calls N] [--threads T]
+
+The fake helper sleeps S seconds at start-up (default 0.3), standing
+in for ruby, loading mcollective and connecting to the broker, and L
+seconds per request (default 0.02).  The persistent helper is timed
+with one caller and with T concurrent callers (default 8), including
+its one start-up.
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, TOP)
+
+from vagoth.virt.utils.mc_json_rpc import MCollectiveHelper, make_request, spawn_call
+
+FAKE_HELPER = [sys.executable, os.path.join(TOP, "vagoth", "tests", "fake_mc_json_rpc.py")]
+
+def spawned(calls):
+    for i in xrange(calls):
+        spawn_call(make_request("geats", "status", identity="hv1", timeout=5), FAKE_HELPER)
+
+def persistent(calls, threads=1):
+    helper = MCollectiveHelper(FAKE_HELPER)
+    helper.call("geats", "status", timeout=5) # start it
+    def worker(count):
+        for i in xrange(count):
+            helper.call("geats", "status", identity="hv1", timeout=5)
+    workers = [threading.Thread(target=worker, args=(calls // threads,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    helper.close()
+
+def rate(func, calls, *args):
+    start = time.time()
+    func(calls, *args)
+    return calls / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time mcollective calls through the fake helper")
+    parser.add_argument("--startup", type=float, default=0.3)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--calls", type=int, default=24)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+    os.environ["FAKE_MC_STARTUP"] = str(args.startup)
+    os.environ["FAKE_MC_LATENCY"] = str(args.latency)
+    print "spawn per call:                    %7.1f calls/s" % (rate(spawned, args.calls),)
+    print "persistent helper, 1 caller:       %7.1f calls/s" % (rate(persistent, args.calls),)
+    print "persistent helper, %2d callers:     %7.1f calls/s" % (args.threads, rate(persistent, args.calls, args.threads))
+
+if __name__ == '__main__':
+    main()
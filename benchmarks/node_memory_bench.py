@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Measure the cost of wrapping N node dicts in NodeDoc and VirtualMachine
+objects, as Manager.get_nodes() does for a listing.
+
+Usage: python benchmarks/node_memory_bench.py [N]
+
+The "before" rows use copies of the previous NodeDoc and Node classes
+(a __dict__ per object, and validation in NodeDoc.__init__).  For each
+it reports the time to wrap every node, the bytes held by the wrappers
+and the number of gc-tracked objects they allocated.
+"""
+
+import os
+import sys
+import gc
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from vagoth.registry.nodedoc import NodeDoc, normalize_node
+from vagoth.virt.virtualmachine import VirtualMachine
+
+class OldNodeDoc(object):
+    def __init__(self, registry, node_dict):
+        self.registry = registry
+        self.node_dict = node_dict
+        assert "type" in node_dict
+        assert "node_id" in node_dict
+        assert "name" in node_dict
+        assert "parent" in node_dict
+        assert "definition" in node_dict
+        assert "unique_keys" in node_dict
+        if "tenant" not in node_dict:
+            node_dict["tenant"] = None
+        if "metadata" not in node_dict:
+            node_dict["metadata"] = {}
+        if "tags" not in node_dict:
+            node_dict["tags"] = {}
+        elif type(node_dict["tags"]) == list:
+            node_dict["tags"] = dict([(x,True) for x in node_dict["tags"]])
+
+    @property
+    def id(self):
+        return self.node_dict["node_id"]
+
+class OldNode(object):
+    def __init__(self, manager, node_doc):
+        self._manager = manager
+        self._node_id = node_doc.id
+        self._doc = node_doc
+
+def make_nodes(size):
+    nodes = []
+    for i in xrange(size):
+        node_id = "vm%d" % (i,)
+        nodes.append(normalize_node({
+            "node_id": node_id, "name": node_id, "type": "vm", "tenant": "tenant1",
+            "parent": "hv%d" % (i / 100,), "definition": {}, "metadata": {},
+            "tags": {}, "unique_keys": [],
+        }))
+    return nodes
+
+def wrapper_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def bench(name, doc_class, node_class, nodes):
+    gc.collect()
+    gc.disable()
+    objects = len(gc.get_objects())
+    start = time.time()
+    wrapped = [node_class(None, doc_class(None, node)) for node in nodes]
+    elapsed = time.time() - start
+    allocated = len(gc.get_objects()) - objects - 1 # the list itself
+    gc.enable()
+    size = sum(wrapper_size(w) + wrapper_size(w._doc) for w in wrapped)
+    print "%-8s %8.3fs %10.1fMB %8d bytes/node %8d objects" % (
+        name, elapsed, size / 1048576.0, size / len(nodes), allocated)
+
+def main(args):
+    size = args and int(args[0]) or 100000
+    nodes = make_nodes(size)
+    print "wrapping %d nodes" % (size,)
+    bench("before", OldNodeDoc, OldNode, nodes)
+    bench("after", NodeDoc, VirtualMachine, nodes)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
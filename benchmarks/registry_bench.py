@@ -0,0 +1,111 @@
+#!/usr/bin/python
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Compare the file-backed registries on a cluster of N VMs spread over
+N/100 hypervisors.
+
+Usage: python benchmarks/registry_bench.py [--writes W] [N ...]
+
+For each registry it times filling the registry (in one batch), opening
+it from a fresh instance, and then per-operation costs of name lookups,
+get_nodes(parent=...) and individual update_metadata() writes.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from vagoth.registry.pickle_registry import PickleRegistry
+from vagoth.registry.sqlite_registry import SqliteRegistry
+
+def make_pickle(tmpdir, **config):
+    config["filename"] = os.path.join(tmpdir, "registry.pickle")
+    config["lockfile"] = os.path.join(tmpdir, "registry.lock")
+    return PickleRegistry(None, config)
+
+def make_sqlite(tmpdir):
+    return SqliteRegistry(None, {"filename": os.path.join(tmpdir, "registry.sqlite")})
+
+REGISTRIES = [
+    ("pickle", make_pickle),
+    ("pickle+journal", lambda tmpdir: make_pickle(tmpdir, journal=True)),
+    ("sqlite", make_sqlite),
+]
+
+def timed(func, count=1):
+    """Return the mean seconds per call of func()"""
+    start = time.time()
+    for i in xrange(count):
+        func()
+    return (time.time() - start) / count
+
+def fill(registry, size):
+    hypervisors = max(1, size / 100)
+    with registry.batch():
+        for hv in xrange(hypervisors):
+            registry.add_node("hv%d" % (hv,), "hv%d.example.com" % (hv,), "hv", None)
+        for vm in xrange(size):
+            node_id = "vm%d" % (vm,)
+            registry.add_node(node_id, "%s.example.com" % (node_id,), "vm", "tenant%d" % (vm % 10,),
+                definition={"name": node_id, "memory": 1024},
+                metadata={"state": "running"},
+                tags={"role": vm % 7 == 0 and "db" or "web"},
+                unique_keys=["ip-10.%d.%d.%d" % (vm >> 16, (vm >> 8) & 255, vm & 255)])
+            registry.set_parent(node_id, "hv%d" % (vm % hypervisors,))
+    return hypervisors
+
+def bench(name, factory, size, writes):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        registry = factory(tmpdir)
+        start = time.time()
+        hypervisors = fill(registry, size)
+        fill_time = time.time() - start
+        registry = factory(tmpdir)
+        open_time = timed(lambda: registry.get_node("vm0"))
+        names = ["vm%d.example.com" % (random.randrange(size),) for i in xrange(1000)]
+        by_name = timed(lambda: registry.get_node_by_name(names.pop()), 1000)
+        by_parent = timed(lambda: list(registry.get_nodes(parent="hv%d" % (random.randrange(hypervisors),))), 100)
+        update = timed(lambda: registry.update_metadata("vm%d" % (random.randrange(size),), {"state": "stopped"}), writes)
+        print "%-15s %7d %9.2fs %9.3fs %9.1fus %9.2fms %9.2fms" % (
+            name, size, fill_time, open_time, by_name * 1e6, by_parent * 1e3, update * 1e3)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main(args):
+    writes = 100
+    if args[:1] == ["--writes"]:
+        writes = int(args[1])
+        args = args[2:]
+    sizes = [int(arg) for arg in args] or [10000, 100000]
+    print "%-15s %7s %10s %10s %11s %11s %11s" % (
+        "registry", "nodes", "fill", "open", "by_name", "by_parent", "update")
+    for size in sizes:
+        for name, factory in REGISTRIES:
+            bench(name, factory, size, writes)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -17,21 +17,80 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 #
 
-def get_config(config_searchpaths):
+import os
+import hashlib
+import tempfile
+import json
+
+def get_config(config_searchpaths, cache_dir=None):
     """
     Given a list of config searchpaths, instantiate the config object for
     the first path, or instantiate an empty config object.  This uses
     the configobj library to load the config.
-    """
-    from configobj import ConfigObj
-    import os.path
 
+    If cache_dir is given, the config is returned as nested dicts by
+    load_compiled_config() instead.
+    """
     for path in config_searchpaths:
         path = os.path.expanduser(path)
         if os.path.exists(path):
+            if cache_dir:
+                return load_compiled_config(path, os.path.expanduser(cache_dir))
+            from configobj import ConfigObj
             return ConfigObj(path)
+    from configobj import ConfigObj
     return ConfigObj()
 
+def _utf8(data):
+    """Return data, from json, with its unicode strings encoded as configobj leaves them"""
+    if isinstance(data, unicode):
+        return data.encode("utf-8")
+    if isinstance(data, list):
+        return [_utf8(value) for value in data]
+    if isinstance(data, dict):
+        return dict((_utf8(key), _utf8(value)) for key, value in data.items())
+    return data
+
+def load_compiled_config(path, cache_dir):
+    """
+    Return the config file at path as nested dicts, using the compiled
+    copy in cache_dir if it was made from the same path, mtime and size.
+    Otherwise parse the file with configobj and try to write a new
+    compiled copy.
+
+    The compiled copy is JSON, rather than a pickle, so that whoever can
+    write to cache_dir can't run code as the user reading it.  It is
+    written to a temporary file and renamed into place, so readers never
+    see a partial copy.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = [path, st.st_mtime, st.st_size]
+    cache_file = os.path.join(cache_dir, "config-%s.json" % (hashlib.sha1(path).hexdigest(),))
+    try:
+        with open(cache_file, "rb") as fd:
+            cached_key, data = json.load(fd)
+        if cached_key == key:
+            return _utf8(data)
+    except (IOError, ValueError, TypeError):
+        pass
+    from configobj import ConfigObj
+    data = ConfigObj(path).dict()
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix=os.path.basename(cache_file) + ".")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                json.dump([key, data], tmp)
+            os.rename(tmp_file, cache_file)
+        except:
+            os.unlink(tmp_file)
+            raise
+    except (IOError, OSError, TypeError, ValueError):
+        pass # the cache is only an optimisation
+    return data
+
 def dynamic_lookup(moduleColonName):
     """
     Dynamically lookup an object in a module, given input of the form
@@ -54,18 +113,33 @@ class Config(object):
     Config is a wrapper class around the real config object,
     supplying methods to return or instantate class factories
     found in the configuration.
+
+    Each "module:name" string, node factory and action is only looked
+    up once per Config.  If cache_dir is set, the config file is loaded
+    through load_compiled_config().
     """
-    def __init__(self, config_searchpaths=None):
+    def __init__(self, config_searchpaths=None, cache_dir=None):
         global _static_config
         if _static_config != None:
             self.config = _static_config
         else:
             searchpath = config_searchpaths or ["~/.config/sippe/vagoth.conf", "/etc/sippe/vagoth.conf"]
-            _static_config = self.config = get_config(searchpath)
+            _static_config = self.config = get_config(searchpath, cache_dir=cache_dir)
+        self._lookups = {}
+        self._node_factories = {}
+        self._actions = {}
 
     def __getitem__(self, key):
         return self.config[key]
 
+    def lookup(self, moduleColonName):
+        """Return dynamic_lookup(moduleColonName), memoised"""
+        try:
+            return self._lookups[moduleColonName]
+        except KeyError:
+            obj = self._lookups[moduleColonName] = dynamic_lookup(moduleColonName)
+            return obj
+
     def _lookup_config_section(self, config_path):
         current = self.config
         try:
@@ -79,7 +153,7 @@ class Config(object):
         """Return a tuple for a factory and its configuration dict"""
         config = self._lookup_config_section(section)
         factory_str = config[factory_key]
-        return dynamic_lookup(factory_str), config
+        return self.lookup(factory_str), config
 
     def make_factory(self, section, context, factory_key="factory"):
         """
@@ -93,14 +167,28 @@ class Config(object):
         """
         Return the class for a given node type
         """
+        try:
+            return self._node_factories[node_type]
+        except KeyError:
+            pass
         node_types = self.config["node_types"]
+        factory = None
         if node_type in node_types:
-            return dynamic_lookup(node_types[node_type])
+            factory = self.lookup(node_types[node_type])
+        self._node_factories[node_type] = factory
+        return factory
 
     def get_action(self, action):
         """
         Return the named action callable
         """
+        try:
+            return self._actions[action]
+        except KeyError:
+            pass
         actions = self.config["actions"]
+        func = None
         if action in actions:
-            return dynamic_lookup(actions[action])
+            func = self.lookup(actions[action])
+        self._actions[action] = func
+        return func
@@ -29,6 +29,11 @@ class IDriver(ZI.Interface):
 
     For example, you could write a driver to manage Xen, VMWare or RHEV VMs,
     or even to manage VMs in remote clouds.
+
+    The Manager creates one instance per configured driver name and
+    shares it between all hypervisors and threads (see
+    Manager.get_driver), so a driver may keep connections or child
+    processes open between calls.
     """
     def __init__(manager, config):
         """
@@ -75,8 +80,77 @@ class IDriver(ZI.Interface):
         """
         Request the "status" for the entire node. This should include a
         "vms" dict, containing the info for each VM.
+
+        If the driver has a true broadcast_status attribute, calling
+        status() without a node returns the status of every hypervisor
+        that replies, with each record's _parent (or, for a hypervisor's
+        own record, _name) set to its hypervisor.  Monitor uses this in
+        its broadcast poll_mode.
         """
     def migrate(node, vm, destination_node):
         """
         Request the node to migrate the VM to the destination_node.
         """
+    def cleanup():
+        """
+        Called by Manager.cleanup() at shutdown time, to close any
+        connections or child processes the driver keeps.
+        """
+
+class IAsyncDriver(ZI.Interface):
+    """
+    Non-blocking versions of the IDriver calls, for a driver which can
+    have many calls in flight without a thread for each (eg. pipelined
+    over a socket).  Each method starts the call and returns a
+    vagoth.virt.utils.futures.Future for what the IDriver method would
+    return or raise; a call which misses its deadline fails with
+    DriverTimeoutException.
+
+    Manager.get_async_driver() returns the driver itself if it provides
+    IAsyncDriver, and otherwise wraps it in an ExecutorDriver, which
+    runs the blocking calls on a pool of threads.
+    """
+    def provision_async(node, vm):
+        """
+        Start IDriver.provision
+        """
+    def define_async(node, vm):
+        """
+        Start IDriver.define
+        """
+    def undefine_async(node, vm):
+        """
+        Start IDriver.undefine
+        """
+    def deprovision_async(node, vm):
+        """
+        Start IDriver.deprovision
+        """
+    def start_async(node, vm):
+        """
+        Start IDriver.start
+        """
+    def reboot_async(node, vm):
+        """
+        Start IDriver.reboot
+        """
+    def stop_async(node, vm):
+        """
+        Start IDriver.stop
+        """
+    def shutdown_async(node, vm):
+        """
+        Start IDriver.shutdown
+        """
+    def info_async(node, vm):
+        """
+        Start IDriver.info
+        """
+    def status_async(node=None):
+        """
+        Start IDriver.status
+        """
+    def migrate_async(node, vm, destination_node):
+        """
+        Start IDriver.migrate
+        """
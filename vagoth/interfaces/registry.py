@@ -65,6 +65,16 @@ class IRegistry(ZI.Interface):
         :returns: Iterable of INodeDoc's
         """
 
+    def explain(tenant=False, node_type=False, tags=False, parent=False):
+        """
+        Describe how get_nodes() would find the nodes matching the
+        supplied filters, eg. which index it would start from.  A filter
+        left as False isn't applied; parent=None matches nodes without
+        a parent.
+
+        :returns: human-readable string
+        """
+
     def get_nodes_with_type(node_type):
         """Return all nodes with a matching type
 
@@ -93,6 +103,9 @@ class IRegistry(ZI.Interface):
         If parent_node_id is None, this will remove the child-parent relationship.
 
         If a parent is already assigned, this will throw an exception.
+
+        :returns: the updated INodeDoc, so that callers needn't read it back
+            (registries may return None, in which case they must)
         """
 
     def add_node(node_id, node_name, node_type, tenant, definition=None, metadata=None, tags=None, unique_keys=None):
@@ -112,6 +125,7 @@ class IRegistry(ZI.Interface):
         :param metadata: metadata dictionary
         :param tags: tags dictionary
         :param unique_keys: list of unique keys to claim
+        :returns: the updated INodeDoc, or None (see set_parent)
         """
 
     def update_metadata(node_id, extra_metadata, delete_keys=None):
@@ -130,6 +144,7 @@ class IRegistry(ZI.Interface):
         :param node_id: unique ID of the node
         :param extra_metadata: dict of metadata to add to existing metadata dict
         :param delete_keys: list of metadata keys to delete
+        :returns: the updated INodeDoc, or None (see set_parent)
         """
 
     def set_blob(node_id, key, value):
@@ -147,6 +162,19 @@ class IRegistry(ZI.Interface):
         Return the blob for the given node_id and (string) key.
         """
 
+    def batch():
+        """
+        Return a context manager for a group of writes.
+
+        Writes made inside the block may be deferred and saved together
+        when the block ends, eg. under a single lock or in one request.
+        If an exception escapes the block, deferred writes are discarded.
+
+        >>> with registry.batch():
+        ...     registry.set_parent(vm_id, hv_id)
+        ...     registry.update_metadata(vm_id, {"state": "running"})
+        """
+
     def __contains__(node_id):
         """
         A shortcut to see if the given node is in the registry
@@ -18,8 +18,11 @@
 #
 
 from config import Config
+from session import Session
+from interfaces.driver import IAsyncDriver
 import exceptions
 import logging
+import threading
 
 class Manager(object):
     """
@@ -43,11 +46,16 @@ class Manager(object):
         provisioner_factory, provisioner_config = self.config.get_factory("provisioner")
         self.provisioner = provisioner_factory(self, provisioner_config)
 
-    def _instantiate_node(self, nodedoc):
+        # drivers are created on first use, see get_driver()
+        self._drivers = {}
+        self._async_drivers = {}
+        self._drivers_lock = threading.Lock()
+
+    def _instantiate_node(self, nodedoc, context=None):
         if nodedoc:
             node_factory = self.config.get_node_factory(nodedoc.type)
             if node_factory:
-                return node_factory(self, nodedoc)
+                return node_factory(context or self, nodedoc)
             else:
                 raise exceptions.UnknownNodeType("Unknown node type: %r" % (nodedoc.type))
 
@@ -61,6 +69,10 @@ class Manager(object):
         for nodedoc in self.registry.get_nodes(tenant=tenant, node_type=node_type, tags=tags, parent=parent):
             yield self._instantiate_node(nodedoc)
 
+    def get_nodes_with_parent(self, parent_id):
+        """Return an iterable of the node instances with the given parent"""
+        return self.get_nodes(parent=parent_id)
+
     def get_node_by_name(self, node_name):
         """Return the node instance for the given node_name"""
         nodedoc = self.registry.get_node_by_name(node_name) # can throw exception
@@ -75,6 +87,16 @@ class Manager(object):
         """Return an iterable of all the node_id in the registry"""
         return self.registry.list_nodes()
 
+    def session(self):
+        """
+        Return a new vagoth.session.Session, an identity map for node
+        lookups.  Use it as a context manager::
+
+            with manager.session() as session:
+                vm = session.get_node("vm1")
+        """
+        return Session(self)
+
     def action(self, action, **kwargs):
         """Call the given action with the given arguments"""
         action_func = self.config.get_action(action)
@@ -85,9 +107,61 @@ class Manager(object):
                 logging.debug("Exception while executing action %s" % (action,), exc_info=True)
                 raise
 
+    def get_driver(self, driver_name):
+        """
+        Return the driver instance for the given driver name, creating
+        it from the virt/drivers/<driver_name> config section on first
+        use.  The instance is shared by all hypervisors and threads.
+        """
+        driver = self._drivers.get(driver_name, None)
+        if driver is None:
+            with self._drivers_lock:
+                driver = self._drivers.get(driver_name, None)
+                if driver is None:
+                    driver = self.config.make_factory("virt/drivers/%s" % (driver_name,), self)
+                    self._drivers[driver_name] = driver
+        return driver
+
+    def get_async_driver(self, driver_name):
+        """
+        Return an IAsyncDriver for the given driver name: the driver
+        itself if it provides IAsyncDriver, or else an adapter for it,
+        made by the async_adapter factory in its config section
+        (vagoth.virt.drivers.executor:ExecutorDriver, which runs its calls
+        on up to async_workers (10) threads, failing those which take
+        longer than async_timeout seconds (300)).
+        """
+        driver = self.get_driver(driver_name)
+        if IAsyncDriver.providedBy(driver):
+            return driver
+        with self._drivers_lock:
+            async_driver = self._async_drivers.get(driver_name, None)
+            if async_driver is None:
+                driver_config = self.config.get_factory("virt/drivers/%s" % (driver_name,))[1]
+                workers = int(driver_config.get('async_workers', 10))
+                timeout = float(driver_config.get('async_timeout', 300))
+                adapter = self.config.lookup(driver_config.get('async_adapter',
+                    "vagoth.virt.drivers.executor:ExecutorDriver"))
+                async_driver = self._async_drivers[driver_name] = adapter(driver, workers, timeout)
+        return async_driver
+
     def cleanup(self):
         """This must be called at shutdown time"""
         self.scheduler.cleanup()
+        with self._drivers_lock:
+            drivers, self._drivers = self._drivers, {}
+            async_drivers, self._async_drivers = self._async_drivers, {}
+        # stop the adapters' threads before their drivers
+        drivers = sorted(async_drivers.items()) + sorted(drivers.items())
+        for driver_name, driver in drivers:
+            # drivers written before IDriver had cleanup() may not have one
+            cleanup = getattr(driver, "cleanup", None)
+            if cleanup is None:
+                continue
+            try:
+                cleanup()
+            except:
+                logging.exception("Exception while cleaning up driver %s" % (driver_name,))
 
 manager = None
 def get_manager(config=None):
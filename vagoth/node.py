@@ -27,8 +27,12 @@ class Node(object):
     a read-only snapshot of a node from the registry.
 
     It's expected that specific node types will inherit this Node
-    and add python-API-friendly functionality to it.
+    and add python-API-friendly functionality to it.  Subclasses should
+    declare __slots__ too (usually empty), so that large listings don't
+    allocate a __dict__ per node.
     """
+    __slots__ = ("_manager", "_node_id", "_doc")
+
     def __init__(self, manager, node_doc):
         """
         :param manager: vagoth.manager.Manager instance
@@ -39,11 +43,16 @@ class Node(object):
         self._node_id = node_doc.id
         self._doc = node_doc
 
-    def refresh(self):
+    def refresh(self, node_doc=None):
         """
         Refresh node data by querying the registry for the latest INodeDoc
+
+        :param node_doc: the INodeDoc returned by a registry write, if any.
+            If given, it's used instead of reading the node back.
         """
-        self._doc = self._manager.registry.get_node(self.node_id)
+        if node_doc is None:
+            node_doc = self._manager.registry.get_node(self.node_id)
+        self._doc = node_doc
 
     # ensure it's read-only
     @property
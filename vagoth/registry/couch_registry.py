@@ -22,9 +22,68 @@
 #
 
 import couchdb
+import json
+import hashlib
+import copy
 from .. import exceptions
-from .. import utils
-from nodedoc import NodeDoc
+from nodedoc import NodeDoc, normalize_node, tags_dict
+from contextlib import contextmanager
+import threading
+import query
+from couch_session import make_session
+
+# Node docs always have node_id and unique_keys, which keeps unique key
+# docs out of the views when both tables share a database.  Tags are
+# emitted as [name] (for existence checks) and [name, value].
+VIEWS = {
+    "by_name": {
+        "map": "function(doc) { if (doc.node_id && doc.unique_keys) emit(doc.name, null); }",
+        "reduce": "_count",
+    },
+    "by_key": {
+        "map": """function(doc) {
+    if (!doc.node_id || !doc.unique_keys) return;
+    if (doc.name) emit("VAGOTH_NAME_" + doc.name, null);
+    for (var i = 0; i < doc.unique_keys.length; i++) emit(doc.unique_keys[i], null);
+}""",
+        "reduce": "_count",
+    },
+    "by_parent": {
+        "map": "function(doc) { if (doc.node_id && doc.unique_keys) emit(doc.parent || null, null); }",
+        "reduce": "_count",
+    },
+    "by_tenant": {
+        "map": "function(doc) { if (doc.node_id && doc.unique_keys) emit(doc.tenant === undefined ? null : doc.tenant, null); }",
+        "reduce": "_count",
+    },
+    "by_type": {
+        "map": "function(doc) { if (doc.node_id && doc.unique_keys) emit(doc.type, null); }",
+        "reduce": "_count",
+    },
+    "by_tag": {
+        "map": """function(doc) {
+    if (!doc.node_id || !doc.unique_keys || !doc.tags) return;
+    if (doc.tags instanceof Array) {
+        for (var i = 0; i < doc.tags.length; i++) {
+            emit([doc.tags[i]], null);
+            emit([doc.tags[i], true], null);
+        }
+    } else {
+        for (var name in doc.tags) {
+            emit([name], null);
+            emit([name, doc.tags[name]], null);
+        }
+    }
+}""",
+        "reduce": "_count",
+    },
+}
+
+# The design document is named after a hash of VIEWS, so a registry
+# only has to install it when its views are missing, and processes
+# running different versions don't overwrite each other's views.
+DESIGN_NAME = "vagoth-" + hashlib.sha1(json.dumps(VIEWS, sort_keys=True)).hexdigest()[:8]
+DESIGN_DOC = "_design/" + DESIGN_NAME
 
 class CouchRegistry(object):
     """
@@ -43,53 +102,203 @@ class CouchRegistry(object):
             "unique_keys": [ "one", "two", "three" ],
             "parent": None,
         }
+
+    get_nodes() and lookups by name or unique key are answered from the
+    views in the DESIGN_DOC document (see VIEWS), which is installed the
+    first time a view is missing.
+
+    Optional config: couch_pool_size is the number of idle keep-alive
+    connections kept open (default 10), and couch_cache_size is the
+    number of responses kept for ETag revalidation (default 1000).
     """
     def __init__(self, manager, config):
         self.manager = manager
-        self.couchdb = couchdb.Server(config['couch_server'])
+        self.session = make_session(
+            pool_size=int(config.get('couch_pool_size', 10)),
+            cache_size=int(config.get('couch_cache_size', 1000)))
+        self.couchdb = couchdb.Server(config['couch_server'], session=self.session)
         self.nodes = self.couchdb[config['couch_nodes_table']]
         self.unique = self.couchdb[config['couch_unique_table']]
+        self._batch = threading.local()
+
+    def _pending(self):
+        """Return the docs queued by the current thread's batch, or None"""
+        return getattr(self._batch, "docs", None)
+
+    def _get_doc(self, node_id):
+        """Return the node doc, including changes queued by the current batch"""
+        pending = self._pending()
+        if pending is not None and node_id in pending:
+            return pending[node_id]
+        return self.nodes[node_id]
+
+    def _save_doc(self, doc):
+        """Save the node doc, or queue it if a batch is in progress"""
+        pending = self._pending()
+        if pending is not None:
+            pending[doc['_id']] = doc
+            return
+        try:
+            self.nodes.save(doc)
+        except couchdb.http.ResourceConflict as e:
+            raise exceptions.RegistryException(*e.args)
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue the node docs changed by set_parent, set_node,
+        update_metadata and set_blob, and write them in one _bulk_docs
+        request at the end of the block.  If an exception escapes,
+        nothing queued is written.
+
+        set_node claims its new unique keys straight away, and only
+        queues the doc once they're claimed.  The keys it replaces are
+        released once the doc is written; if it isn't (because of an
+        exception, or because its row of the _bulk_docs reply failed),
+        the new keys are released instead.
+
+        add_node and delete_node are still written immediately (along
+        with any queued change to the same node).
+        """
+        if self._pending() is not None:
+            # nested; the outermost batch writes or discards
+            yield self
+            return
+        self._batch.docs = {}
+        self._batch.claims = {}
+        try:
+            yield self
+        except:
+            claims = self._batch.claims
+            self._batch.docs = self._batch.claims = None
+            for node_id, (claimed, replaced) in claims.items():
+                self._release_unique_keys(node_id, claimed)
+            raise
+        docs, self._batch.docs = self._batch.docs, None
+        claims, self._batch.claims = self._batch.claims, None
+        if docs:
+            failed = []
+            for success, doc_id, rev_or_exc in self.nodes.update(docs.values()):
+                claimed, replaced = claims.get(doc_id, ([], []))
+                if success:
+                    self._release_replaced_keys(doc_id, replaced, docs[doc_id])
+                else:
+                    failed.append(doc_id)
+                    self._release_unique_keys(doc_id, claimed)
+            if failed:
+                raise exceptions.RegistryException("Could not write nodes to DB: %s" % (", ".join(sorted(failed)),))
+
+    def _node_doc(self, doc):
+        """Wrap a node doc from CouchDB, which may have been written by an older version"""
+        return NodeDoc(self, normalize_node(doc))
+
+    def cache_stats(self):
+        """Return the document cache size and hit/miss/stale counters"""
+        return self.session.cache.stats()
 
     def list_nodes(self):
-        return list(self.nodes)
+        return [node_id for node_id in self.nodes if not node_id.startswith("_design/")]
+
+    def _install_views(self):
+        """Install the design document for this version of VIEWS"""
+        try:
+            self.nodes.save({"_id": DESIGN_DOC, "language": "javascript", "views": VIEWS})
+        except couchdb.http.ResourceConflict:
+            pass # someone else installed it
+
+    def _view(self, name, **options):
+        """Return the rows of the given view, installing the views if missing"""
+        try:
+            return list(self.nodes.view(DESIGN_NAME + "/" + name, **options))
+        except couchdb.http.ResourceNotFound:
+            self._install_views()
+            return list(self.nodes.view(DESIGN_NAME + "/" + name, **options))
+
+    def _view_key(self, predicate):
+        """Return the (view name, key) which finds the nodes matching predicate"""
+        if predicate.field == "tag":
+            if predicate.value is None:
+                return "by_tag", [predicate.tag_name]
+            return "by_tag", [predicate.tag_name, predicate.value]
+        return "by_" + predicate.field, predicate.value
+
+    def _count(self, predicate):
+        """Return the number of nodes matching predicate, from the view's reduce"""
+        view, key = self._view_key(predicate)
+        for row in self._view(view, key=key, reduce=True):
+            return row.value
+        return 0
+
+    def _plan(self, predicates, total=None):
+        """
+        Return a query.QueryPlan for the given predicates.
+
+        Every predicate has a view, so the counts are only needed to
+        choose between several predicates (or to explain the plan).
+        """
+        if len(predicates) == 1 and total is None:
+            return query.plan_query(predicates, lambda p: 0, total)
+        return query.plan_query(predicates, self._count, total)
 
     def get_nodes(self, tenant=False, node_type=False, tags=False, parent=False):
-        for row in self.nodes.view('_all_docs', include_docs=True):
+        predicates = query.make_predicates(tenant=tenant, node_type=node_type, tags=tags, parent=parent)
+        plan = self._plan(predicates)
+        if plan.access is None:
+            for row in self.nodes.view('_all_docs', include_docs=True):
+                if not row.id.startswith("_design/"):
+                    yield self._node_doc(row.doc)
+            return
+        view, key = self._view_key(plan.access)
+        for row in self._view(view, key=key, reduce=False, include_docs=True):
             node = row.doc
-            if tenant is not False and node.get("tenant", None) != tenant:
-                continue
-            if parent is not False and not node["parent"] == parent:
-                continue
-            if node_type and node["type"] != node_type:
-                continue
-            if tags and not utils.matches_tags(tags, node["tags"]):
-                continue
-            yield NodeDoc(self, node)
+            if plan.matches(node):
+                yield self._node_doc(node)
+
+    def explain(self, tenant=False, node_type=False, tags=False, parent=False):
+        """Return a description of how get_nodes() would run with these filters"""
+        predicates = query.make_predicates(tenant=tenant, node_type=node_type, tags=tags, parent=parent)
+        total = 0
+        for row in self._view("by_type", reduce=True):
+            total = row.value
+        plan = self._plan(predicates, total=total)
+        if plan.access is None:
+            return plan.explain()
+        view, key = self._view_key(plan.access)
+        return "%s\nview %s key=%s" % (plan.explain(), view, json.dumps(key))
 
     def __contains__(self, node_id):
         return node_id in self.nodes
 
     def get_node(self, node_id):
         "return dict for node"
+        pending = self._pending()
+        if pending is not None and node_id in pending:
+            return self._node_doc(pending[node_id])
         node = self.nodes.get(node_id, None)
         if node:
-            return NodeDoc(self, node)
+            return self._node_doc(node)
         raise exceptions.NodeNotFoundException("Node {0} not found in registry.".format(node_id))
 
+    def _get_node_from_view(self, view, key):
+        """Return the first node emitted by view for key, or None"""
+        for row in self._view(view, key=key, reduce=False, include_docs=True, limit=1):
+            if row.doc is not None:
+                return self._node_doc(row.doc)
+        return None
+
     def get_node_by_name(self, node_name):
         "return dict for node"
-        key = "VAGOTH_NAME_"+node_name
-        if key in self.unique:
-            node_id = self.unique[key]['node_id']
-            if node_id in self.nodes:
-                return NodeDoc(self, self.nodes[node_id])
+        node = self._get_node_from_view("by_name", node_name)
+        if node is not None:
+            return node
         raise exceptions.NodeNotFoundException("Node with name {0} not found in registry.".format(node_name))
 
     def get_node_by_key(self, unique_key):
         "return the node with given unique key"
-        if unique_key and unique_key in self.unique:
-            node_id = self.unique[unique_key]['node_id']
-            return NodeDoc(self, self.nodes.get(node_id, None))
+        if unique_key:
+            node = self._get_node_from_view("by_key", unique_key)
+            if node is not None:
+                return node
         raise exceptions.NodeNotFoundException("Node with key {0} not found in registry.".format(unique_key))
 
     def get_nodes_with_type(self, node_type):
@@ -111,15 +320,43 @@ class CouchRegistry(object):
 
     def set_parent(self, node_id, parent_node_id):
         """Set parent_node_id atomically, and don't overwrite another"""
-        doc = self.nodes[node_id]
+        doc = self._get_doc(node_id)
         current_parent = doc.get('parent', None)
         if current_parent and parent_node_id is not None:
             raise exceptions.NodeAlreadyHasParentException("Node {0} already has a parent of {1}".format(node_id, current_parent))
         doc['parent'] = parent_node_id
-        try:
-            self.nodes.save(doc)
-        except couchdb.http.ResourceConflict as e:
-            raise exceptions.RegistryException(*e.args)
+        self._save_doc(doc)
+        return self._node_doc(doc)
+
+    def _get_docs(self, table, keys):
+        """Return a dict of key to doc for the keys which exist in table, in one request"""
+        docs = {}
+        if keys:
+            for row in table.view('_all_docs', keys=list(keys), include_docs=True):
+                if row.doc is not None:
+                    docs[row.key] = row.doc
+        return docs
+
+    def _release_unique_keys(self, node_id, keys):
+        """
+        Release the keys still held by node_id, in one _bulk_docs request.
+
+        Keys held by another node, or that fail to delete, are left for
+        a cleanup job.
+        """
+        deletions = []
+        for key, doc in sorted(self._get_docs(self.unique, keys).items()):
+            if doc.get('node_id', None) == node_id:
+                deletions.append({"_id": key, "_rev": doc['_rev'], "_deleted": True})
+        if deletions:
+            self.unique.update(deletions)
+
+    def _release_replaced_keys(self, node_id, keys, doc):
+        """Release the keys node_id no longer holds, now doc is saved"""
+        held = set(['VAGOTH_NAME_' + doc['name']] + doc['unique_keys'])
+        keys = [key for key in keys if key not in held]
+        if keys:
+            self._release_unique_keys(node_id, keys)
 
     def _claim_unique_keys(self, node_id, new_keys, old_keys=None):
         """
@@ -128,70 +365,76 @@ class CouchRegistry(object):
         We want to do this in a safe fashion.. so we should claim
         all new keys first, then release any old keys, and clean up
         in the event of any conflict.
+
+        The current owners are fetched with one _all_docs?keys= request
+        and the free keys are claimed with one _bulk_docs request.  If
+        any claim conflicts, the keys claimed by that request are deleted
+        again.
+
+        :returns: the keys newly claimed (excluding those node_id already held)
         """
         assert node_id is not None
-        claimed_keys = []
-        for key in sorted(new_keys):
-            doc = self.unique.get(key, None)
-            if doc:
-                if doc['node_id'] == node_id:
-                    continue
-                else:
-                    raise exceptions.UniqueConstraintViolation("Key {0} is not unique.".format(key))
-            try:
-                self.unique[key] = { "node_id": node_id }
-                claimed_keys.append(key)
-            except couchdb.http.ResourceConflict:
-                # someone claimed it ahead of us, I guess.. back out..
-                for delkey in claimed_keys:
-                    del self.unique[delkey]
+        new_keys = sorted(set(new_keys))
+        claims = []
+        current = self._get_docs(self.unique, new_keys)
+        for key in new_keys:
+            doc = current.get(key, None)
+            if doc is None:
+                claims.append({"_id": key, "node_id": node_id})
+            elif doc['node_id'] != node_id:
                 raise exceptions.UniqueConstraintViolation("Key {0} is not unique.".format(key))
+        if claims:
+            conflict = None
+            claimed = []
+            for success, key, rev_or_exc in self.unique.update(claims):
+                if success:
+                    claimed.append({"_id": key, "_rev": rev_or_exc, "_deleted": True})
+                elif conflict is None:
+                    conflict = key
+            if conflict is not None:
+                # someone claimed it ahead of us, I guess.. back out..
+                if claimed:
+                    self.unique.update(claimed)
+                raise exceptions.UniqueConstraintViolation("Key {0} is not unique.".format(conflict))
         if old_keys:
-            for old_key in old_keys:
-                if old_key in new_keys:
-                    continue
-                try:
-                    doc = self.unique[old_key]
-                except couchdb.http.ResourceNotFound:
-                    continue
-                if doc.get('node_id', None) == node_id:
-                    try:
-                        self.unique.delete(doc)
-                    except couchdb.http.ResourceConflict:
-                        raise # FIXME
-                        # not good - let a cleanup job fix it later
-                        pass
-                # else: DB is out of sync - let a cleanup job fix it later
+            self._release_unique_keys(node_id, [key for key in old_keys if key not in new_keys])
         #
         # At this point, all new keys have been claimed, and any old keys
         # should have been released.  Even if some old keys remain, our
         # claim on new keys is assured (as much as it can be without rogue
         # processes)
         #
+        return [claim["_id"] for claim in claims]
 
     def add_node(self, node_id, node_name, node_type, tenant=None, definition=None, metadata=None, unique_keys=None, tags=None):
         """
         Create new node in registry
+
+        This takes four requests, however many unique keys the node has:
+        the reservation, a multi-get and a _bulk_docs for the unique keys,
+        and the final save.
         """
         if unique_keys is None: unique_keys = []
         if metadata is None: metadata = {}
-        if tags is None: tags = []
+        tags = tags_dict(tags)
         # create a bare document as a reservation
+        doc = {
+            "_id": node_id,
+            "node_id": node_id,
+            "type": node_type, # only set once
+            "name": None,
+            "definition": {},
+            "metadata": {},
+            "unique_keys": [],
+            "tags": {},
+            "parent": None,
+            "tenant": tenant,
+        }
         try:
-            self.nodes[node_id] = {
-                "node_id": node_id,
-                "type": node_type, # only set once
-                "name": None,
-                "definition": {},
-                "metadata": {},
-                "unique_keys": [],
-                "tags": [],
-                "parent": None,
-                "tenant": tenant,
-            }
+            # save() sets doc['_rev'], so there's no need to fetch it back
+            self.nodes.save(doc)
         except couchdb.http.ResourceConflict:
             raise exceptions.NodeAlreadyExistsException("Node {0} already exists in registry".format(node_id))
-        doc = self.nodes[node_id]
         # add node_name to unique keys
         node_name_key = "VAGOTH_NAME_"+node_name
         if node_name_key not in unique_keys:
@@ -227,52 +470,60 @@ class CouchRegistry(object):
     def set_node(self, node_id, node_name=False, tenant=False, definition=False, metadata=False, unique_keys=False, tags=False):
         """Change an existing node definition"""
         try:
-            doc = self.nodes[node_id]
+            # a copy, so a queued doc is left as it was if a claim fails
+            doc = copy.deepcopy(self._get_doc(node_id))
         except couchdb.http.ResourceNotFound:
             raise exceptions.NodeNotFoundException("Node {0} not found in registry.".format(node_id))
-        new_name_key = None
-        old_name_key = None
+        new_keys = []
+        old_keys = []
         if definition is not False:
             doc['definition'] = definition
         if metadata is not False:
             doc['metadata'] = metadata
         if tags is not False:
-            doc['tags'] = tags
+            doc['tags'] = tags_dict(tags)
         if tenant is not False:
             doc['tenant'] = tenant
-        # update name (remember to cleanup old_name_key if set,
-        #               or new_name_key on failure)
+        # claim the new name and keys before saving, and release the
+        # old ones afterwards, all in a fixed number of requests
         if node_name and doc['name'] != node_name:
             assert isinstance(node_name, basestring)
-            new_name_key = 'VAGOTH_NAME_'+node_name
-            self._claim_unique_keys(node_id, [new_name_key])
-            old_name_key = 'VAGOTH_NAME_'+doc['name']
+            new_keys.append('VAGOTH_NAME_'+node_name)
+            old_keys.append('VAGOTH_NAME_'+doc['name'])
             doc['name'] = node_name
         if unique_keys is not False:
-            try:
-                self._claim_unique_keys(node_id, unique_keys, doc['unique_keys'])
-                doc['unique_keys'] = unique_keys
-            except exceptions.UniqueConstraintViolation:
-                if new_name_key:
-                    self._claim_unique_keys(node_id, [], [new_name_key])
-                raise
-        self._force_node_save(doc)
-        if old_name_key:
-            del self.unique[old_name_key]
+            new_keys.extend(unique_keys)
+            old_keys.extend(doc['unique_keys'])
+            doc['unique_keys'] = unique_keys
+        claimed = []
+        if new_keys:
+            claimed = self._claim_unique_keys(node_id, new_keys)
+        pending = self._pending()
+        if pending is not None:
+            # the batch releases old_keys, or the claimed keys, at the end
+            held, replaced = self._batch.claims.get(node_id, ([], []))
+            self._batch.claims[node_id] = (held + claimed, replaced + old_keys)
+            pending[node_id] = doc
+            return self._node_doc(doc)
+        try:
+            self._force_node_save(doc)
+        except exceptions.RegistryException:
+            self._release_unique_keys(node_id, claimed)
+            raise
+        self._release_replaced_keys(node_id, old_keys, doc)
+        return self._node_doc(doc)
 
     def update_metadata(self, node_id, extra_metadata=None, delete_keys=None):
         """Update metadata with extra_metadata, and delete any keys in delete_keys"""
-        doc = self.nodes[node_id]
+        doc = self._get_doc(node_id)
         if extra_metadata:
             doc['metadata'].update(extra_metadata)
         if delete_keys:
             for key in delete_keys:
                 if key in doc['metadata']:
                     del doc['metadata'][key]
-        try:
-            self.nodes.save(doc)
-        except couchdb.http.ResourceConflict as e:
-            raise exceptions.RegistryException(*e.args)
+        self._save_doc(doc)
+        return self._node_doc(doc)
 
     def set_blob(self, node_id, key, value):
         """Set a blob for the given node_id and key to the given value
@@ -280,7 +531,7 @@ class CouchRegistry(object):
         In this implementation, we store blobs as part of the node doc.
         """
         try:
-            doc = self.nodes[node_id]
+            doc = self._get_doc(node_id)
         except couchdb.http.ResourceNotFound:
             raise exceptions.NodeNotFoundException("Node {0} not found in registry.".format(node_id))
         if not doc.has_key("blobs"):
@@ -289,10 +540,7 @@ class CouchRegistry(object):
             del doc["blobs"][key]
         else:
             doc["blobs"][key] = value
-        try:
-            self.nodes.save(doc)
-        except couchdb.http.ResourceConflict as e:
-            raise exceptions.RegistryException(*e.args)
+        self._save_doc(doc)
 
     def get_blob(self, node_id, key):
         """Return the blob for the given node_id and key, or None
@@ -313,6 +561,9 @@ class CouchRegistry(object):
             raise exceptions.NodeNotFoundException("Node {0} not found in registry".format(node_id))
         unique_keys = doc.get('unique_keys', [])
         name_key = 'VAGOTH_NAME_'+doc['name']
-        unique_keys.insert(0, name_key)
-        self._claim_unique_keys(node_id, [], unique_keys)
+        if self._pending() is not None:
+            self._pending().pop(node_id, None)
+            claimed, replaced = self._batch.claims.pop(node_id, ([], []))
+            unique_keys = unique_keys + claimed
+        self._release_unique_keys(node_id, [name_key] + unique_keys)
         del self.nodes[node_id]
@@ -0,0 +1,114 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+HTTP session tuning for CouchRegistry.
+
+couchdb.http.Session already sends If-None-Match for any GET or HEAD
+whose response it has cached, and reuses the cached body on a 304.
+Its default cache only keeps a handful of responses and its
+connection pool never closes idle connections, so make_session()
+replaces both with bounded versions:
+
+* LRUCache keeps the most recently used responses and counts hits
+  (answered by a 304), misses (not cached) and stale entries (cached,
+  but the document had changed).
+* BoundedConnectionPool keeps at most pool_size idle keep-alive
+  connections per host, and closes any extra ones.
+"""
+
+import couchdb
+from collections import OrderedDict
+from threading import Lock
+
+class LRUCache(object):
+    """
+    A response cache for couchdb.http.Session, keyed by URL.
+
+    Session calls get() before each GET/HEAD, remove() if the response
+    wasn't a 304, and put() to store a response with an ETag.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.by_url = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, url):
+        with self.lock:
+            response = self.by_url.pop(url, None)
+            if response is None:
+                self.misses += 1
+                return None
+            # counted as a hit unless Session removes it again
+            self.by_url[url] = response
+            self.hits += 1
+            return response
+
+    def put(self, url, response):
+        with self.lock:
+            self.by_url.pop(url, None)
+            self.by_url[url] = response
+            while len(self.by_url) > self.max_size:
+                self.by_url.popitem(last=False)
+
+    def remove(self, url):
+        with self.lock:
+            if self.by_url.pop(url, None) is not None:
+                self.hits -= 1
+                self.stale += 1
+
+    def clear(self):
+        with self.lock:
+            self.by_url.clear()
+
+    def stats(self):
+        """Return a dict of the cache size and counters"""
+        with self.lock:
+            return {
+                "size": len(self.by_url),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+            }
+
+class BoundedConnectionPool(couchdb.http.ConnectionPool):
+    """A ConnectionPool which keeps at most max_idle idle connections per host"""
+    def __init__(self, timeout, max_idle=10, disable_ssl_verification=False):
+        couchdb.http.ConnectionPool.__init__(self, timeout, disable_ssl_verification=disable_ssl_verification)
+        self.max_idle = max_idle
+
+    def release(self, url, conn):
+        scheme, host = couchdb.util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+def make_session(pool_size=10, cache_size=1000, timeout=None):
+    """Return a couchdb.http.Session with a bounded pool and LRU cache"""
+    session = couchdb.http.Session(timeout=timeout)
+    session.cache = LRUCache(cache_size)
+    session.connection_pool = BoundedConnectionPool(timeout, pool_size)
+    return session
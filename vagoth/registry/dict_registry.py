@@ -25,12 +25,25 @@ operations, even though it's probably a no-op here.  It uses
 a lock (by default threading.RLock) to lock write operations.
 
 A different lock can passed in as an extra argument.
+
+Lookups by name, parent, type, tenant and tags are served from
+secondary indexes (see vagoth.registry.node_index) which the write
+methods keep up to date.  Subclasses which replace self.nodes in
+_load() must call self._reindex() afterwards, which also normalizes
+the loaded nodes (see nodedoc.normalize_node).
 """
 
 from .. import exceptions
-from .. import utils
-from nodedoc import NodeDoc
+from nodedoc import NodeDoc, normalize_node, tags_dict
+from node_index import NodeIndex
+import query
 from threading import RLock
+from contextlib import contextmanager
+import copy
+
+def node_unique_keys(node):
+    """Return the unique keys claimed by a node dict, including its name"""
+    return ["VAGOTH_NAME_%s" % (node["name"],)] + list(node.get("unique_keys", []))
 
 class DictRegistry(object):
     """
@@ -57,14 +70,81 @@ class DictRegistry(object):
         self.lock = lock or RLock()
         self.nodes = {}
         self.unique = {}
+        self.index = NodeIndex()
+        self.dirty = set()
+        self.undo = None
+
+    def _reindex(self):
+        """Normalize the loaded node dicts and rebuild the secondary indexes"""
+        for node in self.nodes.itervalues():
+            normalize_node(node)
+        self.index.rebuild(self.nodes)
 
     def _load(self):
         """Override to load the nodes and unique dicts"""
         pass
 
     def _save(self):
-        """Override to save the nodes and unique dicts"""
-        pass
+        """
+        Override to save the nodes and unique dicts.
+
+        self.dirty holds the node_id's changed since the last save.
+        """
+        self.dirty.clear()
+
+    def _before_change(self, node_id):
+        """Remember a node as it was before the current batch changed it"""
+        if self.undo is not None and node_id not in self.undo:
+            self.undo[node_id] = copy.deepcopy(self.nodes.get(node_id, None))
+
+    def _changed(self, node_id):
+        """Mark a node as changed, and save unless a batch is in progress"""
+        self.dirty.add(node_id)
+        if self.undo is None:
+            self._save()
+
+    def _replace_node(self, node_id, node):
+        """Replace (or delete, if node is None) a node, its unique keys and index entries"""
+        old_node = self.nodes.pop(node_id, None)
+        if old_node is not None:
+            self.index.remove(old_node)
+            for key in node_unique_keys(old_node):
+                if self.unique.get(key, None) == node_id:
+                    del self.unique[key]
+        if node is not None:
+            self.nodes[node_id] = normalize_node(node)
+            self.index.add(node)
+            for key in node_unique_keys(node):
+                self.unique[key] = node_id
+
+    @contextmanager
+    def batch(self):
+        """
+        Hold the lock for the whole block and save once at the end of it.
+        If an exception escapes the block, every change made in it is undone.
+
+        >>> with registry.batch():
+        ...     registry.set_parent("vm1", "hv1")
+        ...     registry.update_metadata("vm1", {"state": "running"})
+        """
+        with self.lock:
+            self._load()
+            if self.undo is not None:
+                # nested; the outermost batch saves or rolls back
+                yield self
+                return
+            self.undo = {}
+            try:
+                yield self
+            except:
+                undo, self.undo = self.undo, None
+                for node_id, node in undo.iteritems():
+                    self._replace_node(node_id, node)
+                self.dirty.clear()
+                raise
+            self.undo = None
+            if self.dirty:
+                self._save()
 
     def __contains__(self, node_id):
         return node_id in self.nodes
@@ -87,9 +167,9 @@ class DictRegistry(object):
     def get_node_by_name(self, node_name):
         """Return a node doc for the node with the given node_name"""
         self._load()
-        for node in self.nodes.itervalues():
-            if node.get('name', None) == node_name:
-                return NodeDoc(self, node)
+        node_id = self.index.with_name(node_name)
+        if node_id is not None and node_id in self.nodes:
+            return NodeDoc(self, self.nodes[node_id])
         raise exceptions.NodeNotFoundException("Node not found in registry with name: %s" % (node_name,))
 
     def get_node_by_key(self, key):
@@ -100,26 +180,54 @@ class DictRegistry(object):
             return self.get_node(node_id)
         raise exceptions.NodeNotFoundException("Node not found in registry with key: %s" % (key,))
 
-    def get_nodes(self, tenant=False, node_type=None, tags=None, parent=False):
-        """Return an iterable of node docs"""
-        self._load()
-        for node in self.nodes.values():
-            if tenant is not False and node["tenant"] != tenant:
-                continue
-            if node_type and node["type"] != node_type:
-                continue
-            if parent is not False and not node["parent"] == parent:
+    def _lookup(self, predicate):
+        """Return the set of node_id's in the index for the given predicate"""
+        if predicate.field == "tenant":
+            return self.index.with_tenant(predicate.value)
+        elif predicate.field == "type":
+            return self.index.with_type(predicate.value)
+        elif predicate.field == "parent":
+            return self.index.with_parent(predicate.value)
+        else:
+            return self.index.with_tag(predicate.tag_name, predicate.value)
+
+    def _plan(self, tenant=False, node_type=None, tags=None, parent=False):
+        """Return a query.QueryPlan for the given get_nodes() filters"""
+        predicates = query.make_predicates(tenant=tenant, node_type=node_type, tags=tags, parent=parent)
+        return query.plan_query(predicates, lambda p: len(self._lookup(p)), len(self.nodes))
+
+    def _iter_nodes(self, node_ids, plan=None):
+        """Yield node docs for the node_ids which pass the plan's filters"""
+        for node_id in node_ids:
+            node = self.nodes.get(node_id, None)
+            if node is None:
                 continue
-            if tags and not utils.matches_tags(tags, node["tags"]):
+            if plan and not plan.matches(node):
                 continue
             yield NodeDoc(self, node)
 
+    def _query(self, plan):
+        """Return an iterable of node docs for the given plan"""
+        if plan.access is None:
+            node_ids = self.nodes.keys()
+        else:
+            node_ids = list(self._lookup(plan.access))
+        return self._iter_nodes(node_ids, plan)
+
+    def get_nodes(self, tenant=False, node_type=None, tags=None, parent=False):
+        """Return an iterable of node docs"""
+        self._load()
+        return self._query(self._plan(tenant=tenant, node_type=node_type, tags=tags, parent=parent))
+
+    def explain(self, tenant=False, node_type=False, tags=False, parent=False):
+        """Return a description of how get_nodes() would run with these filters"""
+        self._load()
+        return self._plan(tenant=tenant, node_type=node_type, tags=tags, parent=parent).explain()
+
     def get_nodes_with_type(self, node_type):
         """Return an iterable of node docs with the given type"""
         self._load()
-        for node in self.nodes.itervalues():
-            if node['type'] == node_type:
-                yield NodeDoc(self, node)
+        return self._iter_nodes(list(self.index.with_type(node_type)))
 
     def get_nodes_with_tags(self, tag_matches):
         """Return an iterable of node docs with the given tag
@@ -129,23 +237,12 @@ class DictRegistry(object):
         :returns: iterable of node dict's
         """
         self._load()
-        for node in self.nodes.itervalues():
-            tags = node.get('tags', {})
-            if type(tags) == list:
-                tags = dict([(x,True) for x in tags])
-            for tag_name, tag_value in tag_matches.items():
-                if tag_name not in tags:
-                    continue
-                if tag_value is not None and tag_value != tags[tag_name]:
-                    continue
-                yield NodeDoc(self, node)
+        return self._query(self._plan(tags=tag_matches))
 
     def get_nodes_with_parent(self, node_parent):
         """Return an iterable of node docs with the given parent id"""
         self._load()
-        for node in self.nodes.itervalues():
-            if node.get('parent', None) == node_parent:
-                yield NodeDoc(self, node)
+        return self._iter_nodes(list(self.index.with_parent(node_parent)))
 
     def set_parent(self, node_id, parent_node_id):
         """
@@ -158,17 +255,23 @@ class DictRegistry(object):
                 node = self.nodes[node_id]
             except KeyError:
                 raise exceptions.NodeNotFoundException("Node not found: %s" % (node_id,))
+            self._before_change(node_id)
             parent = node.get("parent", None)
             if parent_node_id is None:
+                self.index.remove(node)
                 node["parent"] = None
+                self.index.add(node)
             elif parent is None:
                 if parent_node_id in self.nodes:
+                    self.index.remove(node)
                     node['parent'] = parent_node_id
+                    self.index.add(node)
                 else:
                     raise exceptions.NodeNotFoundException("Parent node not found: %s" % (parent_node_id,))
             else:
                 raise exceptions.NodeAlreadyHasParentException("Node already has a parent. Unassign it first: %s" % (node_id,))
-            self._save()
+            self._changed(node_id)
+            return NodeDoc(self, node)
 
     def add_node(self, node_id, node_name, node_type, tenant, definition=None, metadata=None, tags=None, unique_keys=None):
         """
@@ -186,7 +289,7 @@ class DictRegistry(object):
                 "type": node_type,
                 "definition": definition or {},
                 "metadata": metadata or {},
-                "tags": tags or [],
+                "tags": tags_dict(tags),
                 "unique_keys": unique_keys or [],
                 "parent": None,
             }
@@ -196,11 +299,13 @@ class DictRegistry(object):
             for key in (unique_keys or []):
                 if key in self.unique:
                     raise exceptions.UniqueConstraintViolation("Unique key is already taken: %s" % (key,))
+            self._before_change(node_id)
             self.unique[namekey] = node_id
             for key in (unique_keys or []):
                 self.unique[key] = node_id
             self.nodes[node_id] = node
-            self._save()
+            self.index.add(node)
+            self._changed(node_id)
 
     def set_node(self, node_id, node_name=None, tenant=None, definition=None, metadata=None, tags=None, unique_keys=None):
         """
@@ -222,6 +327,8 @@ class DictRegistry(object):
                 for key in unique_keys:
                     if key in self.unique and self.unique[key] != node_id:
                         raise exceptions.UniqueConstraintViolation("Unique key is already taken: %s" % (key,))
+            self._before_change(node_id)
+            self.index.remove(node)
             if tenant:
                 node["tenant"] = tenant
             if definition:
@@ -229,7 +336,7 @@ class DictRegistry(object):
             if metadata:
                 node["metadata"] = metadata
             if tags:
-                node["tags"] = tags
+                node["tags"] = tags_dict(tags)
             if unique_keys: # unique_keys are the new set of keys
                 for key in node["unique_keys"]:
                     if key in self.unique and self.unique[key] == node_id and key not in unique_keys:
@@ -245,7 +352,9 @@ class DictRegistry(object):
                     del self.unique[oldnamekey]
                     self.unique[newnamekey] = node_id
                 node["name"] = node_name
-            self._save()
+            self.index.add(node)
+            self._changed(node_id)
+            return NodeDoc(self, node)
 
     def set_blob(self, node_id, key, value):
         """Set a blob for the given node_id and key to the given value"""
@@ -255,13 +364,14 @@ class DictRegistry(object):
                 node = self.nodes[node_id]
             except KeyError:
                 raise exceptions.NodeNotFoundException("Node not found: %s" % (node_id,))
+            self._before_change(node_id)
             if not node.has_key("blobs"):
                 node["blobs"] = {}
             if value is None and key in node["blobs"]:
                 del node["blobs"][key]
             else:
                 node["blobs"][key] = value
-            self._save()
+            self._changed(node_id)
 
     def get_blob(self, node_id, key):
         """Return the blob for the given node_id and key, or None"""
@@ -277,26 +387,29 @@ class DictRegistry(object):
                 node = self.nodes[node_id]
             except KeyError:
                 raise exceptions.NodeNotFoundException("Node not found: %s" % (node_id,))
+            self._before_change(node_id)
             metadata = node.get('metadata', {})
             for key in (delete_keys or []):
                 if key in metadata:
                     del metadata[key]
             if extra_metadata:
                 metadata.update(extra_metadata)
-            self._save()
+            self._changed(node_id)
+            return NodeDoc(self, node)
 
     def delete_node(self, node_id):
         """Delete the given node, freeing up its resources"""
         with self.lock:
+            self._load()
             try:
                 node = self.nodes[node_id]
             except KeyError:
                 raise exceptions.NodeNotFoundException("Node not found: %s" % (node_id,))
             if node.get("parent", None):
                 raise exceptions.NodeStillUsedException("Node still has a parent: %s" % (node_id,))
-            children = list(self.get_nodes_with_parent(node_id))
-            if children:
+            if self.index.with_parent(node_id):
                 raise exceptions.NodeStillUsedException("Node still has children: %s" % (node_id,))
+            self._before_change(node_id)
             # not in use, so delete it and its unique keys
             namekey = "VAGOTH_NAME_%s" % (node["name"],)
             if namekey in self.unique and self.unique[namekey] == node_id:
@@ -304,5 +417,6 @@ class DictRegistry(object):
             for key in node.get("unique_keys", []):
                 if key in self.unique and self.unique[key] == node_id:
                     del self.unique[key]
+            self.index.remove(node)
             del self.nodes[node_id]
-            self._save()
+            self._changed(node_id)
@@ -0,0 +1,136 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+In-memory secondary indexes over node dicts.
+
+DictRegistry keeps one NodeIndex up to date as nodes are added,
+changed and deleted, so that lookups by name, parent, type, tenant
+and tags are set lookups rather than scans over every node.
+"""
+
+from nodedoc import tags_dict
+
+def node_tags(node):
+    """Return the tags of a node dict as a dict (old nodes used a list)"""
+    return tags_dict(node.get("tags", None))
+
+def is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+class NodeIndex(object):
+    """
+    Secondary indexes for a dict of node dicts.
+
+    names maps node name to node_id.  parents, types and tenants map
+    the attribute value to a set of node_id's.  tag_keys maps a tag
+    name to the set of node_id's having that tag, and tag_values maps
+    a (tag name, tag value) tuple to a set of node_id's.  Unhashable
+    tag values are only indexed by tag name.
+
+    The index must be told about a node before it changes (remove)
+    and after it has changed (add).
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.names = {}
+        self.parents = {}
+        self.types = {}
+        self.tenants = {}
+        self.tag_keys = {}
+        self.tag_values = {}
+
+    def rebuild(self, nodes):
+        """Rebuild all indexes from a dict of node_id to node dict"""
+        self.clear()
+        for node in nodes.itervalues():
+            self.add(node)
+
+    def _add(self, index, key, node_id):
+        ids = index.get(key, None)
+        if ids is None:
+            ids = index[key] = set()
+        ids.add(node_id)
+
+    def _discard(self, index, key, node_id):
+        ids = index.get(key, None)
+        if ids is not None:
+            ids.discard(node_id)
+            if not ids:
+                del index[key]
+
+    def add(self, node):
+        """Index the given node dict"""
+        node_id = node["node_id"]
+        self.names[node.get("name", None)] = node_id
+        self._add(self.parents, node.get("parent", None), node_id)
+        self._add(self.types, node.get("type", None), node_id)
+        self._add(self.tenants, node.get("tenant", None), node_id)
+        for tag_name, tag_value in node_tags(node).iteritems():
+            self._add(self.tag_keys, tag_name, node_id)
+            if is_hashable(tag_value):
+                self._add(self.tag_values, (tag_name, tag_value), node_id)
+
+    def remove(self, node):
+        """Remove the given node dict from the indexes"""
+        node_id = node["node_id"]
+        name = node.get("name", None)
+        if self.names.get(name, None) == node_id:
+            del self.names[name]
+        self._discard(self.parents, node.get("parent", None), node_id)
+        self._discard(self.types, node.get("type", None), node_id)
+        self._discard(self.tenants, node.get("tenant", None), node_id)
+        for tag_name, tag_value in node_tags(node).iteritems():
+            self._discard(self.tag_keys, tag_name, node_id)
+            if is_hashable(tag_value):
+                self._discard(self.tag_values, (tag_name, tag_value), node_id)
+
+    def with_name(self, name):
+        """Return the node_id with the given name, or None"""
+        return self.names.get(name, None)
+
+    def with_parent(self, parent):
+        """Return the set of node_id's with the given parent"""
+        return self.parents.get(parent, frozenset())
+
+    def with_type(self, node_type):
+        """Return the set of node_id's with the given type"""
+        return self.types.get(node_type, frozenset())
+
+    def with_tenant(self, tenant):
+        """Return the set of node_id's with the given tenant"""
+        return self.tenants.get(tenant, frozenset())
+
+    def with_tag(self, tag_name, tag_value=None):
+        """
+        Return the set of node_id's with the given tag.
+
+        If tag_value is None, only check for tag existence.  If tag_value
+        is unhashable, the result is every node with the tag name and
+        must still be checked with utils.matches_tags.
+        """
+        if tag_value is None or not is_hashable(tag_value):
+            return self.tag_keys.get(tag_name, frozenset())
+        return self.tag_values.get((tag_name, tag_value), frozenset())
@@ -21,27 +21,47 @@
 # A wrapper for a Node Document/Dict
 #
 
+def tags_dict(tags):
+    """Return tags as a dict (old nodes used a list of tag names)"""
+    if not tags:
+        return {}
+    if type(tags) == list:
+        return dict([(x, True) for x in tags])
+    return tags
+
+def normalize_node(node_dict):
+    """
+    Check that node_dict has the required fields, fill in the optional
+    ones and migrate a list of tags to a dict.
+
+    Registries call this when a node dict is stored or loaded, so that
+    NodeDoc can wrap it as-is on every read.
+    """
+    assert "type" in node_dict
+    assert "node_id" in node_dict
+    assert "name" in node_dict
+    assert "parent" in node_dict
+    assert "definition" in node_dict
+    assert "unique_keys" in node_dict
+    if "tenant" not in node_dict:
+        node_dict["tenant"] = None
+    if "metadata" not in node_dict:
+        node_dict["metadata"] = {}
+    if type(node_dict.get("tags", None)) != dict:
+        node_dict["tags"] = tags_dict(node_dict.get("tags", None))
+    return node_dict
+
 class NodeDoc(object):
     """
     An encapsulation of the node dictionary, implementing INodeDoc
+
+    node_dict must already have been through normalize_node().
     """
+    __slots__ = ("registry", "node_dict")
+
     def __init__(self, registry, node_dict):
         self.registry = registry
         self.node_dict = node_dict
-        assert "type" in node_dict
-        assert "node_id" in node_dict
-        assert "name" in node_dict
-        assert "parent" in node_dict
-        assert "definition" in node_dict
-        assert "unique_keys" in node_dict
-        if "tenant" not in node_dict:
-            node_dict["tenant"] = None
-        if "metadata" not in node_dict:
-            node_dict["metadata"] = {}
-        if "tags" not in node_dict:
-            node_dict["tags"] = {}
-        elif type(node_dict["tags"]) == list: # migrate to dict..
-            node_dict["tags"] = dict([(x,True) for x in node_dict["tags"]])
 
     @property
     def type(self):
@@ -21,28 +21,52 @@
 # Registry of nodes
 #
 
-import pickle
+import cPickle as pickle
 import os.path
-from dict_registry import DictRegistry
+from dict_registry import DictRegistry, node_unique_keys
+from threading import RLock
 import fcntl
+from .. import exceptions
+
+JOURNAL_HEADER = "generation"
+
+def file_state(filename):
+    """Return (inode, size, mtime) of filename, or None if it's missing"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
 
 class LockFile(object):
     """
     A simple lock file that can be used in a "with x" statement.
+
+    It can be re-entered by the thread which holds it, and other threads
+    in the same process wait for it to be released.
     """
     def __init__(self, lockfile):
         self.lockfile = lockfile
         self.locked = False
         self.loaded = False
+        self.depth = 0
+        self.rlock = RLock()
     def __enter__(self):
-        self.fd = open(self.lockfile, 'w')
-        fcntl.lockf(self.fd, fcntl.LOCK_EX)
-        self.locked = True
+        self.rlock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            self.fd = open(self.lockfile, 'w')
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            self.locked = True
+            self.loaded = False
     def __exit__(self, *args):
-        self.locked = False
-        self.loaded = False
-        fcntl.lockf(self.fd, fcntl.LOCK_UN)
-        self.fd.close()
+        self.depth -= 1
+        if self.depth == 0:
+            self.locked = False
+            self.loaded = False
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+            self.fd.close()
+        self.rlock.release()
 
 class PickleRegistry(DictRegistry):
     """
@@ -51,28 +75,201 @@ class PickleRegistry(DictRegistry):
 
     Config variable `lockfile` will set the location of the lockfile.
     Config variable `filename` will set the location of the pickle file.
+
+    If config variable `journal` is true, each write appends the changed
+    nodes to `filename`.journal instead of rewriting the whole pickle.
+    Reads replay the journal on top of the pickle, and once the journal
+    holds `journal_max_records` records (default 1000) it is folded into
+    a new pickle.  compact() does the same on demand, eg. from cron.
+
+    The pickle and the journal both carry a generation number, so a
+    reader racing with a compaction notices and loads again, and a
+    journal which was already folded into the pickle is ignored.
+
+    The (inode, size, mtime) of the pickle and the inode and read offset
+    of the journal are remembered after each load and save.  If neither
+    file has changed, the in-memory copy is reused; if only the journal
+    has grown, just the new records are replayed.
     """
 
     def __init__(self, manager, config):
         lock = LockFile(config.get("lockfile", "/var/lock/vagoth.pickledb.lock"))
         DictRegistry.__init__(self, manager, config, lock=lock)
         # replace lock with our own file-based lock
+        self.journal = config.get("journal", False) in ("true", "yes", True)
+        self.journal_max_records = int(config.get("journal_max_records", 1000))
+        self.journal_records = 0
+        self.cache_valid = False
+        self.pickle_state = None
+        self.journal_state = None
+
+    def _journal_filename(self):
+        return self.config.get('filename') + ".journal"
 
     def _load(self):
         if self.lock.locked and self.lock.loaded:
             return # locked and loaded, Sir!
         self.lock.loaded = True
         filename = self.config.get('filename', None)
-        if filename and os.path.exists(filename):
-            with open(filename,'rw') as fd:
-                self.data = pickle.load(fd)
+        if filename and self._is_current():
+            return
+        self.cache_valid = False
+        for attempt in range(5):
+            self.pickle_state = file_state(filename) if filename else None
+            if self.pickle_state is not None:
+                with open(filename, 'rb') as fd:
+                    self.data = pickle.load(fd)
+            else:
+                self.data = {"vms":{},"nodes":{}}
+            self.vms = self.data["vms"]
+            self.nodes = self.data["nodes"]
+            if "unique" not in self.data:
+                self.data["unique"] = self._unique_from_nodes()
+            self.unique = self.data["unique"]
+            self._reindex()
+            if not filename:
+                return
+            if self._replay_journal():
+                break
         else:
-            self.data = {"vms":{},"nodes":{}}
-        self.vms = self.data["vms"]
-        self.nodes = self.data["nodes"]
+            # don't trust the half-replayed data, here or in later loads
+            self.lock.loaded = False
+            raise exceptions.RegistryException(
+                "Could not load %s: its journal kept changing generation" % (filename,))
+        self.cache_valid = True
 
-    def _save(self):
+    def _is_current(self):
+        """
+        Is the in-memory copy up to date with the files on disk?
+
+        If the only change is new records at the end of the journal,
+        replay them and return True.
+        """
+        if not self.cache_valid:
+            return False
+        if file_state(self.config.get('filename')) != self.pickle_state:
+            return False
+        journal = file_state(self._journal_filename())
+        if journal is None or self.journal_state is None:
+            return journal is None and self.journal_state is None
+        inode, offset = self.journal_state
+        if journal[0] != inode or journal[1] < offset:
+            return False
+        if journal[1] == offset:
+            return True
+        return self._replay_journal(offset)
+
+    def _unique_from_nodes(self):
+        """Rebuild the unique dict (older pickles didn't save it)"""
+        unique = {}
+        for node_id, node in self.nodes.iteritems():
+            for key in node_unique_keys(node):
+                unique[key] = node_id
+        return unique
+
+    def _replay_journal(self, offset=0):
+        """
+        Apply the journal records from offset onwards to the loaded pickle.
+
+        Returns False if the journal belongs to a newer pickle than the
+        one loaded (ie. we raced with a compaction), otherwise True.
+        """
+        journal = self._journal_filename()
+        try:
+            fd = open(journal, 'rb')
+        except IOError:
+            self.journal_state = None
+            self.journal_records = 0
+            return True
+        with fd:
+            stat = os.fstat(fd.fileno())
+            if offset == 0:
+                self.journal_records = 0
+                generation = self.data.get("generation", 0)
+                try:
+                    header, journal_generation = pickle.load(fd)
+                    assert header == JOURNAL_HEADER
+                except Exception:
+                    journal_generation = None
+                if journal_generation is None or journal_generation < generation:
+                    # empty, or already folded into the pickle
+                    self.journal_state = (stat.st_ino, stat.st_size)
+                    if self.lock.locked:
+                        self._reset_journal()
+                    return True
+                if journal_generation > generation:
+                    return False
+                offset = fd.tell()
+            else:
+                fd.seek(offset)
+            while True:
+                try:
+                    node_id, node = pickle.load(fd)
+                except EOFError:
+                    break
+                except Exception:
+                    # a torn write from a crashed writer
+                    break
+                self._replace_node(node_id, node)
+                self.journal_records += 1
+                offset = fd.tell()
+        self.journal_state = (stat.st_ino, offset)
+        if offset < stat.st_size and self.lock.locked:
+            # nobody else can be writing, so the tail is garbage
+            with open(journal, 'r+b') as fd:
+                fd.truncate(offset)
+        return True
+
+    def _reset_journal(self):
+        """Start an empty journal for the current pickle generation"""
+        journal = self._journal_filename()
+        self.journal_records = 0
+        if self.journal or os.path.exists(journal):
+            with open(journal+".new", 'wb') as fd:
+                pickle.dump((JOURNAL_HEADER, self.data.get("generation", 0)), fd, pickle.HIGHEST_PROTOCOL)
+            os.rename(journal+".new", journal)
+            state = file_state(journal)
+            self.journal_state = (state[0], state[1])
+
+    def _append_journal(self):
+        """Append a record for each changed node to the journal"""
+        journal = self._journal_filename()
+        if not os.path.exists(journal):
+            self._reset_journal()
+        with open(journal, 'ab') as fd:
+            for node_id in sorted(self.dirty):
+                pickle.dump((node_id, self.nodes.get(node_id, None)), fd, pickle.HIGHEST_PROTOCOL)
+                self.journal_records += 1
+            fd.flush()
+            stat = os.fstat(fd.fileno())
+            self.journal_state = (stat.st_ino, stat.st_size)
+
+    def _checkpoint(self):
+        """Write the whole registry to a new pickle and empty the journal"""
         filename = self.config.get('filename', None)
-        with open(filename+".new", 'w') as fd:
-            pickle.dump(self.data, fd)
+        self.data["generation"] = self.data.get("generation", 0) + 1
+        with open(filename+".new", 'wb') as fd:
+            pickle.dump(self.data, fd, pickle.HIGHEST_PROTOCOL)
         os.rename(filename+".new", filename)
+        self.pickle_state = file_state(filename)
+        self._reset_journal()
+
+    def _save(self):
+        # we hold the lock, so the files only change under our control
+        try:
+            if self.journal:
+                self._append_journal()
+                if self.journal_records >= self.journal_max_records:
+                    self._checkpoint()
+            else:
+                self._checkpoint()
+        except:
+            self.cache_valid = False
+            raise
+        self.dirty.clear()
+
+    def compact(self):
+        """Fold the journal into a new pickle"""
+        with self.lock:
+            self._load()
+            self._checkpoint()
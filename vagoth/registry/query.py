@@ -0,0 +1,159 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+A small query planner for the get_nodes() filters of a registry.
+
+Each filter passed to get_nodes() becomes a Predicate.  The registry
+estimates how many nodes each predicate matches (eg. from the size of
+an index entry), and plan_query() picks the most selective predicate
+that the registry can look up directly as the access path.  The
+remaining predicates are only checked against the candidate nodes,
+most selective first.
+
+Example:
+
+>>> print registry.explain(tenant="X", tags={"role": "db"})
+lookup tag role='db' (~12 of 40000 nodes)
+filter tenant='X' (~900)
+"""
+
+from .. import utils
+from node_index import node_tags, is_hashable
+
+# The guessed fraction of nodes matched by a predicate, used to order
+# the predicates which the registry can't estimate itself.
+DEFAULT_SELECTIVITY = {
+    "parent": 0.01,
+    "tag": 0.1,
+    "tenant": 0.2,
+    "type": 0.5,
+}
+
+class Predicate(object):
+    """
+    A single get_nodes() filter on a node dict field.
+
+    field is one of "tenant", "type", "parent" or "tag".  For tags,
+    tag_name is set, and a value of None only checks for existence.
+    """
+    def __init__(self, field, value, tag_name=None):
+        self.field = field
+        self.value = value
+        self.tag_name = tag_name
+        self.estimate = None
+        self.indexed = False
+        # an index lookup of an unhashable tag value only narrows by name
+        self.exact = field != "tag" or value is None or is_hashable(value)
+
+    def matches(self, node):
+        """Does the given node dict match this predicate?"""
+        if self.field == "tag":
+            return utils.matches_tags({self.tag_name: self.value}, node_tags(node))
+        return node.get(self.field, None) == self.value
+
+    def __str__(self):
+        if self.field == "tag":
+            if self.value is None:
+                return "tag %s exists" % (self.tag_name,)
+            return "tag %s=%r" % (self.tag_name, self.value)
+        return "%s=%r" % (self.field, self.value)
+
+    def __repr__(self):
+        return "<Predicate %s>" % (self,)
+
+def make_predicates(tenant=False, node_type=None, tags=None, parent=False):
+    """
+    Return a list of Predicates for the get_nodes() filters.
+
+    tenant and parent are ignored when False (None is a valid value),
+    node_type and tags are ignored when empty.
+    """
+    predicates = []
+    if tenant is not False:
+        predicates.append(Predicate("tenant", tenant))
+    if node_type:
+        predicates.append(Predicate("type", node_type))
+    if parent is not False:
+        predicates.append(Predicate("parent", parent))
+    if tags:
+        for tag_name, tag_value in sorted(tags.items()):
+            predicates.append(Predicate("tag", tag_value, tag_name=tag_name))
+    return predicates
+
+class QueryPlan(object):
+    """
+    The plan chosen for a get_nodes() query.
+
+    access is the predicate whose matching nodes are the candidates, or
+    None if every node must be scanned.  filters are checked against
+    each candidate, in order.
+    """
+    def __init__(self, access, filters, total):
+        self.access = access
+        self.filters = filters
+        self.total = total
+
+    def matches(self, node):
+        """Does the given candidate node dict pass all the filters?"""
+        for predicate in self.filters:
+            if not predicate.matches(node):
+                return False
+        return True
+
+    def explain(self):
+        """Return a human-readable description of the plan"""
+        lines = []
+        if self.access is None:
+            lines.append("scan all %d nodes" % (self.total,))
+        else:
+            lines.append("lookup %s (~%d of %d nodes)" % (self.access, self.access.estimate, self.total))
+        for predicate in self.filters:
+            if predicate.indexed:
+                lines.append("filter %s (~%d)" % (predicate, predicate.estimate))
+            else:
+                lines.append("filter %s (~%d, guessed)" % (predicate, predicate.estimate))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.explain()
+
+def plan_query(predicates, estimate, total):
+    """
+    Choose a QueryPlan for the given predicates.
+
+    :param predicates: list of Predicate's, as from make_predicates()
+    :param estimate: callable returning the number of nodes matched by a
+        predicate if the registry can look it up directly, or None
+    :param total: number of nodes in the registry
+    :returns: QueryPlan
+    """
+    access = None
+    for predicate in predicates:
+        rows = estimate(predicate)
+        if rows is None:
+            predicate.estimate = int(total * DEFAULT_SELECTIVITY[predicate.field])
+        else:
+            predicate.estimate = rows
+            predicate.indexed = True
+            if access is None or rows < access.estimate:
+                access = predicate
+    filters = [p for p in predicates if p is not access or not p.exact]
+    filters.sort(key=lambda p: p.estimate)
+    return QueryPlan(access, filters, total)
@@ -0,0 +1,412 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Registry of Nodes, backed by an SQLite database.
+
+The database runs in WAL mode, so readers never block the (single)
+writer, and it is safe to share between threads and processes.
+"""
+
+import sqlite3
+import threading
+import json
+import cPickle as pickle
+from contextlib import contextmanager
+from .. import exceptions
+from nodedoc import NodeDoc, tags_dict
+import query
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    node_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    type TEXT,
+    tenant TEXT,
+    parent TEXT,
+    definition TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    unique_keys TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nodes_name ON nodes (name);
+CREATE INDEX IF NOT EXISTS nodes_type ON nodes (type);
+CREATE INDEX IF NOT EXISTS nodes_tenant ON nodes (tenant);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent);
+CREATE TABLE IF NOT EXISTS tags (
+    node_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (node_id, name)
+);
+CREATE INDEX IF NOT EXISTS tags_name_value ON tags (name, value);
+CREATE TABLE IF NOT EXISTS unique_keys (
+    key TEXT PRIMARY KEY,
+    node_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS unique_keys_node_id ON unique_keys (node_id);
+CREATE TABLE IF NOT EXISTS blobs (
+    node_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (node_id, key)
+);
+"""
+
+NODE_COLUMNS = "node_id, name, type, tenant, parent, definition, metadata, tags, unique_keys"
+
+def _equal_form(value):
+    """
+    Return value with the numbers which python considers equal (True, 1
+    and 1.0) all as ints, through lists and dicts
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, dict):
+        return dict((key, _equal_form(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_equal_form(item) for item in value]
+    return value
+
+def tag_value(value):
+    """
+    Encode a tag value for the tags table, so that values which are equal
+    in python (and so match in the other registries) compare equal, eg.
+    {"a": True} and {"a": 1}
+    """
+    return json.dumps(_equal_form(value), sort_keys=True)
+
+class SqliteRegistry(object):
+    """
+    A registry stored in an SQLite database.
+
+    The node attributes are columns of the nodes table, indexed by name,
+    parent, type and tenant.  Tags, unique keys and blobs each have their
+    own table; tags and unique keys are also kept as JSON in the nodes
+    row so that a node can be read in one go.  Definition, metadata and
+    tags must be JSON-serialisable, whereas blobs are pickled.
+
+    Config variable `filename` sets the location of the database, and
+    `timeout` the number of seconds to wait for another writer (default 30).
+    """
+    def __init__(self, manager, config):
+        self.manager = manager
+        self.config = config
+        self.filename = config["filename"]
+        self.timeout = float(config.get("timeout", 30))
+        self.local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _conn(self):
+        """Return this thread's connection to the database"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.depth = 0
+        return conn
+
+    @contextmanager
+    def _transaction(self, begin="BEGIN"):
+        """
+        Run the block in a transaction, or in a savepoint of the current
+        one, so that a nested write which fails is undone even if its
+        exception is caught within the outer transaction
+        """
+        conn = self._conn()
+        if self.local.depth:
+            savepoint = "nested%d" % (self.local.depth,)
+            conn.execute("SAVEPOINT " + savepoint)
+            self.local.depth += 1
+            try:
+                yield conn
+            except:
+                conn.execute("ROLLBACK TO " + savepoint)
+                raise
+            finally:
+                self.local.depth -= 1
+                conn.execute("RELEASE " + savepoint)
+            return
+        conn.execute(begin)
+        self.local.depth = 1
+        try:
+            yield conn
+        except:
+            self.local.depth = 0
+            conn.execute("ROLLBACK")
+            raise
+        try:
+            conn.execute("COMMIT")
+        except:
+            # eg. SQLITE_BUSY, which leaves the transaction open
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass # it was already rolled back
+            raise
+        finally:
+            self.local.depth = 0
+
+    def _write(self):
+        """A write transaction, taking the database write lock up front"""
+        return self._transaction("BEGIN IMMEDIATE")
+
+    @contextmanager
+    def batch(self):
+        """
+        Run the block in a single write transaction, which is rolled
+        back if an exception escapes.
+        """
+        with self._write():
+            yield self
+
+    def _row_to_dict(self, row):
+        node_id, name, node_type, tenant, parent, definition, metadata, tags, unique_keys = row
+        return {
+            "node_id": node_id,
+            "name": name,
+            "type": node_type,
+            "tenant": tenant,
+            "parent": parent,
+            "definition": json.loads(definition),
+            "metadata": json.loads(metadata),
+            "tags": json.loads(tags),
+            "unique_keys": json.loads(unique_keys),
+        }
+
+    def _get_node_dict(self, conn, node_id):
+        row = conn.execute("SELECT %s FROM nodes WHERE node_id = ?" % (NODE_COLUMNS,), (node_id,)).fetchone()
+        if row is None:
+            raise exceptions.NodeNotFoundException("Node not found: %s" % (node_id,))
+        return self._row_to_dict(row)
+
+    def __contains__(self, node_id):
+        row = self._conn().execute("SELECT 1 FROM nodes WHERE node_id = ?", (node_id,)).fetchone()
+        return row is not None
+
+    def list_nodes(self):
+        """Return a list of all node_id"""
+        return [row[0] for row in self._conn().execute("SELECT node_id FROM nodes")]
+
+    def get_node(self, node_id):
+        """Return a node doc for the given node_id"""
+        return NodeDoc(self, self._get_node_dict(self._conn(), node_id))
+
+    def get_node_by_name(self, node_name):
+        """Return a node doc for the node with the given node_name"""
+        row = self._conn().execute("SELECT %s FROM nodes WHERE name = ?" % (NODE_COLUMNS,), (node_name,)).fetchone()
+        if row is None:
+            raise exceptions.NodeNotFoundException("Node not found in registry with name: %s" % (node_name,))
+        return NodeDoc(self, self._row_to_dict(row))
+
+    def get_node_by_key(self, key):
+        """Return a node doc for the node with the given key"""
+        row = self._conn().execute(
+            "SELECT %s FROM nodes WHERE node_id = (SELECT node_id FROM unique_keys WHERE key = ?)" % (NODE_COLUMNS,),
+            (key,)).fetchone()
+        if row is None:
+            raise exceptions.NodeNotFoundException("Node not found in registry with key: %s" % (key,))
+        return NodeDoc(self, self._row_to_dict(row))
+
+    def _select(self, tenant=False, node_type=None, tags=None, parent=False):
+        """Return the SQL and parameters for a get_nodes() query"""
+        where = []
+        params = []
+        for predicate in query.make_predicates(tenant=tenant, node_type=node_type, tags=tags, parent=parent):
+            if predicate.field == "tag":
+                if predicate.value is None:
+                    where.append("node_id IN (SELECT node_id FROM tags WHERE name = ?)")
+                    params.append(predicate.tag_name)
+                else:
+                    where.append("node_id IN (SELECT node_id FROM tags WHERE name = ? AND value = ?)")
+                    params.extend([predicate.tag_name, tag_value(predicate.value)])
+            else:
+                where.append("%s IS ?" % (predicate.field,))
+                params.append(predicate.value)
+        sql = "SELECT %s FROM nodes" % (NODE_COLUMNS,)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return sql, params
+
+    def get_nodes(self, tenant=False, node_type=None, tags=None, parent=False):
+        """Return an iterable of node docs"""
+        sql, params = self._select(tenant=tenant, node_type=node_type, tags=tags, parent=parent)
+        rows = self._conn().execute(sql, params).fetchall()
+        return (NodeDoc(self, self._row_to_dict(row)) for row in rows)
+
+    def explain(self, tenant=False, node_type=False, tags=False, parent=False):
+        """Return SQLite's query plan for get_nodes() with these filters"""
+        predicates = query.make_predicates(tenant=tenant, node_type=node_type, tags=tags, parent=parent)
+        sql, params = self._select(tenant=tenant, node_type=node_type, tags=tags, parent=parent)
+        plan = self._conn().execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        lines = ["filters: " + (", ".join([str(p) for p in predicates]) or "none"), sql]
+        return "\n".join(lines + [row[-1] for row in plan])
+
+    def get_nodes_with_type(self, node_type):
+        """Return an iterable of node docs with the given type"""
+        return self.get_nodes(node_type=node_type)
+
+    def get_nodes_with_tags(self, tag_matches):
+        """Return an iterable of node docs with the given tags
+
+        :param tag_matches: key/value pairs to match. If the value is None,
+            check for key existence only.
+        :returns: iterable of node dict's
+        """
+        return self.get_nodes(tags=tag_matches)
+
+    def get_nodes_with_parent(self, node_parent):
+        """Return an iterable of node docs with the given parent id"""
+        return self.get_nodes(parent=node_parent)
+
+    def _claim_unique_keys(self, conn, node_id, keys):
+        """Claim each of keys for node_id, or raise UniqueConstraintViolation"""
+        for key in keys:
+            row = conn.execute("SELECT node_id FROM unique_keys WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] != node_id:
+                if key.startswith("VAGOTH_NAME_"):
+                    raise exceptions.UniqueConstraintViolation("Node name already taken: %s" % (key[12:],))
+                raise exceptions.UniqueConstraintViolation("Unique key is already taken: %s" % (key,))
+        conn.executemany("INSERT OR IGNORE INTO unique_keys (key, node_id) VALUES (?, ?)",
+            [(key, node_id) for key in keys])
+
+    def _release_unique_keys(self, conn, node_id, keys):
+        conn.executemany("DELETE FROM unique_keys WHERE key = ? AND node_id = ?",
+            [(key, node_id) for key in keys])
+
+    def _set_tags(self, conn, node_id, tags):
+        conn.execute("DELETE FROM tags WHERE node_id = ?", (node_id,))
+        conn.executemany("INSERT INTO tags (node_id, name, value) VALUES (?, ?, ?)",
+            [(node_id, name, tag_value(value)) for name, value in tags.items()])
+
+    def set_parent(self, node_id, parent_node_id):
+        """
+        Set the parent node id, but only if it's not already set.
+        It can also be used to set the parent back to to None.
+        """
+        with self._write() as conn:
+            node = self._get_node_dict(conn, node_id)
+            if parent_node_id is not None:
+                if node["parent"] is not None:
+                    raise exceptions.NodeAlreadyHasParentException("Node already has a parent. Unassign it first: %s" % (node_id,))
+                if conn.execute("SELECT 1 FROM nodes WHERE node_id = ?", (parent_node_id,)).fetchone() is None:
+                    raise exceptions.NodeNotFoundException("Parent node not found: %s" % (parent_node_id,))
+            conn.execute("UPDATE nodes SET parent = ? WHERE node_id = ?", (parent_node_id, node_id))
+        node["parent"] = parent_node_id
+        return NodeDoc(self, node)
+
+    def add_node(self, node_id, node_name, node_type, tenant, definition=None, metadata=None, tags=None, unique_keys=None):
+        """
+        Add a new node to the registry, ensuring that the node_id,
+        node_name, and keys are unique.
+        """
+        unique_keys = list(unique_keys or [])
+        tags = tags_dict(tags)
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM nodes WHERE node_id = ?", (node_id,)).fetchone() is not None:
+                raise exceptions.NodeAlreadyExistsException("Node already exists in registry: %s" % (node_id,))
+            self._claim_unique_keys(conn, node_id, ["VAGOTH_NAME_%s" % (node_name,)] + unique_keys)
+            conn.execute("INSERT INTO nodes (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)" % (NODE_COLUMNS,), (
+                node_id, node_name, node_type, tenant, None,
+                json.dumps(definition or {}), json.dumps(metadata or {}),
+                json.dumps(tags), json.dumps(unique_keys)))
+            self._set_tags(conn, node_id, tags)
+
+    def set_node(self, node_id, node_name=None, tenant=None, definition=None, metadata=None, tags=None, unique_keys=None):
+        """
+        Update the node specified by node_id, ensuring that all uniqueness constraints are
+        still valid. No changes will be made if there is the chance of a name or unique key
+        collision.
+        """
+        with self._write() as conn:
+            node = self._get_node_dict(conn, node_id)
+            if node_name and node_name != node["name"]:
+                self._claim_unique_keys(conn, node_id, ["VAGOTH_NAME_%s" % (node_name,)])
+                self._release_unique_keys(conn, node_id, ["VAGOTH_NAME_%s" % (node["name"],)])
+                node["name"] = node_name
+            if unique_keys:
+                self._claim_unique_keys(conn, node_id, unique_keys)
+                self._release_unique_keys(conn, node_id,
+                    [key for key in node["unique_keys"] if key not in unique_keys])
+                node["unique_keys"] = list(unique_keys)
+            if tenant:
+                node["tenant"] = tenant
+            if definition:
+                node["definition"] = definition
+            if metadata:
+                node["metadata"] = metadata
+            if tags:
+                node["tags"] = tags = tags_dict(tags)
+                self._set_tags(conn, node_id, tags)
+            conn.execute("UPDATE nodes SET name = ?, tenant = ?, definition = ?, metadata = ?, tags = ?, unique_keys = ? WHERE node_id = ?", (
+                node["name"], node["tenant"], json.dumps(node["definition"]), json.dumps(node["metadata"]),
+                json.dumps(node["tags"]), json.dumps(node["unique_keys"]), node_id))
+        return NodeDoc(self, node)
+
+    def update_metadata(self, node_id, extra_metadata, delete_keys=None):
+        """Atomically update the metadata dict, or delete keys from it"""
+        with self._write() as conn:
+            node = self._get_node_dict(conn, node_id)
+            metadata = node["metadata"]
+            for key in (delete_keys or []):
+                if key in metadata:
+                    del metadata[key]
+            if extra_metadata:
+                metadata.update(extra_metadata)
+            conn.execute("UPDATE nodes SET metadata = ? WHERE node_id = ?", (json.dumps(metadata), node_id))
+        return NodeDoc(self, node)
+
+    def set_blob(self, node_id, key, value):
+        """Set a blob for the given node_id and key to the given value"""
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM nodes WHERE node_id = ?", (node_id,)).fetchone() is None:
+                raise exceptions.NodeNotFoundException("Node not found: %s" % (node_id,))
+            if value is None:
+                conn.execute("DELETE FROM blobs WHERE node_id = ? AND key = ?", (node_id, key))
+            else:
+                conn.execute("INSERT OR REPLACE INTO blobs (node_id, key, value) VALUES (?, ?, ?)",
+                    (node_id, key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+
+    def get_blob(self, node_id, key):
+        """Return the blob for the given node_id and key, or None"""
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM nodes WHERE node_id = ?", (node_id,)).fetchone() is None:
+                raise exceptions.NodeNotFoundException("Node not found: %s" % (node_id,))
+            row = conn.execute("SELECT value FROM blobs WHERE node_id = ? AND key = ?", (node_id, key)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(str(row[0]))
+
+    def delete_node(self, node_id):
+        """Delete the given node, freeing up its resources"""
+        with self._write() as conn:
+            node = self._get_node_dict(conn, node_id)
+            if node["parent"]:
+                raise exceptions.NodeStillUsedException("Node still has a parent: %s" % (node_id,))
+            if conn.execute("SELECT 1 FROM nodes WHERE parent = ? LIMIT 1", (node_id,)).fetchone() is not None:
+                raise exceptions.NodeStillUsedException("Node still has children: %s" % (node_id,))
+            conn.execute("DELETE FROM unique_keys WHERE node_id = ?", (node_id,))
+            conn.execute("DELETE FROM tags WHERE node_id = ?", (node_id,))
+            conn.execute("DELETE FROM blobs WHERE node_id = ?", (node_id,))
+            conn.execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
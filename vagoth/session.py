@@ -0,0 +1,246 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+An identity map over the Manager's node lookups.
+
+Within a session, each node is fetched from the registry at most once
+and always returns the same Node instance.  Nodes are created with the
+session as their manager, so node.parent and hypervisor.children are
+resolved through the session too.  Writes made through
+session.registry update the cached docs in place, from the doc the
+registry returns, instead of having them re-fetched.
+
+>>> with manager.session() as session:
+...     session.prefetch()
+...     for vm in session.get_nodes(node_type="vm"):
+...         print vm.name, vm.parent
+"""
+
+from contextlib import contextmanager
+
+class SessionRegistry(object):
+    """
+    Wraps the registry for a Session.  get_node() returns the cached
+    INodeDoc, and the write methods patch the cached docs (and the
+    session's children lists) after calling the real registry.  Anything
+    else is passed straight through.
+    """
+    def __init__(self, session, registry):
+        self._session = session
+        self._registry = registry
+
+    def __getattr__(self, name):
+        return getattr(self._registry, name)
+
+    def __contains__(self, node_id):
+        return node_id in self._session._docs or node_id in self._registry
+
+    def get_node(self, node_id):
+        session = self._session
+        doc = session._docs.get(node_id, None)
+        if doc is None:
+            doc = session._docs[node_id] = self._registry.get_node(node_id)
+        return doc
+
+    def _written(self, node_id, new_doc, patch):
+        """
+        Bring the cached doc for node_id up to date after a write, using
+        the doc the registry returned or else patch(node_dict), and return
+        the cached doc (or new_doc, if node_id isn't cached).
+        """
+        doc = self._session._docs.get(node_id, None)
+        if doc is None:
+            return new_doc
+        if new_doc is not None:
+            doc.node_dict = new_doc.node_dict
+        else:
+            patch(doc.node_dict)
+        return doc
+
+    def set_parent(self, node_id, parent_node_id):
+        doc = self._session._docs.get(node_id, None)
+        # read the old parent first: the doc may share its dict with the
+        # registry's copy
+        old_parent = doc.parent if doc is not None else False
+        new_doc = self._registry.set_parent(node_id, parent_node_id)
+        if doc is not None:
+            self._session._move_child(node_id, old_parent, parent_node_id)
+        else:
+            self._session._forget_children()
+        def patch(node_dict):
+            node_dict["parent"] = parent_node_id
+        return self._written(node_id, new_doc, patch)
+
+    def update_metadata(self, node_id, extra_metadata=None, delete_keys=None):
+        new_doc = self._registry.update_metadata(node_id, extra_metadata, delete_keys)
+        def patch(node_dict):
+            metadata = node_dict["metadata"]
+            if extra_metadata:
+                metadata.update(extra_metadata)
+            for key in (delete_keys or []):
+                metadata.pop(key, None)
+        return self._written(node_id, new_doc, patch)
+
+    def set_node(self, node_id, *args, **kwargs):
+        new_doc = self._registry.set_node(node_id, *args, **kwargs)
+        def patch(node_dict):
+            # set_node's defaults differ between registries, so take
+            # the registry's version of the node
+            node_dict.update(self._registry.get_node(node_id).node_dict)
+        return self._written(node_id, new_doc, patch)
+
+    @contextmanager
+    def batch(self):
+        """The registry's batch(); if it is rolled back, so is the session"""
+        try:
+            with self._registry.batch():
+                yield self
+        except:
+            self._session.clear()
+            raise
+
+    def add_node(self, node_id, *args, **kwargs):
+        self._registry.add_node(node_id, *args, **kwargs)
+        if self._session._complete:
+            self._session.get_node(node_id)
+        self._session._move_child(node_id, False, None)
+
+    def delete_node(self, node_id):
+        self._registry.delete_node(node_id)
+        self._session._forget(node_id)
+
+class Session(object):
+    """
+    An identity map for the Manager's node lookups; see the module
+    docstring.  Anything else (scheduler, config, get_driver, ...) is
+    passed through to the Manager.
+
+    A session is not thread-safe, and only sees changes made by others
+    to nodes it hasn't fetched yet.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.registry = SessionRegistry(self, manager.registry)
+        self.clear()
+
+    def __getattr__(self, name):
+        return getattr(self.manager, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.clear()
+
+    def clear(self):
+        """Forget every cached node"""
+        self._docs = {}
+        self._nodes = {}
+        # parent node_id -> list of child node_ids, for the parents
+        # whose children have been fetched.  _complete is set when every
+        # node has been fetched by prefetch().
+        self._children = {}
+        self._complete = False
+
+    def _forget(self, node_id):
+        doc = self._docs.pop(node_id, None)
+        self._nodes.pop(node_id, None)
+        if doc is not None:
+            self._move_child(node_id, doc.parent, False)
+
+    def _forget_children(self):
+        self._children = {}
+        self._complete = False
+
+    def _move_child(self, node_id, old_parent, new_parent):
+        """Update the children lists; False means "not a child of anything" """
+        if old_parent is not False and old_parent in self._children:
+            children = self._children[old_parent]
+            if node_id in children:
+                children.remove(node_id)
+        if new_parent is not False:
+            if new_parent in self._children:
+                self._children[new_parent].append(node_id)
+            elif self._complete:
+                self._children[new_parent] = [node_id]
+
+    def _node(self, doc):
+        """Return the Node for doc, reusing the cached one if there is one"""
+        node = self._nodes.get(doc.id, None)
+        if node is None:
+            doc = self._docs.setdefault(doc.id, doc)
+            node = self._nodes[doc.id] = self.manager._instantiate_node(doc, context=self)
+        return node
+
+    def prefetch(self, tenant=False, node_type=False, tags=False):
+        """
+        Fetch the matching nodes (by default, all of them) into the session
+        in one query.  Without filters, this also gives every node's
+        children without further queries.
+        """
+        nodes = [self._node(doc) for doc in self.manager.registry.get_nodes(
+            tenant=tenant, node_type=node_type, tags=tags)]
+        if tenant is False and not node_type and not tags:
+            self._children = {}
+            for node in nodes:
+                self._children.setdefault(node._doc.parent, []).append(node.node_id)
+            self._complete = True
+        return nodes
+
+    def get_node(self, node_id):
+        """Return the node instance for this node_id"""
+        node = self._nodes.get(node_id, None)
+        if node is None:
+            node = self._node(self.registry.get_node(node_id))
+        return node
+
+    def get_nodes_with_parent(self, parent_id):
+        """Return a list of the node instances with the given parent"""
+        if parent_id not in self._children:
+            if self._complete:
+                return []
+            children = self._children[parent_id] = []
+            for doc in self.manager.registry.get_nodes(parent=parent_id):
+                children.append(self._node(doc).node_id)
+        return [self.get_node(node_id) for node_id in list(self._children[parent_id])]
+
+    def get_nodes(self, tenant=False, node_type=False, tags=False, parent=False):
+        """
+        Return a list of node instances.  Filtering by parent, or any
+        query after an unfiltered prefetch(), is answered from the session.
+        """
+        if parent is not False:
+            nodes = self.get_nodes_with_parent(parent)
+        elif self._complete:
+            nodes = [self._nodes[node_id] for node_id in sorted(self._nodes)]
+        else:
+            return [self._node(doc) for doc in self.manager.registry.get_nodes(
+                tenant=tenant, node_type=node_type, tags=tags)]
+        return [n for n in nodes if (tenant is False or n.tenant == tenant)
+            and (not node_type or n.node_type == node_type)
+            and (not tags or n.matches_tags(tags))]
+
+    def get_node_by_name(self, node_name):
+        """Return the node instance for the given node_name"""
+        return self._node(self.manager.registry.get_node_by_name(node_name))
+
+    def get_node_by_key(self, node_key):
+        """Return the node instance which has the given unique key"""
+        return self._node(self.manager.registry.get_node_by_key(node_key))
@@ -0,0 +1,160 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+A stand-in for the socket agent which GeatsDirect talks to, for tests
+and benchmarks.
+
+Usage: python fake_geats_agent.py ADDRESS [--latency L]
+
+ADDRESS is "host:port" or "unix:/path".  Each request is answered in
+its own thread, after sleeping latency seconds, so pipelined requests
+overlap and replies may come back out of order.  The data echoes the
+request's data.
+
+The "status" action returns one running VM, "vm1".  "fail" returns an
+error, "hang" never replies, and "drop" closes the connection.
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+if __name__ == '__main__':
+    sys.path.insert(0, TOP)
+
+from vagoth.virt.drivers.geatsdirect import parse_address, send_frame, recv_frame
+
+def respond(request):
+    action = request["action"]
+    if action == "fail":
+        return {"success": False, "errorcode": "failed", "message": "as requested"}
+    if action == "status":
+        vm1 = {"definition": {"name": "vm1"}, "state": ["running", "running"]}
+        return {"success": True, "data": {"vms": {"vm1": vm1}, "status": {}}}
+    return {"success": True, "data": request.get("data", {})}
+
+class FakeAgent(object):
+    """
+    Serve the fake agent on address, in background threads, until stop().
+    connections counts the connections accepted.
+    """
+    def __init__(self, address, latency=0):
+        self.address = address
+        self.latency = latency
+        self.connections = 0
+        family, sockaddr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.unlink(sockaddr)
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(sockaddr)
+        self.listener.listen(64)
+        if family == socket.AF_INET:
+            # for port 0
+            self.address = "%s:%d" % self.listener.getsockname()
+        self.clients = []
+        self.threads = []
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self._thread(self._accept)
+        return self
+
+    def _thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _accept(self):
+        while self.running:
+            try:
+                client, _ = self.listener.accept()
+            except socket.error:
+                break
+            self.connections += 1
+            self.clients.append(client)
+            self._thread(self._serve, client)
+
+    def _serve(self, client):
+        output = threading.Lock()
+        def handle(request):
+            time.sleep(self.latency)
+            reply = respond(request)
+            reply["id"] = request["id"]
+            with output:
+                try:
+                    send_frame(client, reply)
+                except socket.error:
+                    pass
+        try:
+            while True:
+                request = recv_frame(client)
+                if request["action"] == "hang":
+                    continue
+                if request["action"] == "drop":
+                    break
+                thread = threading.Thread(target=handle, args=(request,))
+                thread.daemon = True
+                thread.start()
+        except (EOFError, socket.error):
+            pass
+        self._close(client)
+
+    def _close(self, client):
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        client.close()
+
+    def stop(self):
+        """Stop listening, and close every connection"""
+        self.running = False
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        for client in self.clients:
+            self._close(client)
+        for thread in self.threads:
+            thread.join(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake geats agent")
+    parser.add_argument("address")
+    parser.add_argument("--latency", type=float, default=0)
+    args = parser.parse_args()
+    agent = FakeAgent(args.address, args.latency).start()
+    print "Listening on %s" % (agent.address,)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        agent.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+A stand-in for geats_jsonagent, for tests, which needs no geats install.
+
+Usage: python fake_geats_jsonagent.py [--serve]
+
+Without --serve it answers the one request on stdin; with it, it
+answers each line on stdin with a line, in turn.  Replies come after
+FAKE_AGENT_LATENCY seconds (default 0), and their data echoes the
+request's data, plus this process's pid.
+
+The "status" action returns one running VM, "vm1".  "fail" returns an
+error, "crash" makes the agent exit, and "hang" never replies.
+"""
+
+import os
+import sys
+import json
+import time
+
+LATENCY = float(os.environ.get("FAKE_AGENT_LATENCY", 0))
+
+def respond(request):
+    action = request["action"]
+    time.sleep(LATENCY)
+    if action == "crash":
+        os._exit(1)
+    if action == "hang":
+        while True:
+            time.sleep(60)
+    if action == "fail":
+        return {"success": False, "errorcode": "failed", "message": "as requested"}
+    if action == "status":
+        vm1 = {"definition": {"name": "vm1"}, "state": ["running", "running"]}
+        return {"success": True, "data": {"vms": {"vm1": vm1}, "status": {"pid": os.getpid()}}}
+    data = dict(request.get("data", {}))
+    data["pid"] = os.getpid()
+    return {"success": True, "data": data}
+
+def main(args):
+    if args == ["--serve"]:
+        for line in iter(sys.stdin.readline, ""):
+            sys.stdout.write(json.dumps(respond(json.loads(line))) + "\n")
+            sys.stdout.flush()
+    elif args == []:
+        print json.dumps(respond(json.load(sys.stdin)))
+    else:
+        sys.stderr.write("Syntax: %s [--serve]\n" % (sys.argv[0],))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
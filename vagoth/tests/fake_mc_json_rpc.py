@@ -0,0 +1,81 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+A stand-in for mc_json_rpc.rb, for tests and benchmarks, which speaks
+the same protocol without ruby or mcollective.
+
+Usage: python fake_mc_json_rpc.py [-|--serve]
+
+Each request is answered by one reply from "fake", whose data echoes
+the request, after sleeping FAKE_MC_LATENCY seconds (default 0).  The
+helper sleeps FAKE_MC_STARTUP seconds (default 0) when it starts, to
+stand in for loading ruby and mcollective.
+
+With --serve it answers one request at a time, in order, as the real
+helper does.  The "crash" action makes the helper exit, and "hang"
+replies only after FAKE_MC_HANG seconds (default 1), standing in for
+a request which outlives its caller's deadline.
+A request for vm_name "missing" gets statuscode 1 and no data.
+"""
+
+import os
+import sys
+import json
+import time
+
+STARTUP = float(os.environ.get("FAKE_MC_STARTUP", 0))
+LATENCY = float(os.environ.get("FAKE_MC_LATENCY", 0))
+HANG = float(os.environ.get("FAKE_MC_HANG", 1))
+
+def respond(request):
+    time.sleep(LATENCY)
+    arguments = request.get("arguments", {})
+    if arguments.get("vm_name", None) == "missing":
+        return [{"sender": "fake", "statuscode": 1, "statusmsg": "No such VM", "data": {}}]
+    return [{
+        "sender": "fake",
+        "statuscode": 0,
+        "statusmsg": "OK",
+        "data": {"action": request["action"], "arguments": arguments},
+    }]
+
+def serve():
+    for line in iter(sys.stdin.readline, ""):
+        request = json.loads(line)
+        if request["action"] == "crash":
+            os._exit(1)
+        if request["action"] == "hang":
+            time.sleep(HANG)
+        reply = {"id": request["id"], "result": respond(request)}
+        sys.stdout.write(json.dumps(reply) + "\n")
+        sys.stdout.flush()
+
+def main(args):
+    time.sleep(STARTUP)
+    if args == ["--serve"]:
+        serve()
+    elif args == ["-"]:
+        print json.dumps(respond(json.load(sys.stdin)))
+    else:
+        sys.stderr.write("Syntax: %s [-|--serve]\n" % (sys.argv[0],))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
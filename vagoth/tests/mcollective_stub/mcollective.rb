@@ -0,0 +1,89 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+#
+# Just enough of mcollective for mc_json_rpc.rb, for the tests:
+# put this directory first on ruby's load path (ruby -I).
+#
+# Like the real thing, rpcclient() without :options parses ARGV
+# and rejects options it doesn't know, and the client isn't
+# thread-safe: overlapping calls fail.  Each call replies from
+# "stub", echoing the action, arguments and identity filter, after
+# sleeping for the "sleep" argument (default 0).
+#
+
+module MCollective
+  module Util
+    def self.default_options
+      {:config => "stub"}
+    end
+  end
+
+  class StubResult
+    attr_reader :results
+
+    def initialize(results)
+      @results = results
+    end
+  end
+
+  class StubClient
+    @@lock = Mutex.new
+    @@busy = false
+
+    attr_accessor :progress, :timeout
+
+    def initialize(agent)
+      @agent = agent
+      @identity = nil
+    end
+
+    def identity_filter(identity)
+      @identity = identity
+    end
+
+    def discover
+    end
+
+    def method_missing(action, arguments)
+      @@lock.synchronize do
+        raise "mcollective client used concurrently" if @@busy
+        @@busy = true
+      end
+      begin
+        sleep(arguments["sleep"] || 0)
+        data = {"action" => action.to_s, "arguments" => arguments, "identity" => @identity}
+        [StubResult.new({"sender" => "stub", "statuscode" => 0, "statusmsg" => "OK", "data" => data})]
+      ensure
+        @@busy = false
+      end
+    end
+  end
+
+  module RPC
+    def rpcclient(agent, flags = {})
+      unless flags[:options]
+        ARGV.each do |arg|
+          raise "invalid option: #{arg}" if arg.start_with?("-") and arg != "-"
+        end
+      end
+      StubClient.new(agent)
+    end
+  end
+end
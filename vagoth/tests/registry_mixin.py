@@ -133,6 +133,18 @@ class RegistryMixin(object):
         # ..but not all keys
         self.assertIn("three", metadata)
 
+    def test_writes_return_doc(self):
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv", tenant=None)
+        doc = self.registry.update_metadata("0xdeadbeef", {"one": "two"}, ["mymetakey"])
+        self.assertEqual(doc.metadata, {"one": "two"})
+        doc = self.registry.set_parent("0xdeadbeef", "othernode")
+        self.assertEqual(doc.parent, "othernode")
+        self.assertEqual(doc.metadata, {"one": "two"})
+        doc = self.registry.set_node("0xdeadbeef", node_name="foo.example.com")
+        self.assertEqual(doc.id, "0xdeadbeef")
+        self.assertEqual(doc.name, "foo.example.com")
+        self.assertEqual(doc.parent, "othernode")
+
     def test_change_name(self):
         self.registry.set_node("0xdeadbeef", node_name="foo.example.com")
         node = self.registry.get_node("0xdeadbeef")
@@ -160,3 +172,34 @@ class RegistryMixin(object):
 
     def test_interface(self):
         verifyObject(IRegistry, self.registry)
+
+    def test_explain(self):
+        plan = self.registry.explain(tenant="mytenant", tags={"tag2": "somevalue"})
+        self.assertIn("tenant='mytenant'", plan)
+        self.assertIn("tag tag2='somevalue'", plan)
+
+    def test_batch(self):
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv", tenant=None)
+        with self.registry.batch():
+            self.registry.update_metadata("0xdeadbeef", {"one": "two"})
+            self.registry.set_parent("0xdeadbeef", "othernode")
+            with self.registry.batch():
+                self.registry.update_metadata("0xdeadbeef", {"three": "four"})
+        node = self.registry.get_node("0xdeadbeef")
+        self.assertEqual(node.metadata["one"], "two")
+        self.assertEqual(node.metadata["three"], "four")
+        self.assertEqual(node.parent, "othernode")
+
+    def test_batch_rollback(self):
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv", tenant=None)
+        try:
+            with self.registry.batch():
+                self.registry.update_metadata("0xdeadbeef", {"one": "two"})
+                self.registry.set_parent("0xdeadbeef", "othernode")
+                raise ValueError("oops")
+        except ValueError:
+            pass
+        node = self.registry.get_node("0xdeadbeef")
+        self.assertNotIn("one", node.metadata)
+        self.assertEqual(node.parent, None)
+        self.assertEqual(0, len(list(self.registry.get_nodes_with_parent("othernode"))))
@@ -0,0 +1,104 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.config
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import json
+from .. import config
+from ..config import Config, load_compiled_config
+
+CONFIG = """
+[node_types]
+    vm = vagoth.virt.virtualmachine:VirtualMachine
+[actions]
+    vm_poll = vagoth.utils:matches_tags
+"""
+
+class testConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "vagoth.conf")
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        with open(self.path, "w") as fd:
+            fd.write(CONFIG)
+        config._static_config = None
+
+    def tearDown(self):
+        config._static_config = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookups_are_memoised(self):
+        calls = []
+        dynamic_lookup = config.dynamic_lookup
+        def counting_lookup(name):
+            calls.append(name)
+            return dynamic_lookup(name)
+        config.dynamic_lookup = counting_lookup
+        try:
+            cfg = Config([self.path])
+            first = cfg.get_node_factory("vm")
+            self.assertTrue(cfg.get_node_factory("vm") is first)
+            cfg.get_action("vm_poll")
+            cfg.get_action("vm_poll")
+        finally:
+            config.dynamic_lookup = dynamic_lookup
+        self.assertEqual(calls, ["vagoth.virt.virtualmachine:VirtualMachine", "vagoth.utils:matches_tags"])
+        self.assertEqual(cfg.get_node_factory("unknown"), None)
+
+    def test_compiled_config(self):
+        cfg = Config([self.path], cache_dir=self.cache_dir)
+        self.assertEqual(cfg["node_types"]["vm"], "vagoth.virt.virtualmachine:VirtualMachine")
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        # the compiled copy is used while the file is unchanged
+        compiled = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        mtime = os.stat(compiled).st_mtime
+        self.assertEqual(load_compiled_config(self.path, self.cache_dir)["actions"],
+            {"vm_poll": "vagoth.utils:matches_tags"})
+        self.assertEqual(os.stat(compiled).st_mtime, mtime)
+
+    def test_compiled_config_is_json(self):
+        load_compiled_config(self.path, self.cache_dir)
+        compiled = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(compiled) as fd:
+            key, data = json.load(fd)
+        self.assertEqual(data["actions"], {"vm_poll": "vagoth.utils:matches_tags"})
+        # and is read back as plain strings, as configobj returns them
+        value = load_compiled_config(self.path, self.cache_dir)["actions"]["vm_poll"]
+        self.assertEqual(type(value), str)
+
+    def test_compiled_config_invalidated(self):
+        load_compiled_config(self.path, self.cache_dir)
+        with open(self.path, "a") as fd:
+            fd.write("    vm_start = vagoth.virt.actions:vm_start\n")
+        st = os.stat(self.path)
+        os.utime(self.path, (st.st_atime, st.st_mtime + 10))
+        self.assertIn("vm_start", load_compiled_config(self.path, self.cache_dir)["actions"])
+
+    def test_compiled_config_unwritable_cache(self):
+        cache_file = os.path.join(self.tmpdir, "not-a-directory")
+        with open(cache_file, "w") as fd:
+            fd.write("")
+        data = load_compiled_config(self.path, cache_file)
+        self.assertEqual(data["node_types"]["vm"], "vagoth.virt.virtualmachine:VirtualMachine")
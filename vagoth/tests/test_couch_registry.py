@@ -23,7 +23,9 @@ Test vagoth.registry.couch_registry.CouchRegistry
 
 import unittest
 from ..registry.couch_registry import CouchRegistry
+from ..registry import couch_registry
 import uuid
+import copy
 import couchdb
 from .. import exceptions
 from registry_mixin import RegistryMixin
@@ -33,11 +35,65 @@ rev_counter = 0
 NO_DEFAULT=uuid.uuid4()
 
 # an in-memory couchdb table mocker
+class CouchRowMock:
+    def __init__(self, doc_id, key, doc=None, value=None):
+        self.id = doc_id
+        self.key = key
+        self.doc = doc
+        self.value = value
+
+def view_tag_keys(doc):
+    tags = doc.get("tags", None) or {}
+    if type(tags) == list:
+        tags = dict([(x, True) for x in tags])
+    keys = []
+    for name, value in tags.items():
+        keys.append([name])
+        keys.append([name, value])
+    return keys
+
+# python equivalents of the map functions in couch_registry.VIEWS
+VIEW_KEYS = {
+    "by_name": lambda doc: [doc.get("name", None)],
+    "by_key": lambda doc: (doc.get("name", None) and ["VAGOTH_NAME_" + doc["name"]] or []) + doc["unique_keys"],
+    "by_parent": lambda doc: [doc.get("parent", None) or None],
+    "by_tenant": lambda doc: [doc.get("tenant", None)],
+    "by_type": lambda doc: [doc.get("type", None)],
+    "by_tag": view_tag_keys,
+}
+
 class CouchTableMock:
     def __init__(self):
         self.data = {}
+        self.views_queried = []
+        self.requests = 0
+    def __len__(self):
+        return len(self.data)
+    def view(self, name, include_docs=False, key=NO_DEFAULT, keys=None, reduce=True, limit=None):
+        self.views_queried.append(name)
+        self.requests += 1
+        if name == "_all_docs":
+            if keys is not None:
+                return [CouchRowMock(k, k, copy.deepcopy(self.data.get(k, None))) for k in keys]
+            return [CouchRowMock(k, k, copy.deepcopy(self.data[k])) for k in sorted(self.data)]
+        design, view_name = name.split("/")
+        if "_design/" + design not in self.data:
+            raise couchdb.http.ResourceNotFound(name)
+        assert view_name in self.data["_design/" + design]["views"]
+        rows = []
+        for doc_id in sorted(self.data):
+            doc = self.data[doc_id]
+            if "node_id" not in doc or "unique_keys" not in doc:
+                continue
+            for emitted in VIEW_KEYS[view_name](doc):
+                if key is NO_DEFAULT or emitted == key:
+                    rows.append(CouchRowMock(doc_id, emitted, copy.deepcopy(doc)))
+        if reduce:
+            return [CouchRowMock(None, None, value=len(rows))]
+        return rows[:limit]
     def __setitem__(self, k, v):
         global rev_counter
+        self.requests += 1
         assert type(v) == dict
         if "_id" in v:
             if v["_id"] != k:
@@ -49,27 +105,49 @@ class CouchTableMock:
                 raise couchdb.http.ResourceConflict("differing id")
             if "_rev" in self.data[k] and v.get("_rev", None) != self.data[k]["_rev"]:
                 raise couchdb.http.ResourceConflict("stale rev")
-        if "_rev" not in v:
-            v["_rev"] = rev_counter
-            rev_counter += 1
-        self.data[k] = v
+        v["_rev"] = rev_counter
+        rev_counter += 1
+        self.data[k] = copy.deepcopy(v)
     def __iter__(self):
         return iter(self.data)
     def __getitem__(self, k):
-        return self.data[k]
+        self.requests += 1
+        if k not in self.data:
+            raise couchdb.http.ResourceNotFound(k)
+        return copy.deepcopy(self.data[k])
     def __delitem__(self, k):
+        self.requests += 1
         del self.data[k]
     def get(self, k, default=NO_DEFAULT):
+        self.requests += 1
         if default == NO_DEFAULT:
-            return self.data.get(k)
-        else:
-            return self.data.get(k, default)
+            default = None
+        if k in self.data:
+            return copy.deepcopy(self.data[k])
+        return default
     def __contains__(self, k):
+        self.requests += 1
         return k in self.data
     def save(self, doc):
         if "_id" in doc:
             self[doc["_id"]] = doc
+    def update(self, docs):
+        requests = self.requests
+        results = []
+        for doc in docs:
+            try:
+                if doc.get("_deleted", False):
+                    self.delete(doc)
+                    results.append((True, doc["_id"], doc["_rev"]))
+                    continue
+                self.save(doc)
+                results.append((True, doc["_id"], doc["_rev"]))
+            except couchdb.http.ResourceConflict as e:
+                results.append((False, doc["_id"], e))
+        self.requests = requests + 1
+        return results
     def delete(self, doc):
+        self.requests += 1
         if "_id" in doc and "_rev" in doc:
             _id, _rev = doc["_id"], doc["_rev"]
             if _id in self.data:
@@ -78,13 +156,14 @@ class CouchTableMock:
                 else:
                     raise couchdb.http.ResourceConflict("stale rev")
             else:
-                raise KeyError("not found in table")
+                raise couchdb.http.ResourceConflict("not found in table")
         else:
             raise Exception("trying to delete a doc w/o _id and _rev: %r" % (doc,))
 
 class CouchServer:
-    def __init__(self, server):
+    def __init__(self, server, session=None):
         self.server = server
+        self.session = session
     def __getitem__(self, table_name):
         return CouchTableMock()
 
@@ -126,3 +205,120 @@ class test_CouchRegistry(unittest.TestCase, RegistryMixin):
         self.assertEqual(len(self.registry.unique.data), 2)
         self.assertIn("VAGOTH_NAME_node001.example.com", self.registry.unique)
         self.assertIn("node001_uniquekey", self.registry.unique)
+
+    def test_couch_get_nodes_uses_views(self):
+        self.registry.add_node("0x2", "node002", "vm", "mytenant", tags={"role": "db"})
+        self.registry.set_parent("0xdeadbeef", "0x2")
+        self.registry._install_views()
+        del self.registry.nodes.views_queried[:]
+        self.assertEqual([n.id for n in self.registry.get_nodes(parent="0x2")], ["0xdeadbeef"])
+        self.assertEqual([n.id for n in self.registry.get_nodes_with_type("vm")], ["0x2"])
+        self.assertEqual([n.id for n in self.registry.get_nodes_with_tags({"role": "db"})], ["0x2"])
+        self.assertEqual([n.id for n in self.registry.get_nodes_with_tags({"role": None})], ["0x2"])
+        self.assertEqual([n.id for n in self.registry.get_nodes(parent=None)], ["0x2"])
+        self.assertNotIn("_all_docs", self.registry.nodes.views_queried)
+        self.assertEqual(self.registry.nodes.views_queried,
+            [couch_registry.DESIGN_NAME + "/" + view for view in ("by_parent", "by_type", "by_tag", "by_tag", "by_parent")])
+
+    def test_couch_get_nodes_picks_smallest_view(self):
+        self.registry.add_node("0x2", "node002", "vm", "mytenant")
+        del self.registry.nodes.views_queried[:]
+        nodes = list(self.registry.get_nodes(tenant="mytenant", node_type="vm"))
+        self.assertEqual([n.id for n in nodes], ["0x2"])
+        # counts from both views, then the documents from the smaller one
+        self.assertEqual(self.registry.nodes.views_queried[-1], couch_registry.DESIGN_NAME + "/by_type")
+        self.assertIn("view by_type key=\"vm\"", self.registry.explain(tenant="mytenant", node_type="vm"))
+
+    def test_couch_views_installed(self):
+        # a design doc from another version of VIEWS doesn't get in the way
+        self.registry.nodes["_design/vagoth-old"] = {"views": {"by_parent": {"map": "function(doc) {}"}}}
+        list(self.registry.get_nodes(parent=None))
+        self.assertEqual(self.registry.nodes.data[couch_registry.DESIGN_DOC]["views"], couch_registry.VIEWS)
+        self.assertIn("_design/vagoth-old", self.registry.nodes.data)
+        # the design docs are not nodes
+        self.assertEqual(self.registry.list_nodes(), ["0xdeadbeef"])
+        self.assertEqual([n.id for n in self.registry.get_nodes()], ["0xdeadbeef"])
+
+    def test_couch_lookups_take_one_request(self):
+        self.registry._install_views()
+        requests = self.registry.nodes.requests + self.registry.unique.requests
+        self.assertEqual(self.registry.get_node_by_name("node001.example.com").id, "0xdeadbeef")
+        self.assertEqual(self.registry.get_node_by_key("node001_uniquekey").id, "0xdeadbeef")
+        self.assertEqual(self.registry.get_node_by_key("VAGOTH_NAME_node001.example.com").id, "0xdeadbeef")
+        self.assertEqual(self.registry.nodes.requests + self.registry.unique.requests, requests + 3)
+        self.assertRaises(exceptions.NodeNotFoundException, self.registry.get_node_by_key, "missing")
+
+    def test_couch_claim_unique_keys_backs_out(self):
+        self.registry._claim_unique_keys("0x1", ["B"])
+        self.registry.unique.data["B"]["_rev"] = "stolen"
+        # B looks free to the multi-get, then conflicts in _bulk_docs
+        get_docs = self.registry._get_docs
+        self.registry._get_docs = lambda table, keys: {}
+        self.assertRaises(exceptions.UniqueConstraintViolation,
+            self.registry._claim_unique_keys, "0x2", ["A", "B", "C"])
+        self.registry._get_docs = get_docs
+        self.assertNotIn("A", self.registry.unique.data)
+        self.assertNotIn("C", self.registry.unique.data)
+        self.assertEqual(self.registry.unique.data["B"]["node_id"], "0x1")
+
+    def test_couch_write_returns_saved_doc(self):
+        before = self.registry.nodes.requests
+        doc = self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+        # one GET and one PUT, and no read back
+        self.assertEqual(self.registry.nodes.requests, before + 2)
+        self.assertEqual(doc.node_dict["_rev"], self.registry.nodes.data["0xdeadbeef"]["_rev"])
+        self.assertEqual(doc.metadata["state"], "running")
+
+    def test_couch_constant_requests(self):
+        def count(func, *args, **kwargs):
+            before = self.registry.nodes.requests + self.registry.unique.requests
+            func(*args, **kwargs)
+            return self.registry.nodes.requests + self.registry.unique.requests - before
+        few_keys = count(self.registry.add_node, "0x2", "node002", "vm", unique_keys=["k1"])
+        many_keys = count(self.registry.add_node, "0x3", "node003", "vm", unique_keys=["k%d" % i for i in range(2, 12)])
+        self.assertEqual(few_keys, 4)
+        self.assertEqual(many_keys, 4)
+        self.assertEqual(count(self.registry.set_node, "0x3", node_name="node003b",
+            unique_keys=["k%d" % i for i in range(12, 22)]), 6)
+        self.assertNotIn("k2", self.registry.unique)
+        self.assertNotIn("VAGOTH_NAME_node003", self.registry.unique)
+        self.assertEqual(self.registry.get_node_by_key("k12").id, "0x3")
+        self.assertEqual(count(self.registry.delete_node, "0x3"), 4)
+        self.assertEqual([k for k in self.registry.unique.data if k.startswith("k")], ["k1"])
+
+    def test_couch_batch_claim_failure_leaves_queued_doc(self):
+        self.registry.add_node("0x2", "node002", "vm")
+        # the failed set_node is caught inside the block, so the batch
+        # exits normally and writes what was queued
+        with self.registry.batch():
+            self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+            self.assertRaises(exceptions.UniqueConstraintViolation,
+                self.registry.set_node, "0xdeadbeef", node_name="node002", metadata={})
+        node = self.registry.get_node("0xdeadbeef")
+        self.assertEqual(node.name, "node001.example.com")
+        self.assertEqual(node.metadata["state"], "running")
+
+    def test_couch_batch_set_node(self):
+        with self.registry.batch():
+            self.registry.set_node("0xdeadbeef", node_name="node001b", unique_keys=["k1"])
+            # claimed now, released or written at the end
+            self.assertIn("k1", self.registry.unique.data)
+            self.assertIn("node001_uniquekey", self.registry.unique.data)
+        self.assertEqual(self.registry.nodes.data["0xdeadbeef"]["name"], "node001b")
+        self.assertEqual(sorted(self.registry.unique.data), ["VAGOTH_NAME_node001b", "k1"])
+
+    def test_couch_batch_releases_claims_of_failed_rows(self):
+        self.registry.add_node("0x2", "node002", "vm")
+        try:
+            with self.registry.batch():
+                self.registry.set_node("0xdeadbeef", node_name="node001b", unique_keys=["k1"])
+                self.registry.update_metadata("0x2", {"state": "running"})
+                # someone else writes 0xdeadbeef first
+                self.registry.nodes.data["0xdeadbeef"]["_rev"] = "stolen"
+            self.fail("batch should have raised")
+        except exceptions.RegistryException as e:
+            self.assertIn("0xdeadbeef", str(e))
+        self.assertEqual(self.registry.nodes.data["0x2"]["metadata"], {"state": "running"})
+        self.assertEqual(self.registry.nodes.data["0xdeadbeef"]["name"], "node001.example.com")
+        self.assertEqual(sorted(k for k in self.registry.unique.data if "node001" in k or k == "k1"),
+            ["VAGOTH_NAME_node001.example.com", "node001_uniquekey"])
@@ -0,0 +1,131 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.registry.couch_session
+"""
+
+import unittest
+import threading
+import json
+import BaseHTTPServer
+import SocketServer
+import couchdb
+from ..registry.couch_session import LRUCache, BoundedConnectionPool, make_session
+
+class FakeCouchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the docs of one database, honouring If-None-Match"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.path)
+        doc = server.docs.get(self.path.split("/")[-1], None)
+        if doc is None:
+            body = json.dumps({"error": "not_found", "reason": "missing"})
+            self.send_response(404)
+        else:
+            etag = '"%s"' % (doc["_rev"],)
+            if self.headers.get("If-None-Match", None) == etag:
+                server.not_modified += 1
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = json.dumps(doc)
+            self.send_response(200)
+            self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeCouchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # keep-alive connections would otherwise block shutdown()
+    daemon_threads = True
+
+class FakeConnection(object):
+    closed = False
+    def close(self):
+        self.closed = True
+
+class test_LRUCache(unittest.TestCase):
+    def test_eviction_order(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_counters(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.get("a"), None)
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.remove("a") # the second get wasn't answered by a 304
+        self.assertEqual(cache.stats(), {"size": 0, "max_size": 10, "hits": 1, "misses": 1, "stale": 1})
+
+class test_BoundedConnectionPool(unittest.TestCase):
+    def test_release_closes_extra_connections(self):
+        pool = BoundedConnectionPool(None, max_idle=2)
+        conns = [FakeConnection() for i in range(3)]
+        for conn in conns:
+            pool.release("http://couch:5984/db/doc", conn)
+        self.assertEqual([c.closed for c in conns], [False, False, True])
+        self.assertEqual(len(pool.conns[("http", "couch:5984")]), 2)
+
+class test_make_session(unittest.TestCase):
+    def setUp(self):
+        self.httpd = FakeCouchServer(("127.0.0.1", 0), FakeCouchHandler)
+        self.httpd.docs = {"node1": {"_id": "node1", "_rev": "1-a", "name": "node1"}}
+        self.httpd.requests = []
+        self.httpd.not_modified = 0
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.session = make_session(pool_size=2, cache_size=10)
+        server = couchdb.Server("http://127.0.0.1:%d/" % (self.httpd.server_port,), session=self.session)
+        self.db = server["nodes"]
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_revalidates_with_etag(self):
+        self.assertEqual(self.db["node1"]["name"], "node1")
+        self.assertEqual(self.db["node1"]["name"], "node1")
+        self.assertEqual(self.httpd.not_modified, 1)
+        self.httpd.docs["node1"] = {"_id": "node1", "_rev": "2-b", "name": "renamed"}
+        self.assertEqual(self.db["node1"]["name"], "renamed")
+        stats = self.session.cache.stats()
+        # the HEAD sent by server["nodes"] was a miss too
+        self.assertEqual((stats["hits"], stats["misses"], stats["stale"]), (1, 2, 1))
@@ -41,3 +41,66 @@ class testDictRegistry(unittest.TestCase, RegistryMixin):
         self.assertEqual(len(self.registry.unique), 2)
         self.assertIn("VAGOTH_NAME_node001.example.com", self.registry.unique)
         self.assertIn("node001_uniquekey", self.registry.unique)
+
+    def test_dict_index_follows_parent(self):
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv", tenant=None)
+        self.registry.set_parent("0xdeadbeef", "othernode")
+        self.assertEqual(self.registry.index.with_parent("othernode"), set(["0xdeadbeef"]))
+        self.assertRaises(exceptions.NodeStillUsedException,
+            self.registry.delete_node, "othernode")
+        self.registry.set_parent("0xdeadbeef", None)
+        self.assertEqual(self.registry.index.with_parent("othernode"), set())
+        self.registry.delete_node("othernode")
+        self.assertNotIn("othernode", self.registry.index.with_type("hv"))
+
+    def test_dict_index_follows_set_node(self):
+        self.registry.set_node("0xdeadbeef", node_name="foo.example.com",
+            tenant="othertenant", tags={"role": "db"})
+        self.assertEqual(self.registry.get_node_by_name("foo.example.com").id, "0xdeadbeef")
+        self.assertRaises(exceptions.NodeNotFoundException,
+            self.registry.get_node_by_name, "node001.example.com")
+        self.assertEqual(0, len(list(self.registry.get_nodes(tenant="mytenant"))))
+        self.assertEqual(1, len(list(self.registry.get_nodes(tenant="othertenant"))))
+        self.assertEqual(0, len(list(self.registry.get_nodes_with_tags({"tag1": None}))))
+        self.assertEqual(1, len(list(self.registry.get_nodes_with_tags({"role": "db"}))))
+
+    def test_dict_get_nodes_with_tags_matches_all(self):
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv",
+            tenant=None, tags={"tag1": True})
+        nodes = list(self.registry.get_nodes_with_tags({"tag1": None, "tag2": "somevalue"}))
+        self.assertEqual([node.id for node in nodes], ["0xdeadbeef"])
+        nodes = list(self.registry.get_nodes_with_tags({"tag1": True}))
+        self.assertEqual(len(nodes), 2)
+
+    def test_dict_unhashable_tag_values(self):
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv",
+            tenant=None, tags={"disks": ["sda", "sdb"]})
+        nodes = list(self.registry.get_nodes(tags={"disks": ["sda", "sdb"]}))
+        self.assertEqual([node.id for node in nodes], ["othernode"])
+        self.assertEqual(0, len(list(self.registry.get_nodes(tags={"disks": ["sda"]}))))
+
+    def test_dict_explain_uses_narrowest_index(self):
+        for i in range(5):
+            self.registry.add_node("vm%d" % (i,), node_name="vm%d" % (i,), node_type="vm",
+                tenant="mytenant", tags={"role": i == 0 and "db" or "web"})
+        plan = self.registry._plan(tenant="mytenant", tags={"role": "db"})
+        self.assertEqual(plan.access.field, "tag")
+        self.assertEqual(plan.access.estimate, 1)
+        self.assertEqual([p.field for p in plan.filters], ["tenant"])
+        self.assertTrue(self.registry.explain(tenant="mytenant", tags={"role": "db"}).startswith(
+            "lookup tag role='db' (~1 of 6 nodes)"))
+        nodes = list(self.registry.get_nodes(tenant="mytenant", tags={"role": "db"}))
+        self.assertEqual([node.id for node in nodes], ["vm0"])
+        self.assertTrue(self.registry.explain().startswith("scan all 6 nodes"))
+
+    def test_dict_tags_list_migrated_on_write_and_load(self):
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv",
+            tenant=None, tags=["old"])
+        self.assertEqual(self.registry.get_node("othernode").tags, {"old": True})
+        # a node dict loaded from an old pickle
+        self.registry.nodes["oldnode"] = {"node_id": "oldnode", "name": "oldnode", "type": "hv",
+            "parent": None, "definition": {}, "unique_keys": [], "tags": ["a"]}
+        self.registry._reindex()
+        node = self.registry.get_node("oldnode")
+        self.assertEqual((node.tags, node.tenant, node.metadata), ({"a": True}, None, {}))
+        self.assertFalse(hasattr(node, "__dict__"))
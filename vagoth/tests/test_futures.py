@@ -0,0 +1,90 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.virt.utils.futures
+"""
+
+import unittest
+import threading
+import time
+from ..virt.utils.futures import Future, Executor, chain, gather, expire, call_at
+from ..virt.exceptions import DriverException, DriverTimeoutException
+
+class testFutures(unittest.TestCase):
+    def test_future(self):
+        future = Future()
+        done = []
+        future.add_done_callback(done.append)
+        self.assertFalse(future.done())
+        self.assertRaises(DriverTimeoutException, future.result, 0.01)
+        self.assertTrue(future.set_result(1))
+        self.assertFalse(future.set_exception(DriverException("too late")))
+        self.assertEqual((future.result(), future.exception()), (1, None))
+        self.assertEqual(done, [future])
+        # called straight away once done
+        future.add_done_callback(done.append)
+        self.assertEqual(len(done), 2)
+
+    def test_chain(self):
+        future = Future()
+        doubled = chain(future, lambda value: value * 2)
+        failed = chain(future, lambda value: value / 0)
+        future.set_result(2)
+        self.assertEqual(doubled.result(), 4)
+        self.assertTrue(isinstance(failed.exception(), ZeroDivisionError))
+        future = Future()
+        chained = chain(future, lambda value: value * 2)
+        future.set_exception(DriverException("failed"))
+        self.assertRaises(DriverException, chained.result)
+
+    def test_gather_and_expire(self):
+        futures = [Future(), Future(), expire(Future(), 0.1, "expired")]
+        call_at(time.time() + 0.05, lambda: futures[0].set_result("late"))
+        futures[1].set_exception(DriverException("failed"))
+        start = time.time()
+        results = gather(futures, timeout=2)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(results[0], "late")
+        self.assertTrue(isinstance(results[1], DriverException))
+        self.assertTrue(isinstance(results[2], DriverTimeoutException))
+
+    def test_executor(self):
+        executor = Executor(workers=3)
+        running = []
+        def work(i):
+            running.append(threading.current_thread())
+            time.sleep(0.1)
+            return i
+        try:
+            start = time.time()
+            self.assertEqual(gather([executor.submit(work, i) for i in range(9)]), range(9))
+            self.assertTrue(0.25 < time.time() - start < 1)
+            self.assertEqual(len(set(running)), 3)
+        finally:
+            executor.shutdown()
+
+    def test_executor_shutdown_timeout(self):
+        executor = Executor(workers=1)
+        release = threading.Event()
+        executor.submit(release.wait)
+        start = time.time()
+        executor.shutdown(timeout=0.2)
+        self.assertTrue(time.time() - start < 1)
+        release.set()
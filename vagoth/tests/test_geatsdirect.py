@@ -0,0 +1,144 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.virt.drivers.geatsdirect against fake_geats_agent.FakeAgent
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import socket
+import threading
+from fake_geats_agent import FakeAgent
+from ..interfaces.driver import IAsyncDriver
+from ..virt.drivers.geatsdirect import GeatsDirect, AgentConnection
+from ..virt.utils.futures import gather
+from ..virt.exceptions import DriverException, DriverTimeoutException
+
+class Named(object):
+    def __init__(self, node_id, definition=None):
+        self.node_id = node_id
+        self.definition = definition or {}
+
+class testGeatsDirect(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.agent = FakeAgent("127.0.0.1:0").start()
+        self.node = Named("hv1", {"geats_address": self.agent.address})
+        self.driver = GeatsDirect(None, {"connections": "2", "backoff": "0.2"})
+
+    def tearDown(self):
+        self.driver.cleanup()
+        self.agent.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_calls(self):
+        self.assertEqual(self.driver.start(self.node, Named("vm1")), True)
+        self.assertEqual(self.driver.info(self.node, Named("vm1")), {"vm_name": "vm1", "node": "hv1"})
+        status = self.driver.status(self.node)
+        self.assertEqual([(vm["_name"], vm["_parent"]) for vm in status], [("vm1", "hv1"), ("hv1", None)])
+        self.assertRaises(DriverException, self.driver._call, "fail", self.node)
+        # the connection was kept open
+        self.assertEqual(self.agent.connections, 1)
+
+    def test_unix_socket(self):
+        agent = FakeAgent("unix:" + os.path.join(self.tmpdir, "{node}.sock").format(node="hv2")).start()
+        try:
+            driver = GeatsDirect(None, {"address": "unix:" + os.path.join(self.tmpdir, "{node}.sock")})
+            self.assertEqual(driver.start(Named("hv2"), Named("vm1")), True)
+            driver.cleanup()
+        finally:
+            agent.stop()
+
+    def test_pipelining(self):
+        self.agent.latency = 0.2
+        threads = [threading.Thread(target=self.driver.start, args=(self.node, Named("vm%d" % (i,))))
+            for i in range(10)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertTrue(self.agent.connections <= 2)
+
+    def test_timeout_and_dropped_connection(self):
+        self.assertRaises(DriverTimeoutException, self.driver._call, "hang", self.node, 0.2)
+        self.assertRaises(DriverException, self.driver._call, "drop", self.node, 5)
+        # a new connection is made for the next call
+        self.assertEqual(self.driver._call("info", self.node, 5), {})
+        self.assertEqual(self.agent.connections, 2)
+
+    def test_send_timeout(self):
+        # an agent which never reads its requests
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        try:
+            conn = AgentConnection("127.0.0.1:%d" % (listener.getsockname()[1],), send_timeout=0.2)
+            start = time.time()
+            self.assertRaises(DriverException, conn.send, "define", {"definition": "x" * (16 * 1024 * 1024)})
+            self.assertTrue(time.time() - start < 5)
+            self.assertTrue(conn.closed)
+            conn.close()
+        finally:
+            listener.close()
+
+    def test_bad_address(self):
+        for address in ("hv1", "hv1:", "hv1:port"):
+            node = Named("hv1", {"geats_address": address})
+            self.assertRaises(DriverException, self.driver.start, node, Named("vm1"))
+            # and again, rather than waiting on a slot the first call held
+            self.assertRaises(DriverException, self.driver.start, node, Named("vm1"))
+
+    def test_reconnect_backoff(self):
+        address = self.agent.address
+        self.agent.stop()
+        self.assertRaises(DriverException, self.driver.start, self.node, Named("vm1"))
+        self.assertEqual(self.driver._pool(self.node).failures, 1)
+        # refused straight away while backing off
+        self.assertRaises(DriverException, self.driver.start, self.node, Named("vm1"))
+        self.assertEqual(self.driver._pool(self.node).failures, 1)
+        self.agent = FakeAgent(address).start()
+        time.sleep(0.25)
+        self.assertEqual(self.driver.start(self.node, Named("vm1")), True)
+        self.assertEqual(self.driver._pool(self.node).failures, 0)
+
+    def test_async_calls_share_a_connection(self):
+        self.assertTrue(IAsyncDriver.providedBy(self.driver))
+        driver = GeatsDirect(None, {"connections": "1"})
+        self.agent.latency = 0.2
+        try:
+            start = time.time()
+            futures = [driver.start_async(self.node, Named("vm%d" % (i,))) for i in range(50)]
+            futures.append(driver.status_async(self.node))
+            results = gather(futures, timeout=5)
+            self.assertTrue(time.time() - start < 1)
+            self.assertEqual(results[:50], [True] * 50)
+            self.assertEqual(results[50][-1]["_name"], "hv1")
+            self.assertEqual(self.agent.connections, 1)
+            # a missed deadline fails the future without anyone waiting on it
+            future = driver._call_async("hang", self.node, 0.1)
+            time.sleep(0.3)
+            self.assertTrue(isinstance(future.exception(0), DriverTimeoutException))
+        finally:
+            driver.cleanup()
@@ -0,0 +1,140 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.virt.drivers.geatslocal and its AgentPool, using
+fake_geats_jsonagent.py as the agent
+"""
+
+import unittest
+import os
+import sys
+import time
+import threading
+from ..virt.drivers.geatslocal import GeatsLocal, local_call
+from ..virt.utils.agent_pool import AgentPool, Latencies
+from ..virt.exceptions import DriverException, DriverTimeoutException
+
+FAKE_AGENT = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_geats_jsonagent.py")]
+
+class Named(object):
+    def __init__(self, node_id):
+        self.node_id = node_id
+
+class testAgentPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = AgentPool(FAKE_AGENT, size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        os.environ.pop("FAKE_AGENT_LATENCY", None)
+
+    def test_reuses_workers(self):
+        first = self.pool.call("info", timeout=5, vm_name="vm1")
+        self.assertEqual(first["vm_name"], "vm1")
+        self.assertEqual(self.pool.call("info", timeout=5)["pid"], first["pid"])
+        self.assertEqual(self.pool.starts, 1)
+
+    def test_size(self):
+        os.environ["FAKE_AGENT_LATENCY"] = "0.2"
+        threads = [threading.Thread(target=self.pool.call, args=("info", 5)) for i in range(6)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # three rounds of two
+        self.assertTrue(0.55 < time.time() - start < 1.5)
+        self.assertEqual(self.pool.starts, 2)
+
+    def test_timeout_replaces_worker(self):
+        pid = self.pool.call("info", timeout=5)["pid"]
+        start = time.time()
+        self.assertRaises(DriverTimeoutException, self.pool.call, "hang", timeout=0.2)
+        self.assertTrue(time.time() - start < 1)
+        self.assertNotEqual(self.pool.call("info", timeout=5)["pid"], pid)
+        self.assertEqual(self.pool.starts, 2)
+
+    def test_errors(self):
+        self.assertRaises(DriverException, self.pool.call, "fail", timeout=5)
+        self.assertRaises(DriverException, self.pool.call, "crash", timeout=5)
+        self.assertEqual(self.pool.call("info", timeout=5)["pid"] > 0, True)
+
+    def test_waiting_for_a_worker_counts_towards_the_deadline(self):
+        pool = AgentPool(FAKE_AGENT, size=1)
+        try:
+            hung = threading.Thread(target=lambda: self.assertRaises(DriverTimeoutException, pool.call, "hang", 1))
+            hung.start()
+            time.sleep(0.3)
+            self.assertRaises(DriverTimeoutException, pool.call, "info", 0.2)
+            hung.join()
+        finally:
+            pool.close()
+
+    def test_killed_worker_frees_its_slot_for_waiting_calls(self):
+        pool = AgentPool(FAKE_AGENT, size=1)
+        try:
+            hung = threading.Thread(target=lambda: self.assertRaises(DriverTimeoutException, pool.call, "hang", 0.5))
+            hung.start()
+            time.sleep(0.2)
+            start = time.time()
+            self.assertTrue(pool.call("info", 5)["pid"] > 0)
+            self.assertTrue(time.time() - start < 2)
+            hung.join()
+            self.assertEqual(pool.starts, 2)
+        finally:
+            pool.close()
+
+class testLatencies(unittest.TestCase):
+    def test_percentiles(self):
+        latencies = Latencies(window=100)
+        self.assertEqual(latencies.percentiles(), {})
+        for i in range(1, 201):
+            latencies.add("start" if i % 2 else "stop", i / 1000.0)
+        # only the last 100 are kept
+        self.assertEqual(latencies.percentiles(points=(0, 50, 90, 100)),
+            {0: 0.101, 50: 0.150, 90: 0.190, 100: 0.200})
+        self.assertEqual(latencies.percentiles("stop", (50,)), {50: 0.100})
+
+class testGeatsLocal(unittest.TestCase):
+    def test_local_call_timeout(self):
+        self.assertEqual(local_call("info", 5, FAKE_AGENT, vm_name="vm1")["vm_name"], "vm1")
+        start = time.time()
+        self.assertRaises(DriverTimeoutException, local_call, "hang", 0.2, FAKE_AGENT)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_local_call_timeout_while_writing(self):
+        # sleep never reads its stdin, so the write blocks until it's killed
+        start = time.time()
+        self.assertRaises(DriverTimeoutException, local_call, "define", 0.2, ["sleep", "5"],
+            definition="x" * (1024 * 1024))
+        self.assertTrue(time.time() - start < 2)
+
+    def test_pooled_driver(self):
+        driver = GeatsLocal(None, {"agent_command": " ".join(FAKE_AGENT), "pool_size": "2"})
+        try:
+            node = Named(os.uname()[1])
+            self.assertEqual(driver.start(node, Named("vm1")), True)
+            status = driver.status(node)
+            self.assertEqual([vm["_name"] for vm in status if vm["_type"] == "vm"], ["vm1"])
+            self.assertEqual(driver.pool.starts, 1)
+            self.assertEqual(sorted(driver.latency_percentiles()), [50, 90, 99])
+            self.assertEqual(len(driver.latency_percentiles("start")), 3)
+        finally:
+            driver.cleanup()
@@ -0,0 +1,184 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.manager.Manager
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import logging
+from .. import config
+from ..config import Config
+from ..manager import Manager
+from ..interfaces.driver import IAsyncDriver
+from ..exceptions import ActionException
+from ..virt.exceptions import DriverException
+
+CONFIG = """
+[registry]
+    factory = vagoth.registry.dict_registry:DictRegistry
+[scheduler]
+    factory = vagoth.scheduler.sync:SyncJobScheduler
+[provisioner]
+    factory = vagoth.provisioner.dummy:DummyProvisioner
+[virt]
+  [[allocator]]
+    factory = vagoth.virt.allocators.dummy:DummyAllocator
+  [[drivers]]
+    [[[default]]]
+      factory = vagoth.tests.test_manager:CountingDriver
+    [[[other]]]
+      factory = vagoth.tests.test_manager:CountingDriver
+[node_types]
+    vm = vagoth.virt.virtualmachine:VirtualMachine
+    hv = vagoth.virt.hypervisor:Hypervisor
+[actions]
+"""
+
+class CountingDriver(object):
+    created = []
+
+    def __init__(self, manager, local_config):
+        self.config = local_config
+        self.cleaned_up = False
+        CountingDriver.created.append(self)
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+    def start(self, node, vm):
+        if getattr(vm, "node_id", None) == "vmbad":
+            raise DriverException("start failed")
+        return (threading.current_thread(), node.node_id, vm)
+
+class OldDriver(object):
+    """A driver written before IDriver had cleanup()"""
+    def __init__(self, manager, local_config):
+        pass
+
+def make_manager(tmpdir, extra_config="", base_config=CONFIG):
+    """Return a Manager using a DictRegistry and the drivers above"""
+    path = os.path.join(tmpdir, "vagoth.conf")
+    with open(path, "w") as fd:
+        fd.write(base_config + extra_config)
+    config._static_config = None
+    try:
+        return Manager(config=Config([path]))
+    finally:
+        config._static_config = None
+
+class testManager(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manager = make_manager(self.tmpdir)
+        del CountingDriver.created[:]
+        registry = self.manager.registry
+        registry.add_node("hv1", "hv1", "hv", None, definition={})
+        registry.add_node("hv2", "hv2", "hv", None, definition={})
+        registry.add_node("hv3", "hv3", "hv", None, definition={"driver": "other"})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_drivers_are_shared(self):
+        hv1 = self.manager.get_node("hv1")
+        driver = hv1.driver
+        self.assertTrue(hv1.driver is driver)
+        self.assertTrue(self.manager.get_node("hv2").driver is driver)
+        self.assertFalse(self.manager.get_node("hv3").driver is driver)
+        self.assertEqual(len(CountingDriver.created), 2)
+
+    def test_drivers_created_once_across_threads(self):
+        drivers = []
+        def get_driver():
+            drivers.append(self.manager.get_node("hv1").driver)
+        threads = [threading.Thread(target=get_driver) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(CountingDriver.created), 1)
+        self.assertEqual(len(set(map(id, drivers))), 1)
+
+    def test_state_setter_uses_written_doc(self):
+        hv = self.manager.get_node("hv1")
+        reads = []
+        get_node = self.manager.registry.get_node
+        def counting_get_node(node_id):
+            reads.append(node_id)
+            return get_node(node_id)
+        self.manager.registry.get_node = counting_get_node
+        hv.state = "enabled"
+        self.assertEqual(hv.state, "enabled")
+        self.assertEqual(reads, [])
+
+    def test_cleanup_cleans_up_drivers(self):
+        driver = self.manager.get_driver("default")
+        self.manager.cleanup()
+        self.assertTrue(driver.cleaned_up)
+        # a new one is created if needed after cleanup
+        self.assertFalse(self.manager.get_driver("default") is driver)
+
+    def test_cleanup_skips_drivers_without_cleanup(self):
+        self.manager._drivers["old"] = OldDriver(self.manager, {})
+        logged = []
+        exception, logging.exception = logging.exception, lambda *args: logged.append(args)
+        try:
+            self.manager.cleanup()
+        finally:
+            logging.exception = exception
+        self.assertEqual(logged, [])
+
+    def test_async_driver_adapter(self):
+        hv1 = self.manager.get_node("hv1")
+        async_driver = hv1.async_driver
+        self.assertTrue(IAsyncDriver.providedBy(async_driver))
+        self.assertTrue(self.manager.get_node("hv2").async_driver is async_driver)
+        self.assertEqual(async_driver.timeout, 300)
+        thread, node_id, vm = async_driver.start_async(hv1, "vm1").result(5)
+        self.assertEqual((node_id, vm), ("hv1", "vm1"))
+        self.assertFalse(thread is threading.current_thread())
+        self.manager.cleanup()
+        self.assertEqual(async_driver.executor._threads, [])
+
+    def test_vm_bulk_failures_do_not_stop_the_others(self):
+        # actions makes its allocator from the global manager on import
+        from .. import manager as manager_module
+        if manager_module.manager is None:
+            manager_module.manager = self.manager
+            self.addCleanup(setattr, manager_module, "manager", None)
+        from ..virt.actions import vm_bulk
+        registry = self.manager.registry
+        for vm_name in ("vm1", "vmbad", "vm2"):
+            registry.add_node(vm_name, vm_name, "vm", None, definition={}, metadata={"state": "stopped"})
+            registry.set_parent(vm_name, "hv1")
+        try:
+            vm_bulk(self.manager, "start", ["vm1", "vmbad", "nosuch", "vm2"], timeout=5)
+            self.fail("vm_bulk should have raised")
+        except ActionException as e:
+            self.assertTrue("vmbad" in str(e) and "nosuch" in str(e))
+            self.assertFalse("vm1" in str(e) or "vm2" in str(e))
+        self.assertEqual(self.manager.get_node("vm1").state, "starting")
+        self.assertEqual(self.manager.get_node("vm2").state, "starting")
+        # put back as it was
+        self.assertEqual(self.manager.get_node("vmbad").state, "stopped")
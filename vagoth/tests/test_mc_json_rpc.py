@@ -0,0 +1,221 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.virt.utils.mc_json_rpc, using fake_mc_json_rpc.py as the helper
+"""
+
+import unittest
+import os
+import sys
+import time
+import threading
+import distutils.spawn
+from ..virt.utils.mc_json_rpc import MCollectiveHelper, MCollectiveException, make_request, spawn_call, \
+    mcollective_call_many, RUBY_SCRIPT, MCollectiveTimeout
+from ..virt.drivers.geats import GeatsMcollective
+from ..virt.exceptions import DriverException, DriverTimeoutException
+from ..interfaces.driver import IAsyncDriver
+
+FAKE_HELPER = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_mc_json_rpc.py")]
+RUBY = distutils.spawn.find_executable("ruby")
+# the real helper, with a stub in place of mcollective
+STUB_HELPER = [RUBY, "-I", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcollective_stub"), RUBY_SCRIPT]
+
+class testMCollectiveHelper(unittest.TestCase):
+    def setUp(self):
+        self.helper = MCollectiveHelper(FAKE_HELPER, grace=0)
+
+    def tearDown(self):
+        self.helper.close()
+        os.environ.pop("FAKE_MC_LATENCY", None)
+
+    def test_spawn_call(self):
+        result = spawn_call(make_request("geats", "status", identity="hv1", x=1), FAKE_HELPER)
+        self.assertEqual(result[0]["data"], {"action": "status", "arguments": {"x": 1}})
+
+    def test_call(self):
+        result = self.helper.call("geats", "start", identity="hv1", timeout=5, vm_name="vm1")
+        self.assertEqual(result[0]["data"], {"action": "start", "arguments": {"vm_name": "vm1"}})
+        self.helper.call("geats", "stop", timeout=5)
+        self.assertEqual(self.helper.starts, 1)
+
+    def test_calls_from_several_threads(self):
+        os.environ["FAKE_MC_LATENCY"] = "0.05"
+        results = []
+        def call(i):
+            results.append(self.helper.call("geats", "info", timeout=5, n=i)[0]["data"]["arguments"]["n"])
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), range(8))
+        self.assertEqual(self.helper.starts, 1)
+
+    def test_restart_after_crash(self):
+        self.helper.call("geats", "status", timeout=5)
+        self.assertRaises(MCollectiveException, self.helper.call, "geats", "crash", timeout=5)
+        self.assertEqual(self.helper.call("geats", "status", timeout=5)[0]["sender"], "fake")
+        self.assertEqual(self.helper.starts, 2)
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(MCollectiveException, self.helper.call, "geats", "hang", timeout=0.2)
+        self.assertTrue(time.time() - start < 1)
+        # the hung helper was killed, and a new one is started
+        self.assertEqual(self.helper.call("geats", "status", timeout=5)[0]["sender"], "fake")
+        self.assertEqual(self.helper.starts, 2)
+
+    def test_timeout_fails_queued_requests(self):
+        os.environ["FAKE_MC_HANG"] = "5"
+        try:
+            hung = self.helper.call_async("geats", "hang", timeout=0.2)
+            queued = self.helper.call_async("geats", "status", timeout=5)
+            start = time.time()
+            self.assertTrue(isinstance(hung.exception(2), MCollectiveException))
+            self.assertTrue(isinstance(queued.exception(2), MCollectiveException))
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            os.environ.pop("FAKE_MC_HANG", None)
+
+    def test_close_kills_hung_helpers(self):
+        os.environ["FAKE_MC_HANG"] = "30"
+        try:
+            self.helper.call_async("geats", "hang", timeout=60)
+            time.sleep(0.2)
+            start = time.time()
+            self.helper.close(grace=0.3)
+            self.assertTrue(time.time() - start < 2)
+        finally:
+            os.environ.pop("FAKE_MC_HANG", None)
+
+    def test_call_many(self):
+        requests = [("geats", "info", "hv%d" % (i,), {"n": i}) for i in range(8)]
+        results = mcollective_call_many(requests, timeout=5, command=FAKE_HELPER)
+        self.assertEqual([result[0]["data"]["arguments"]["n"] for result in results], range(8))
+
+    def test_call_async(self):
+        os.environ["FAKE_MC_LATENCY"] = "0.2"
+        futures = [self.helper.call_async("geats", "info", timeout=5, n=i) for i in range(5)]
+        self.assertEqual([future.result(2)[0]["data"]["arguments"]["n"] for future in futures], range(5))
+        hung = self.helper.call_async("geats", "hang", timeout=0.1)
+        self.assertTrue(isinstance(hung.exception(2), MCollectiveTimeout))
+        self.assertTrue(isinstance(hung.exception(), DriverTimeoutException))
+
+    def test_processes_run_calls_in_parallel(self):
+        os.environ["FAKE_MC_LATENCY"] = "0.2"
+        helper = MCollectiveHelper(FAKE_HELPER, grace=0, processes=4)
+        try:
+            start = time.time()
+            futures = [helper.call_async("geats", "info", timeout=5, n=i) for i in range(8)]
+            self.assertEqual([future.result(5)[0]["data"]["arguments"]["n"] for future in futures], range(8))
+            self.assertTrue(time.time() - start < 0.8)
+            self.assertEqual(helper.starts, 4)
+            # an idle helper is reused rather than starting another
+            helper.call("geats", "status", timeout=5)
+            self.assertEqual(helper.starts, 4)
+        finally:
+            helper.close()
+
+    def test_call_many_with_processes(self):
+        os.environ["FAKE_MC_LATENCY"] = "0.2"
+        requests = [("geats", "info", "hv%d" % (i,), {"n": i}) for i in range(6)]
+        start = time.time()
+        results = mcollective_call_many(requests, timeout=5, command=FAKE_HELPER, processes=3)
+        self.assertEqual([result[0]["data"]["arguments"]["n"] for result in results], range(6))
+        self.assertTrue(time.time() - start < 1)
+
+    def test_call_many_failures(self):
+        requests = [("geats", "status", None, {}), ("geats", "hang", None, {})]
+        results = self.helper.call_many(requests, timeout=0.3)
+        self.assertEqual(results[0][0]["sender"], "fake")
+        self.assertTrue(isinstance(results[1], MCollectiveException))
+
+@unittest.skipUnless(RUBY, "needs ruby")
+class testRubyHelper(unittest.TestCase):
+    """mc_json_rpc.rb itself, loading the stub in vagoth/tests/mcollective_stub"""
+    def test_spawn_call(self):
+        result = spawn_call(make_request("geats", "status", identity="hv1", x=1), STUB_HELPER)
+        self.assertEqual(result[0]["data"], {"action": "status", "arguments": {"x": 1}, "identity": "hv1"})
+
+    def test_serve(self):
+        helper = MCollectiveHelper(STUB_HELPER, grace=5)
+        results = []
+        def call(i):
+            results.append(helper.call("geats", "info", identity="hv%d" % (i,), timeout=5, n=i, sleep=0.02))
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(4)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            helper.close()
+        # no errors from --serve reaching mcollective's options, or from overlapping calls
+        self.assertEqual(sorted(result[0]["data"]["arguments"]["n"] for result in results), range(4))
+        self.assertEqual(helper.starts, 1)
+
+    def test_call_many(self):
+        requests = [("geats", "start", "hv%d" % (i,), {"vm_name": "vm%d" % (i,), "sleep": 0.02}) for i in range(6)]
+        results = mcollective_call_many(requests, timeout=5, command=STUB_HELPER)
+        self.assertEqual([result[0]["data"]["identity"] for result in results], ["hv%d" % (i,) for i in range(6)])
+        self.assertEqual([result[0]["data"]["arguments"]["vm_name"] for result in results],
+            ["vm%d" % (i,) for i in range(6)])
+
+    def test_driver_batch(self):
+        driver = GeatsMcollective(None, {"persistent_helper": "true"})
+        driver.helper = MCollectiveHelper(STUB_HELPER, grace=5)
+        try:
+            results = driver.start_many([(Named("hv%d" % (i,)), Named("vm%d" % (i,))) for i in range(4)])
+        finally:
+            driver.cleanup()
+        self.assertEqual(results, [True] * 4)
+
+class Named(object):
+    def __init__(self, node_id):
+        self.node_id = node_id
+
+class testGeatsMcollective(unittest.TestCase):
+    def test_start_many(self):
+        driver = GeatsMcollective(None, {"persistent_helper": "true"})
+        driver.helper = MCollectiveHelper(FAKE_HELPER, grace=0)
+        try:
+            results = driver.start_many([(Named("hv1"), Named("vm1")), (Named("hv2"), Named("missing"))])
+        finally:
+            driver.cleanup()
+        self.assertEqual(results[0], True)
+        self.assertTrue(isinstance(results[1], DriverException))
+        self.assertEqual(driver.helper.starts, 1)
+
+    def test_async_with_persistent_helper(self):
+        self.assertFalse(IAsyncDriver.providedBy(GeatsMcollective(None, {})))
+        driver = GeatsMcollective(None, {"persistent_helper": "true"})
+        self.assertTrue(IAsyncDriver.providedBy(driver))
+        driver.helper = MCollectiveHelper(FAKE_HELPER, grace=0)
+        try:
+            started = driver.start_async(Named("hv1"), Named("vm1"))
+            missing = driver.stop_async(Named("hv1"), Named("missing"))
+            self.assertEqual(started.result(5), True)
+            self.assertTrue(isinstance(missing.exception(5), DriverException))
+            self.assertFalse(isinstance(missing.exception(), DriverTimeoutException))
+            hung = driver._call_single_async("hang", Named("hv1"), Named("vm1"), timeout=0.1)
+            self.assertTrue(isinstance(hung.exception(5), DriverTimeoutException))
+        finally:
+            driver.cleanup()
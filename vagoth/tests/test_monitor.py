@@ -0,0 +1,352 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.virt.monitor.Monitor
+"""
+
+import unittest
+import shutil
+import tempfile
+import time
+import threading
+import zope.interface as ZI
+from test_manager import make_manager, CONFIG
+from ..interfaces.driver import IAsyncDriver
+from ..virt.utils.futures import Future
+from ..virt.exceptions import DriverException
+from ..virt.monitor import Monitor
+from ..virt.monitor_daemon import MonitorDaemon
+
+class StatusDriver(object):
+    """
+    Returns the statuses in StatusDriver.vms for each hypervisor,
+    after sleeping for StatusDriver.delays[node_id] seconds.  Without a
+    node, it returns the statuses of all the hypervisors in StatusDriver.up
+    which aren't failing.
+    """
+    broadcast_status = True
+    vms = {}
+    delays = {}
+    failing = set()
+    up = []
+    calls = []
+
+    def __init__(self, manager, local_config):
+        pass
+
+    def _status(self, node_id):
+        status = [{"_name": node_id, "_type": "hv", "_parent": None, "load": 1}]
+        for vm_name, state in self.vms.get(node_id, {}).items():
+            status.append({"_name": vm_name, "_type": "vm", "_parent": node_id,
+                "state": (state, state), "definition": {"name": vm_name}})
+        return status
+
+    def status(self, node=None):
+        self.calls.append(node)
+        if node is None:
+            status = []
+            for node_id in self.up:
+                if node_id not in self.failing:
+                    status.extend(self._status(node_id))
+            return status
+        time.sleep(self.delays.get(node.node_id, 0))
+        if node.node_id in self.failing:
+            raise DriverException("%s is down" % (node.node_id,))
+        return self._status(node.node_id)
+
+    def cleanup(self):
+        pass
+
+@ZI.implementer(IAsyncDriver)
+class AsyncStatusDriver(StatusDriver):
+    """A StatusDriver whose status_async() needs no thread while it waits"""
+    def status_async(self, node=None):
+        self.calls.append(node)
+        future = Future()
+        def reply():
+            if node.node_id in self.failing:
+                future.set_exception(DriverException("%s is down" % (node.node_id,)))
+            else:
+                future.set_result(self._status(node.node_id))
+        timer = threading.Timer(self.delays.get(node.node_id, 0), reply)
+        timer.daemon = True
+        timer.start()
+        return future
+
+class MonitorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manager = make_manager(self.tmpdir,
+            base_config=CONFIG.replace("test_manager:CountingDriver", "test_monitor:StatusDriver"))
+        registry = self.manager.registry
+        for hv in ("hv1", "hv2", "hv3", "hv4"):
+            registry.add_node(hv, hv, "hv", None, definition={})
+        for vm in ("vm1", "vm2", "vm3"):
+            registry.add_node(vm, vm, "vm", None, definition={}, metadata={"state": "defined"})
+        registry.set_parent("vm3", "hv2")
+        StatusDriver.vms = {"hv1": {"vm1": "running"}, "hv2": {"vm2": "stopped"}}
+        StatusDriver.delays = {}
+        StatusDriver.failing = set()
+        StatusDriver.up = ["hv1", "hv2", "hv3", "hv4"]
+        StatusDriver.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+class testMonitor(MonitorTestCase):
+    def test_poll_updates_registry(self):
+        report = Monitor(self.manager, {}).poll_nodes()
+        registry = self.manager.registry
+        self.assertEqual(registry.get_node("vm1").parent, "hv1")
+        self.assertEqual(registry.get_node("vm1").metadata["state"], "running")
+        self.assertEqual(registry.get_node("vm2").parent, "hv2")
+        self.assertEqual(registry.get_node("vm2").metadata["state"], "stopped")
+        # vm3 wasn't found on hv2
+        self.assertEqual(registry.get_node("vm3").parent, None)
+        self.assertEqual(registry.get_node("vm3").metadata["state"], "unassigned")
+        self.assertEqual(registry.get_node("hv1").metadata["load"], 1)
+        self.assertEqual(sorted(report.timings), ["hv1", "hv2", "hv3", "hv4"])
+        self.assertEqual(report.timeouts, [])
+
+    def test_poll_some_nodes_reads_only_those(self):
+        registry = self.manager.registry
+        queries = []
+        get_nodes = registry.get_nodes
+        def counting_get_nodes(**kwargs):
+            queries.append(kwargs)
+            return get_nodes(**kwargs)
+        registry.get_nodes = counting_get_nodes
+        report = Monitor(self.manager, {}).poll_nodes(["hv2", "hv9"])
+        self.assertEqual(report.polled, ["hv2"])
+        self.assertEqual(queries, [{"parent": "hv2"}])
+        self.assertEqual(registry.get_node("vm3").parent, None)
+
+    def test_polls_concurrently(self):
+        StatusDriver.delays = dict.fromkeys(["hv1", "hv2", "hv3", "hv4"], 0.2)
+        report = Monitor(self.manager, {"poll_concurrency": "4"}).poll_nodes()
+        self.assertTrue(report.wall_time < 0.6, report.wall_time)
+        self.assertEqual(self.manager.registry.get_node("vm1").metadata["state"], "running")
+
+    def test_timeouts_and_errors(self):
+        StatusDriver.delays = {"hv1": 0.2, "hv3": 5}
+        StatusDriver.failing = set(["hv4"])
+        report = Monitor(self.manager, {"poll_concurrency": "2", "poll_timeout": "1"}).poll_nodes()
+        self.assertTrue(report.wall_time < 2, report.wall_time)
+        self.assertEqual(report.timeouts, ["hv3"])
+        self.assertEqual(report.errors, ["hv4"])
+        self.assertEqual(report.slowest(1), [("hv3", 1.0)])
+        # the other hypervisors were still updated
+        self.assertEqual(self.manager.registry.get_node("vm1").metadata["state"], "running")
+        self.assertEqual(self.manager.registry.get_node("vm2").metadata["state"], "stopped")
+
+    def test_hung_hosts_do_not_pile_up_threads(self):
+        StatusDriver.delays = {"hv3": 1.5, "hv4": 1.5}
+        monitor = Monitor(self.manager, {"poll_concurrency": "3", "poll_timeout": "0.2"})
+        threads = threading.active_count()
+        self.assertEqual(sorted(monitor.poll_nodes().timeouts), ["hv3", "hv4"])
+        report = monitor.poll_nodes()
+        # not called again while their last call is still running
+        self.assertEqual(sorted(report.timeouts), ["hv3", "hv4"])
+        self.assertEqual(report.timings["hv3"], 0.0)
+        self.assertEqual(sorted(report.polled), ["hv1", "hv2"])
+        self.assertTrue(threading.active_count() - threads <= 2)
+        # the hung calls don't take the healthy hosts' slots
+        monitor.poll_concurrency = 1
+        report = monitor.poll_nodes()
+        self.assertEqual(sorted(report.timeouts), ["hv3", "hv4"])
+        self.assertEqual(sorted(report.polled), ["hv1", "hv2"])
+
+    def test_update_errors_are_reported(self):
+        monitor = Monitor(self.manager, {})
+        update_node = monitor.update_node
+        def failing_update_node(node, status, manager=None):
+            if node.node_id == "hv1":
+                raise IOError("registry unavailable")
+            return update_node(node, status, manager)
+        monitor.update_node = failing_update_node
+        report = monitor.poll_nodes()
+        self.assertEqual(report.errors, ["hv1"])
+        self.assertNotIn("hv1", report.polled)
+        self.assertEqual(self.manager.registry.get_node("vm2").metadata["state"], "stopped")
+
+    def test_broadcast(self):
+        StatusDriver.failing = set(["hv4"])
+        report = Monitor(self.manager, {"poll_mode": "broadcast"}).poll_nodes()
+        self.assertEqual(StatusDriver.calls, [None])
+        self.assertEqual(report.unreachable, ["hv4"])
+        registry = self.manager.registry
+        self.assertEqual(registry.get_node("vm1").parent, "hv1")
+        self.assertEqual(registry.get_node("vm1").metadata["state"], "running")
+        self.assertEqual(registry.get_node("vm2").metadata["state"], "stopped")
+        # hv2 replied without vm3
+        self.assertEqual(registry.get_node("vm3").parent, None)
+        self.assertEqual(registry.get_node("hv3").metadata["load"], 1)
+        self.assertNotIn("load", registry.get_node("hv4").metadata)
+
+    def test_broadcast_leaves_unreachable_nodes(self):
+        StatusDriver.up = ["hv1"]
+        Monitor(self.manager, {"poll_mode": "broadcast"}).poll_nodes()
+        # hv2 didn't reply, so vm3 is left assigned to it
+        self.assertEqual(self.manager.registry.get_node("vm3").parent, "hv2")
+
+    def test_reconcile(self):
+        StatusDriver.vms["hv2"]["vm4"] = "running"
+        monitor = Monitor(self.manager, {})
+        with self.manager.session() as session:
+            session.prefetch()
+            changes = monitor.reconcile(session.get_node("hv2"), StatusDriver(None, {})._status("hv2"), session)
+        self.assertEqual(sorted(changes), [
+            ("assign", "vm2", None),
+            ("metadata", "hv2", {"load": 1}),
+            ("state", "vm2", "stopped"),
+            ("unassign", "vm3", None),
+        ])
+
+    def test_unchanged_poll_makes_no_writes(self):
+        # reconcile every poll, without skipping on the fingerprint
+        monitor = Monitor(self.manager, {"reconcile_every": "1"})
+        self.assertEqual(monitor.poll_nodes().changes, 9)
+        registry = self.manager.registry
+        writes = []
+        for name in ("update_metadata", "set_parent", "set_node", "batch"):
+            setattr(registry, name, lambda *args, **kwargs: writes.append(args))
+        self.assertEqual(monitor.poll_nodes().changes, 0)
+        self.assertEqual(writes, [])
+
+    def test_create_missing(self):
+        StatusDriver.vms["hv2"]["vm4"] = "running"
+        Monitor(self.manager, {"create_missing": "true"}).poll_nodes()
+        vm4 = self.manager.registry.get_node("vm4")
+        self.assertEqual(vm4.parent, "hv2")
+        self.assertEqual(vm4.metadata["state"], "running")
+
+    def test_unchanged_status_is_skipped(self):
+        monitor = Monitor(self.manager, {"reconcile_every": "3"})
+        self.assertEqual(monitor.poll_nodes().unchanged, 0)
+        # someone else changes the registry; only a forced reconcile sees it
+        self.manager.registry.update_metadata("vm1", {"state": "stopped"})
+        report = monitor.poll_nodes()
+        self.assertEqual((report.unchanged, report.changes), (4, 0))
+        self.assertEqual(monitor.poll_nodes().unchanged, 4)
+        report = monitor.poll_nodes()
+        self.assertEqual((report.unchanged, report.changes), (0, 1))
+        self.assertEqual(self.manager.registry.get_node("vm1").metadata["state"], "running")
+
+    def test_changed_status_is_reconciled(self):
+        monitor = Monitor(self.manager, {})
+        monitor.poll_nodes()
+        StatusDriver.vms["hv1"]["vm1"] = "stopped"
+        report = monitor.poll_nodes()
+        self.assertEqual((report.unchanged, report.changes), (3, 1))
+        self.assertEqual(self.manager.registry.get_node("vm1").metadata["state"], "stopped")
+
+    def test_fingerprint_ignore(self):
+        monitor = Monitor(self.manager, {"fingerprint_ignore": "load"})
+        node = self.manager.get_node("hv1")
+        status = StatusDriver(None, {})._status("hv1")
+        fingerprint = monitor.fingerprint(node, status)
+        status[0]["load"] = 2
+        self.assertEqual(monitor.fingerprint(node, status), fingerprint)
+        status[1]["state"] = ("stopped", "stopped")
+        self.assertNotEqual(monitor.fingerprint(node, status), fingerprint)
+        self.assertNotEqual(Monitor(self.manager, {}).fingerprint(node, status), fingerprint)
+
+    def test_async_poll(self):
+        self.manager = make_manager(self.tmpdir, base_config=CONFIG.replace(
+            "test_manager:CountingDriver", "test_monitor:AsyncStatusDriver"))
+        registry = self.manager.registry
+        for hv in ("hv1", "hv2", "hv3"):
+            registry.add_node(hv, hv, "hv", None, definition={})
+        registry.add_node("vm1", "vm1", "vm", None, definition={}, metadata={"state": "defined"})
+        StatusDriver.delays = {"hv1": 0.3, "hv2": 0.3, "hv3": 5}
+        threads = threading.active_count()
+        report = Monitor(self.manager, {"poll_concurrency": "1", "poll_timeout": "1"}).poll_nodes()
+        # all at once, despite poll_concurrency, and without a thread each
+        self.assertTrue(report.wall_time < 1.5, report.wall_time)
+        self.assertEqual(report.timeouts, ["hv3"])
+        self.assertEqual(registry.get_node("vm1").metadata["state"], "running")
+        # only the timers standing in for the agents
+        self.assertTrue(threading.active_count() - threads <= 3)
+
+class testMonitorDaemon(MonitorTestCase):
+    def daemon(self):
+        config = {"interval": "60", "min_interval": "10", "max_interval": "200",
+            "busy_period": "100", "jitter": "0"}
+        return MonitorDaemon(Monitor(self.manager, {}), config)
+
+    def test_schedule(self):
+        StatusDriver.failing = set(["hv4"])
+        daemon = self.daemon()
+        report = daemon.run_once(now=1000)
+        self.assertEqual(sorted(report.polled), ["hv1", "hv2", "hv3"])
+        # changes were found, so the hosts are busy
+        self.assertAlmostEqual(daemon.hosts["hv1"].due, 1010, places=1)
+        # the failing host is backed off
+        self.assertAlmostEqual(daemon.hosts["hv4"].due, 1120, places=1)
+        self.assertEqual(daemon.run_once(now=1005), None)
+        report = daemon.run_once(now=1015)
+        self.assertEqual(sorted(report.polled), ["hv1", "hv2", "hv3"])
+        self.assertAlmostEqual(daemon.lag()["hv1"], 5, places=1)
+        # no changes, but still busy from the first poll
+        self.assertAlmostEqual(daemon.hosts["hv1"].due, 1025, places=1)
+        daemon.run_once(now=1125)
+        # idle now, and hv4 backed off further
+        self.assertAlmostEqual(daemon.hosts["hv1"].due, 1185, places=1)
+        self.assertAlmostEqual(daemon.hosts["hv4"].due, 1325, places=1)
+        StatusDriver.failing = set()
+        daemon.run_once(now=1326)
+        self.assertEqual(daemon.hosts["hv4"].failures, 0)
+
+    def test_poke_and_rescan(self):
+        daemon = self.daemon()
+        daemon.run_once(now=1000)
+        daemon.poke("hv2", now=1001)
+        self.assertEqual(daemon.run_once(now=1001).polled, ["hv2"])
+        self.manager.registry.add_node("hv5", "hv5", "hv", None, definition={})
+        daemon.rescan(now=1002)
+        self.assertEqual(daemon.run_once(now=1002).polled, ["hv5"])
+
+    def test_idle_pass_reads_only_due_hosts(self):
+        daemon = self.daemon()
+        daemon.run_once(now=1000)
+        registry = self.manager.registry
+        queries = []
+        get_nodes = registry.get_nodes
+        def counting_get_nodes(**kwargs):
+            queries.append(kwargs)
+            return get_nodes(**kwargs)
+        registry.get_nodes = counting_get_nodes
+        daemon.poke("hv2", now=1001)
+        self.assertEqual(daemon.run_once(now=1001).polled, ["hv2"])
+        self.assertEqual(queries, [{"parent": "hv2"}])
+
+    def test_watch_pokes_hosts_of_acted_on_vms(self):
+        daemon = self.daemon()
+        for now in (1000, 1015, 1125):
+            daemon.run_once(now=now)
+        self.assertEqual(daemon.run_once(now=1136), None)
+        # eg. "vagoth start vm1", from another process
+        self.manager.registry.update_metadata("vm1", {"state": "starting"})
+        report = daemon.run_once(now=1147)
+        self.assertEqual(report.polled, ["hv1"])
+        self.assertEqual(report.lag, {"hv1": 0})
+        self.assertTrue("worst lag: hv1 0.00s" in str(report))
+        # and it's polled often while busy
+        self.assertAlmostEqual(daemon.hosts["hv1"].due, 1157, places=1)
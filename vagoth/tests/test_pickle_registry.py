@@ -0,0 +1,149 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.registry.pickle_registry.PickleRegistry
+"""
+
+import unittest
+import tempfile
+import shutil
+import os.path
+from ..registry.pickle_registry import PickleRegistry
+from ..exceptions import RegistryException
+from registry_mixin import RegistryMixin
+
+class testPickleRegistry(unittest.TestCase, RegistryMixin):
+    journal = False
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.registry = self.make_registry()
+        self.mixin_setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_registry(self, **config):
+        config.setdefault("filename", os.path.join(self.tmpdir, "vagoth.pickledb"))
+        config.setdefault("lockfile", os.path.join(self.tmpdir, "vagoth.lock"))
+        config.setdefault("journal", self.journal)
+        return PickleRegistry(None, config)
+
+    def test_pickle_other_process_sees_changes(self):
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv", tenant=None)
+        self.registry.set_parent("0xdeadbeef", "othernode")
+        self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+        other = self.make_registry()
+        node = other.get_node_by_name("node001.example.com")
+        self.assertEqual(node.parent, "othernode")
+        self.assertEqual(node.metadata["state"], "running")
+        self.assertEqual(other.get_node_by_key("node001_uniquekey").id, "0xdeadbeef")
+        self.assertEqual([n.id for n in other.get_nodes_with_parent("othernode")], ["0xdeadbeef"])
+
+    def test_pickle_reuses_unchanged_file(self):
+        other = self.make_registry()
+        data = other.get_node("0xdeadbeef").node_dict
+        self.assertTrue(other.get_node("0xdeadbeef").node_dict is data)
+        self.assertTrue(other.get_node_by_name("node001.example.com").node_dict is data)
+        # our own writes don't force a reload either
+        other.update_metadata("0xdeadbeef", {"state": "running"})
+        self.assertTrue(other.get_node("0xdeadbeef").node_dict is data)
+        # but somebody else's do
+        self.registry.update_metadata("0xdeadbeef", {"state": "stopped"})
+        self.assertEqual(other.get_node("0xdeadbeef").metadata["state"], "stopped")
+
+class testPickleRegistryJournal(testPickleRegistry):
+    journal = True
+
+    def test_pickle_journal_appends(self):
+        filename = self.registry.config["filename"]
+        self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+        self.assertFalse(os.path.exists(filename))
+        self.assertTrue(os.path.exists(filename + ".journal"))
+        self.assertEqual(self.registry.journal_records, 2)
+
+    def test_pickle_journal_replays_new_records_only(self):
+        other = self.make_registry()
+        data = other.get_node("0xdeadbeef").node_dict
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv", tenant=None)
+        self.assertEqual(other.get_node("othernode").name, "othernode")
+        self.assertTrue(other.get_node("0xdeadbeef").node_dict is data)
+        self.assertEqual(other.journal_records, 2)
+        self.assertEqual([n.id for n in other.get_nodes(node_type="hv")].count("othernode"), 1)
+
+    def test_pickle_batch_saves_once(self):
+        self.assertEqual(self.registry.journal_records, 1)
+        with self.registry.batch():
+            self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+            self.registry.update_metadata("0xdeadbeef", {"one": "two"})
+            self.registry.set_blob("0xdeadbeef", "blob", "value")
+        self.assertEqual(self.registry.journal_records, 2)
+        node = self.make_registry().get_node("0xdeadbeef")
+        self.assertEqual(node.metadata["one"], "two")
+        self.assertEqual(node.get_blob("blob"), "value")
+
+    def test_pickle_journal_compacts(self):
+        registry = self.make_registry(journal_max_records="3")
+        filename = registry.config["filename"]
+        registry.update_metadata("0xdeadbeef", {"state": "running"})
+        self.assertFalse(os.path.exists(filename))
+        registry.update_metadata("0xdeadbeef", {"state": "stopped"})
+        self.assertTrue(os.path.exists(filename))
+        self.assertEqual(registry.journal_records, 0)
+        registry.delete_node("0xdeadbeef")
+        other = self.make_registry()
+        self.assertNotIn("0xdeadbeef", [node.id for node in other.get_nodes()])
+        self.assertEqual(other.list_nodes(), [])
+        self.assertEqual(other.unique, {})
+
+    def test_pickle_journal_replay_keeps_failing(self):
+        self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+        other = self.make_registry()
+        other._replay_journal = lambda: False
+        self.assertRaises(RegistryException, other.get_node, "0xdeadbeef")
+        self.assertFalse(other.cache_valid)
+        del other._replay_journal
+        self.assertEqual(other.get_node("0xdeadbeef").metadata["state"], "running")
+
+    def test_pickle_journal_torn_write(self):
+        self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+        with open(self.registry.config["filename"] + ".journal", "ab") as fd:
+            fd.write("\x80\x02(U\x0a0xdeadb")
+        other = self.make_registry()
+        self.assertEqual(other.get_node("0xdeadbeef").metadata["state"], "running")
+        other.update_metadata("0xdeadbeef", {"state": "stopped"})
+        self.assertEqual(self.make_registry().get_node("0xdeadbeef").metadata["state"], "stopped")
+
+    def test_pickle_compact(self):
+        self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+        self.registry.compact()
+        self.assertEqual(self.registry.journal_records, 0)
+        self.assertEqual(self.make_registry().get_node("0xdeadbeef").metadata["state"], "running")
+
+    def test_pickle_stale_journal_ignored(self):
+        # a journal left over from before the last compaction
+        journal = self.registry.config["filename"] + ".journal"
+        self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+        shutil.copy(journal, journal + ".old")
+        self.registry.compact()
+        self.registry.update_metadata("0xdeadbeef", {"state": "stopped"})
+        self.registry.compact()
+        shutil.copy(journal + ".old", journal)
+        self.assertEqual(self.make_registry().get_node("0xdeadbeef").metadata["state"], "stopped")
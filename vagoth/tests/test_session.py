@@ -0,0 +1,115 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.session.Session
+"""
+
+import unittest
+import shutil
+import tempfile
+from test_manager import make_manager
+
+class testSession(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manager = make_manager(self.tmpdir)
+        registry = self.registry = self.manager.registry
+        registry.add_node("hv1", "hv1", "hv", None, definition={})
+        registry.add_node("hv2", "hv2", "hv", None, definition={})
+        for vm in ("vm1", "vm2", "vm3"):
+            registry.add_node(vm, vm, "vm", "tenant1", definition={}, metadata={"state": "running"})
+        registry.set_parent("vm1", "hv1")
+        registry.set_parent("vm2", "hv1")
+        registry.set_parent("vm3", "hv2")
+        # count the reads which reach the registry
+        self.reads = []
+        for name in ("get_node", "get_nodes"):
+            self._count(name)
+
+    def _count(self, name):
+        method = getattr(self.registry, name)
+        def counted(*args, **kwargs):
+            self.reads.append(name)
+            return method(*args, **kwargs)
+        setattr(self.registry, name, counted)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_identity_map(self):
+        with self.manager.session() as session:
+            vm1 = session.get_node("vm1")
+            self.assertTrue(session.get_node("vm1") is vm1)
+            hv1 = vm1.parent
+            self.assertTrue(hv1 is session.get_node("hv1"))
+            self.assertTrue(session.get_node("vm2").parent is hv1)
+            self.assertEqual(self.reads, ["get_node", "get_node", "get_node"])
+
+    def test_prefetch(self):
+        with self.manager.session() as session:
+            session.prefetch()
+            hv1 = session.get_node("hv1")
+            self.assertEqual(sorted(vm.node_id for vm in hv1.children), ["vm1", "vm2"])
+            self.assertEqual([vm.node_id for vm in session.get_nodes(parent="hv2")], ["vm3"])
+            self.assertEqual([n.node_id for n in session.get_nodes(node_type="hv")], ["hv1", "hv2"])
+            self.assertTrue(session.get_node("vm1").parent is hv1)
+            self.assertEqual(self.reads, ["get_nodes"])
+
+    def test_writes_update_cached_docs(self):
+        with self.manager.session() as session:
+            session.prefetch()
+            vm1 = session.get_node("vm1")
+            vm1.state = "stopped"
+            self.assertEqual(vm1.state, "stopped")
+            session.registry.update_metadata("vm1", {"extra": 1}, ["state"])
+            self.assertEqual(vm1.metadata, {"extra": 1})
+            session.registry.set_parent("vm1", None)
+            session.registry.set_parent("vm1", "hv2")
+            self.assertTrue(vm1.parent is session.get_node("hv2"))
+            self.assertEqual([vm.node_id for vm in session.get_nodes(parent="hv2")], ["vm3", "vm1"])
+            self.assertEqual([vm.node_id for vm in session.get_nodes(parent="hv1")], ["vm2"])
+            self.assertEqual(self.reads, ["get_nodes"])
+        self.assertEqual(self.registry.get_node("vm1").metadata, {"extra": 1})
+        self.assertEqual(self.registry.get_node("vm1").parent, "hv2")
+
+    def test_add_and_delete(self):
+        with self.manager.session() as session:
+            session.prefetch()
+            session.registry.add_node("vm4", "vm4", "vm", "tenant1", definition={})
+            self.assertEqual([vm.node_id for vm in session.get_nodes(parent=None)], ["hv1", "hv2", "vm4"])
+            session.registry.delete_node("vm4")
+            self.assertEqual([vm.node_id for vm in session.get_nodes(node_type="vm")], ["vm1", "vm2", "vm3"])
+
+    def test_batch_rollback_clears_session(self):
+        with self.manager.session() as session:
+            vm1 = session.get_node("vm1")
+            try:
+                with session.registry.batch():
+                    session.registry.update_metadata("vm1", {"state": "broken"})
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertEqual(session.get_node("vm1").state, "running")
+            self.assertFalse(session.get_node("vm1") is vm1)
+
+    def test_passes_through_to_manager(self):
+        session = self.manager.session()
+        self.assertTrue(session.scheduler is self.manager.scheduler)
+        self.assertTrue(session.get_node("hv1").driver is self.manager.get_driver("default"))
@@ -0,0 +1,124 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Test vagoth.registry.sqlite_registry.SqliteRegistry
+"""
+
+import unittest
+import tempfile
+import shutil
+import os.path
+import sqlite3
+from ..registry.sqlite_registry import SqliteRegistry
+from .. import exceptions
+from registry_mixin import RegistryMixin
+
+class testSqliteRegistry(unittest.TestCase, RegistryMixin):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.registry = self.make_registry()
+        self.mixin_setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_registry(self):
+        return SqliteRegistry(None, {"filename": os.path.join(self.tmpdir, "vagoth.sqlite")})
+
+    # the mixin peeks at DictRegistry.nodes
+    def test_set_parent(self):
+        self.registry.add_node("othernode", node_name="othernode", node_type="hv", tenant=None)
+        self.registry.set_parent('0xdeadbeef', 'othernode')
+        self.assertEqual(self.registry.get_node('0xdeadbeef').parent, 'othernode')
+        self.assertRaises(exceptions.NodeAlreadyHasParentException,
+            self.registry.set_parent, '0xdeadbeef', 'othernode')
+
+    def test_sqlite_wal(self):
+        mode = self.registry._conn().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_sqlite_other_connection_sees_changes(self):
+        other = self.make_registry()
+        self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+        self.assertEqual(other.get_node("0xdeadbeef").metadata["state"], "running")
+
+    def test_sqlite_unique_constraints(self):
+        self.assertRaises(exceptions.UniqueConstraintViolation,
+            self.registry.add_node, "other", node_name="node001.example.com", node_type="vm", tenant=None)
+        self.assertRaises(exceptions.UniqueConstraintViolation,
+            self.registry.add_node, "other", node_name="other", node_type="vm", tenant=None,
+            unique_keys=["node001_uniquekey"])
+        self.assertRaises(exceptions.NodeAlreadyExistsException,
+            self.registry.add_node, "0xdeadbeef", node_name="other", node_type="vm", tenant=None)
+        self.assertEqual(self.registry.list_nodes(), ["0xdeadbeef"])
+        self.registry.delete_node("0xdeadbeef")
+        self.registry.add_node("other", node_name="node001.example.com", node_type="vm",
+            tenant=None, unique_keys=["node001_uniquekey"])
+
+    def test_sqlite_explain_uses_index(self):
+        plan = self.registry.explain(parent="othernode")
+        self.assertIn("nodes_parent", plan)
+
+    def test_sqlite_batch_undoes_failed_writes(self):
+        self.registry.add_node("0x2", "node002", "vm", None, unique_keys=["k2"])
+        with self.registry.batch():
+            self.registry.update_metadata("0xdeadbeef", {"state": "running"})
+            # the new name is free, but the key isn't
+            self.assertRaises(exceptions.UniqueConstraintViolation, self.registry.set_node,
+                "0xdeadbeef", node_name="node001b", unique_keys=["k2"])
+        node = self.registry.get_node("0xdeadbeef")
+        self.assertEqual(node.name, "node001.example.com")
+        self.assertEqual(node.metadata["state"], "running")
+        self.registry.add_node("0x3", "node001b", "vm", None)
+
+    def test_sqlite_failed_commit_is_rolled_back(self):
+        conn = self.registry._conn()
+        class BusyConnection(object):
+            """Fails the first COMMIT, as SQLITE_BUSY would"""
+            busy = True
+            def execute(self, sql, *args):
+                if sql == "COMMIT" and self.busy:
+                    self.busy = False
+                    raise sqlite3.OperationalError("database is locked")
+                return conn.execute(sql, *args)
+        self.registry.local.conn = BusyConnection()
+        self.assertRaises(sqlite3.OperationalError,
+            self.registry.update_metadata, "0xdeadbeef", {"state": "running"})
+        self.assertEqual(self.registry.local.depth, 0)
+        self.assertNotIn("state", self.registry.get_node("0xdeadbeef").metadata)
+        # the next transaction can begin
+        self.registry.update_metadata("0xdeadbeef", {"state": "stopped"})
+        self.assertEqual(self.registry.get_node("0xdeadbeef").metadata["state"], "stopped")
+
+    def test_sqlite_batch_yields_registry(self):
+        with self.registry.batch() as registry:
+            self.assertTrue(registry is self.registry)
+            registry.update_metadata("0xdeadbeef", {"state": "running"})
+        self.assertEqual(self.registry.get_node("0xdeadbeef").metadata["state"], "running")
+
+    def test_sqlite_tag_values_compare_as_in_python(self):
+        self.registry.add_node("other", node_name="other", node_type="vm", tenant=None,
+            tags={"flag": True, "count": 2.0, "nested": {"a": [True, 1.5]}})
+        for tags in ({"flag": 1}, {"flag": 1.0}, {"count": 2}, {"nested": {"a": [1, 1.5]}}):
+            self.assertEqual([n.id for n in self.registry.get_nodes(tags=tags)], ["other"])
+        self.assertEqual(list(self.registry.get_nodes(tags={"flag": "1"})), [])
+        self.assertEqual(list(self.registry.get_nodes(tags={"count": 2.5})), [])
+        # still stored as given
+        self.assertEqual(self.registry.get_node("other").tags["flag"], True)
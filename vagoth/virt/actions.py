@@ -26,6 +26,7 @@ with an instance of Vagoth's Manager as the first argument.
 from ..exceptions import ActionException
 from .. import get_manager
 from .. import transaction
+from .utils.futures import gather
 import logging
 
 Manager = get_manager()
@@ -155,6 +156,67 @@ def vm_deprovision(manager, vm_name):
         return
     node.driver.deprovision(node, vm)
 
+# the state a VM is set to while each vm_bulk action is in flight
+BULK_STATES = {
+    "start": "starting",
+    "stop": "stopping",
+    "shutdown": "shutting down",
+    "reboot": "rebooting",
+}
+
+def vm_bulk(manager, action, vm_names, timeout=None, **kwargs):
+    """
+    Start, stop, shutdown or reboot many VMs at once: call
+    driver.<action>_async(hypervisor, vm) on each VM's hypervisor's
+    async driver (see Manager.get_async_driver), so that the calls are
+    all in flight together, then wait for them (up to timeout seconds).
+
+    As with vm_start, unassigned VMs are defined first when starting.
+    A VM which can't be looked up or set up doesn't stop the others,
+    and a VM whose call fails is put back in the state it had before.
+    Raises ActionException naming the VMs which failed.
+    """
+    if action not in BULK_STATES:
+        raise ActionException("Unknown bulk action: %s" % (action,))
+    failed = []
+    calls = [] # (vm_name, vm, previous state, future)
+    for vm_name in vm_names:
+        log_vm_action(vm_name, action)
+        try:
+            vm = manager.get_node(vm_name)
+            node = vm.parent
+            if not node and action == "start":
+                manager.action("vm_define", vm_name=vm_name, **kwargs)
+                vm.refresh() # pick up state change
+                node = vm.parent
+                if not node:
+                    raise ActionException("VM not assigned")
+            if not node:
+                continue
+            previous = vm.state
+            vm.state = BULK_STATES[action]
+            try:
+                future = getattr(node.async_driver, action + "_async")(node, vm)
+            except:
+                vm.state = previous
+                raise
+        except Exception as e:
+            log_vm_action(vm_name, action, "failed: %s" % (e,))
+            failed.append(vm_name)
+            continue
+        calls.append((vm_name, vm, previous, future))
+    results = gather([call[3] for call in calls], timeout)
+    for (vm_name, vm, previous, future), result in zip(calls, results):
+        if isinstance(result, Exception):
+            log_vm_action(vm_name, action, "failed: %s" % (result,))
+            failed.append(vm_name)
+            try:
+                vm.state = previous
+            except Exception:
+                logging.exception("Could not restore the state of %s" % (vm_name,))
+    if failed:
+        raise ActionException("%s failed for %s" % (action, ", ".join(failed)))
+
 def vm_poll(manager, **kwargs):
     """
     instantiate the monitor and poll all nodes
@@ -29,6 +29,9 @@ class DummyDriver(object):
     def __init__(self, manager, local_config):
         self.config = local_config
 
+    def cleanup(self):
+        pass
+
     def provision(self, node, vm):
         """Request a node to define & provision a VM"""
         raise DriverException(ERRMSG)
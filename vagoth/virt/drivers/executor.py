@@ -0,0 +1,80 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+from ...interfaces.driver import IAsyncDriver
+from ..utils.futures import Executor, expire
+import zope.interface as ZI
+
+@ZI.implementer(IAsyncDriver)
+class ExecutorDriver(object):
+    """
+    Provide IAsyncDriver for a blocking IDriver, by running its calls on
+    a pool of up to workers threads.
+
+    A call which is still queued or running after timeout seconds (if
+    given) fails with DriverTimeoutException.  A running call can't be
+    stopped, so it keeps its thread until the driver returns, and
+    cleanup() waits at most grace seconds for it.
+    """
+    def __init__(self, driver, workers=10, timeout=None, grace=5):
+        self.driver = driver
+        self.timeout = timeout
+        self.grace = grace
+        self.executor = Executor(workers)
+
+    def cleanup(self):
+        """Stop the threads; the wrapped driver is cleaned up by the Manager"""
+        self.executor.shutdown(self.grace)
+
+    def _submit(self, method, *args):
+        future = self.executor.submit(getattr(self.driver, method), *args)
+        return expire(future, self.timeout, "%s took longer than %ss" % (method, self.timeout))
+
+    def provision_async(self, node, vm):
+        return self._submit("provision", node, vm)
+
+    def define_async(self, node, vm):
+        return self._submit("define", node, vm)
+
+    def undefine_async(self, node, vm):
+        return self._submit("undefine", node, vm)
+
+    def deprovision_async(self, node, vm):
+        return self._submit("deprovision", node, vm)
+
+    def start_async(self, node, vm):
+        return self._submit("start", node, vm)
+
+    def reboot_async(self, node, vm):
+        return self._submit("reboot", node, vm)
+
+    def stop_async(self, node, vm):
+        return self._submit("stop", node, vm)
+
+    def shutdown_async(self, node, vm):
+        return self._submit("shutdown", node, vm)
+
+    def info_async(self, node, vm):
+        return self._submit("info", node, vm)
+
+    def status_async(self, node=None):
+        return self._submit("status", node)
+
+    def migrate_async(self, node, vm, destination_node):
+        return self._submit("migrate", node, vm, destination_node)
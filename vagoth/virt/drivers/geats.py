@@ -17,24 +17,54 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 #
 
-from ..utils.mc_json_rpc import mcollective_call
+from ...interfaces.driver import IAsyncDriver
+from ..utils.mc_json_rpc import mcollective_call, mcollective_call_many, MCollectiveHelper
+from ..utils.futures import chain, resolved
 from ..exceptions import DriverException
+import zope.interface as ZI
 
 class GeatsMcollective(object):
     """
     Driver to talk to Geats using mcollective.  It uses the
     mcollective_call() function from utils.mc_json_rpc to
     launch ruby to make the call.
+
+    With persistent_helper = true in its config, it instead keeps ruby
+    helpers running (an MCollectiveHelper) for all its calls, until
+    cleanup().  It then also provides IAsyncDriver, as the helpers can
+    have many calls in flight without a thread waiting on each.
+
+    Each helper runs one call at a time, so helper_processes (4) is how
+    many calls run in parallel, whether from concurrent polls, async
+    calls, or the *_many batches.
     """
+    # status() with no node asks every hypervisor at once
+    broadcast_status = True
+
     def __init__(self, manager, local_config):
         self.config = local_config
+        self.helper_processes = int(local_config.get('helper_processes', 4))
+        if local_config.get('persistent_helper', False) in ('true','yes',True):
+            self.helper = MCollectiveHelper(processes=self.helper_processes)
+            ZI.alsoProvides(self, IAsyncDriver)
+        else:
+            self.helper = None
+
+    def cleanup(self):
+        if self.helper:
+            self.helper.close()
+
+    def _mcollective_call(self, agent, action, **kwargs):
+        if self.helper:
+            return self.helper.call(agent, action, **kwargs)
+        return mcollective_call(agent, action, **kwargs)
 
     def _call(self, action, node=None, timeout=60, **kwargs):
         if node:
             node_name = node.node_id
-            return mcollective_call("geats", action, timeout=timeout, identity=node_name, **kwargs)
+            return self._mcollective_call("geats", action, timeout=timeout, identity=node_name, **kwargs)
         else:
-            return mcollective_call("geats", action, timeout=timeout, **kwargs)
+            return self._mcollective_call("geats", action, timeout=timeout, **kwargs)
 
     def _call_single(self, action, node, vm, timeout=60, **kwargs):
         if node is None:
@@ -43,14 +73,64 @@ class GeatsMcollective(object):
             raise TypeError, "vm argument is required"
         node_name = node.node_id
         vm_name = vm.node_id
-        responses = mcollective_call("geats", action, timeout=timeout, identity=node_name, vm_name=vm_name, **kwargs)
+        responses = self._mcollective_call("geats", action, timeout=timeout, identity=node_name, vm_name=vm_name, **kwargs)
+        return self._single_response(responses)
+
+    def _call_single_async(self, action, node, vm, timeout=60, **kwargs):
+        if node is None:
+            raise TypeError, "node argument is required"
+        if vm is None:
+            raise TypeError, "vm argument is required"
+        future = self.helper.call_async("geats", action, timeout=timeout, identity=node.node_id, vm_name=vm.node_id, **kwargs)
+        return chain(future, self._single_response)
+
+    def _single_response(self, responses):
         # should only be one response
         for res in responses:
             return res["statuscode"], res["statusmsg"], res["data"]
         return None, None, None
 
+    def _call_many(self, action, node_vms, timeout=60, **kwargs):
+        """
+        Make the call for each (node, vm) in node_vms in one go, and return
+        a list of (statuscode, statusmsg, data) or DriverException, in order.
+        """
+        requests = []
+        for node, vm in node_vms:
+            requests.append(("geats", action, node.node_id, dict(kwargs, vm_name=vm.node_id)))
+        if self.helper:
+            results = self.helper.call_many(requests, timeout=timeout)
+        else:
+            results = mcollective_call_many(requests, timeout=timeout, processes=self.helper_processes)
+        for i, result in enumerate(results):
+            if isinstance(result, DriverException):
+                pass # eg. an MCollectiveTimeout
+            elif isinstance(result, Exception):
+                results[i] = DriverException(str(result))
+            else:
+                results[i] = self._single_response(result)
+        return results
+
+    def _call_boolean_many(self, action, node_vms, timeout=60, **kwargs):
+        """Like _call_boolean for each (node, vm), returning True or a DriverException for each"""
+        results = []
+        for (node, vm), result in zip(node_vms, self._call_many(action, node_vms, timeout, **kwargs)):
+            if not isinstance(result, DriverException):
+                try:
+                    result = self._boolean_result(node, *result)
+                except DriverException as e:
+                    result = e
+            results.append(result)
+        return results
+
     def _call_single_exc(self, action, node, vm, timeout=60, **kwargs):
-        status, statusmsg, data = self._call_single(action, node, vm, timeout, **kwargs)
+        return self._exc_result(node, *self._call_single(action, node, vm, timeout, **kwargs))
+
+    def _call_single_exc_async(self, action, node, vm, timeout=60, **kwargs):
+        return chain(self._call_single_async(action, node, vm, timeout, **kwargs),
+            lambda result: self._exc_result(node, *result))
+
+    def _exc_result(self, node, status, statusmsg, data):
         if status is None:
             raise DriverException("No response received from %s" % (node,))
         if status != 0:
@@ -58,7 +138,13 @@ class GeatsMcollective(object):
         return data
 
     def _call_boolean(self, action, node, vm, timeout=60, **kwargs):
-        status, statusmsg, data = self._call_single(action, node, vm, timeout, **kwargs)
+        return self._boolean_result(node, *self._call_single(action, node, vm, timeout, **kwargs))
+
+    def _call_boolean_async(self, action, node, vm, timeout=60, **kwargs):
+        return chain(self._call_single_async(action, node, vm, timeout, **kwargs),
+            lambda result: self._boolean_result(node, *result))
+
+    def _boolean_result(self, node, status, statusmsg, data):
         if data:
             return True
         if status == 0:
@@ -100,16 +186,40 @@ class GeatsMcollective(object):
         """Request node to shutdown (nicely) the VM"""
         return self._call_boolean("shutdown", node, vm, timeout=10)
 
+    def start_many(self, node_vms):
+        """
+        Request each node to start its VM, for a list of (node, vm), in one
+        run of the mcollective helpers.  Returns a list of True or
+        DriverException.
+        """
+        return self._call_boolean_many("start", node_vms, timeout=10)
+
+    def stop_many(self, node_vms):
+        """Like start_many, to stop (forcefully) each VM"""
+        return self._call_boolean_many("stop", node_vms, timeout=10)
+
+    def shutdown_many(self, node_vms):
+        """Like start_many, to shutdown (nicely) each VM"""
+        return self._call_boolean_many("shutdown", node_vms, timeout=10)
+
+    def reboot_many(self, node_vms):
+        """Like start_many, to reboot each VM"""
+        return self._call_boolean_many("reboot", node_vms, timeout=10)
+
     def info(self, node, vm):
         """Request information about the given VM from the node"""
-        info = self._call_single_exc("info", node, vm, timeout=5)
+        return self._info_result(node, self._call_single_exc("info", node, vm, timeout=5))
+
+    def _info_result(self, node, info):
         if info:
             info[u"node"] = unicode(node.node_id)
         return info
 
     def status(self, node=None):
         """Request information about all VMs from the node"""
-        res = self._call("status", node, timeout=5)
+        return self._status_result(node, self._call("status", node, timeout=5))
+
+    def _status_result(self, node, res):
         if len(res) == 0:
             raise DriverException("No results received for %s" % (node))
         nodes = []
@@ -131,3 +241,41 @@ class GeatsMcollective(object):
     def migrate(self, node, vm, destination_node):
         """Request the node to migrate the given VM to the destination node"""
         return NotImplemented
+
+    # IAsyncDriver, with persistent_helper
+
+    def provision_async(self, node, vm):
+        return self._call_single_exc_async("provision", node, vm, definition=vm.definition)
+
+    def define_async(self, node, vm):
+        return self._call_single_exc_async("define", node, vm, definition=vm.definition)
+
+    def undefine_async(self, node, vm):
+        return self._call_boolean_async("undefine", node, vm)
+
+    def deprovision_async(self, node, vm):
+        return self._call_boolean_async("deprovision", node, vm)
+
+    def start_async(self, node, vm):
+        return self._call_boolean_async("start", node, vm, timeout=10)
+
+    def reboot_async(self, node, vm):
+        return self._call_boolean_async("reboot", node, vm, timeout=10)
+
+    def stop_async(self, node, vm):
+        return self._call_boolean_async("stop", node, vm, timeout=10)
+
+    def shutdown_async(self, node, vm):
+        return self._call_boolean_async("shutdown", node, vm, timeout=10)
+
+    def info_async(self, node, vm):
+        return chain(self._call_single_exc_async("info", node, vm, timeout=5),
+            lambda info: self._info_result(node, info))
+
+    def status_async(self, node=None):
+        identity = node.node_id if node else None
+        future = self.helper.call_async("geats", "status", timeout=5, identity=identity)
+        return chain(future, lambda res: self._status_result(node, res))
+
+    def migrate_async(self, node, vm, destination_node):
+        return resolved(NotImplemented)
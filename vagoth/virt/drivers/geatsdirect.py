@@ -0,0 +1,424 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+A Geats driver which talks straight to an agent on each hypervisor,
+over TCP or a Unix socket, without mcollective or a subprocess.
+
+Each message is a 4-byte big-endian length followed by that many bytes
+of JSON.  Requests are {"id", "action", "data"}, and replies are a
+geats_jsonagent reply plus the request's id.  Requests are pipelined:
+many can be in flight on one connection, and the agent may reply in
+any order.  So GeatsDirect also provides IAsyncDriver: an asynchronous
+call is only a Future, completed by the connection's reader thread.
+"""
+
+from ...interfaces.driver import IAsyncDriver
+from ..exceptions import DriverException, DriverTimeoutException
+from ..utils.agent_pool import agent_result
+from ..utils.futures import Future, call_at, chain, resolved
+from .geatslocal import status_nodes
+from threading import Thread, Lock, Condition
+import zope.interface as ZI
+import logging
+import socket
+import struct
+import json
+import time
+
+MAX_FRAME = 64 * 1024 * 1024
+
+def parse_address(address):
+    """
+    Return (family, sockaddr) for "unix:/path" or "host:port"
+    """
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[5:]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host.strip("[]"), int(port))
+
+def send_frame(sock, obj):
+    data = json.dumps(obj)
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        try:
+            chunk = sock.recv(size)
+        except socket.timeout:
+            # the socket's timeout is for sends; an idle read just waits
+            continue
+        if not chunk:
+            raise EOFError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+def recv_frame(sock):
+    """Return the next decoded message from sock, or raise EOFError"""
+    size, = struct.unpack(">I", _recv_exactly(sock, 4))
+    if size > MAX_FRAME:
+        raise ValueError("message of %d bytes is too large" % (size,))
+    return json.loads(_recv_exactly(sock, size))
+
+class AgentConnection(object):
+    """
+    One connection to an agent.  send() is thread-safe, and a reader
+    thread hands each reply to the request with its id.  When the
+    connection fails, every request waiting on it fails too.
+
+    Requests are written under send_lock, not lock, so a send which is
+    waiting for the agent to read never keeps the reader from handing
+    off replies.  A send which takes longer than send_timeout fails the
+    connection.
+    """
+    def __init__(self, address, connect_timeout=5, send_timeout=30):
+        self.address = address
+        family, sockaddr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(connect_timeout)
+        try:
+            self.sock.connect(sockaddr)
+        except:
+            self.sock.close()
+            raise
+        self.sock.settimeout(send_timeout)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = Lock()
+        self.send_lock = Lock()
+        self.closed = False
+        self._next_id = 0
+        # request id -> Future
+        self._pending = {}
+        self.reader = Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def _read(self):
+        try:
+            while True:
+                reply = recv_frame(self.sock)
+                with self.lock:
+                    future = self._pending.pop(reply.get("id", None), None)
+                if future is not None:
+                    future.set_result(reply)
+        except (EOFError, ValueError, socket.error) as e:
+            self._fail(e)
+
+    def _fail(self, reason):
+        with self.lock:
+            if not self.closed:
+                logging.info("Lost connection to geats agent at %s: %s" % (self.address, reason))
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(DriverException("Connection to %s failed: %s" % (self.address, reason)))
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def send(self, action, data, timeout=None):
+        """
+        Send a request, and return a Future for its reply, which fails
+        with DriverTimeoutException after timeout seconds
+        """
+        with self.lock:
+            if self.closed:
+                raise DriverException("Connection to %s is closed" % (self.address,))
+            self._next_id += 1
+            request_id = self._next_id
+            future = self._pending[request_id] = Future()
+        try:
+            with self.send_lock:
+                send_frame(self.sock, {"id": request_id, "action": action, "data": data})
+        except socket.error as e:
+            with self.lock:
+                self._pending.pop(request_id, None)
+            # a partly written frame leaves the connection unusable
+            self._fail(e)
+            raise DriverException("Could not send to %s: %s" % (self.address, e))
+        if timeout is not None:
+            call_at(time.time() + timeout, lambda: self._expire(request_id, timeout))
+        return future
+
+    def _expire(self, request_id, timeout):
+        with self.lock:
+            future = self._pending.pop(request_id, None)
+        if future is not None:
+            future.set_exception(DriverTimeoutException("No reply from %s within %ss" % (self.address, timeout)))
+
+    def close(self):
+        self._fail("closed")
+        self.reader.join(1)
+        self.sock.close()
+
+class HostPool(object):
+    """
+    Keep-alive connections to one hypervisor's agent.
+
+    Each request goes on the connection with the fewest in flight, and
+    another connection is opened, up to size, when they're all busy.
+    After a failed connect, it waits backoff seconds before trying
+    again, doubling on each failure up to max_backoff; meanwhile calls
+    fail straight away, unless a connection is still open.
+
+    Connecting happens outside the lock, in a slot reserved under it,
+    so a slow connect doesn't hold up calls which can use an open
+    connection.
+    """
+    def __init__(self, address, size=2, connect_timeout=5, backoff=0.5, max_backoff=30, send_timeout=30):
+        try:
+            parse_address(address)
+        except ValueError:
+            raise DriverException("Bad geats agent address: %r" % (address,))
+        self.address = address
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = Lock()
+        # notified when a connect finishes
+        self.connected = Condition(self.lock)
+        self.connections = []
+        self.connecting = 0
+        self.closed = False
+        self.failures = 0
+        self.retry_at = 0
+        self.connects = 0
+
+    def get(self):
+        """Return a connection to send a request on"""
+        with self.lock:
+            while True:
+                self.connections = [conn for conn in self.connections if not conn.closed]
+                best = min(self.connections, key=lambda conn: conn.in_flight) if self.connections else None
+                if best is not None and (best.in_flight == 0
+                        or len(self.connections) + self.connecting >= self.size):
+                    return best
+                now = time.time()
+                if now < self.retry_at:
+                    if best is not None:
+                        return best
+                    raise DriverException("Not connecting to %s for another %.1fs" % (self.address, self.retry_at - now))
+                if len(self.connections) + self.connecting < self.size:
+                    break
+                # no connection is open, and every slot is being connected
+                self.connected.wait()
+            self.connecting += 1
+        try:
+            conn = AgentConnection(self.address, self.connect_timeout, self.send_timeout)
+        except socket.error as e:
+            with self.lock:
+                self.connecting -= 1
+                self.failures += 1
+                self.retry_at = now + min(self.max_backoff, self.backoff * 2 ** min(self.failures - 1, 16))
+                self.connected.notify_all()
+            if best is not None:
+                return best
+            raise DriverException("Could not connect to %s: %s" % (self.address, e))
+        except:
+            # free the slot for the next caller
+            with self.lock:
+                self.connecting -= 1
+                self.connected.notify_all()
+            raise
+        with self.lock:
+            self.connecting -= 1
+            self.failures = 0
+            self.retry_at = 0
+            self.connects += 1
+            if not self.closed:
+                self.connections.append(conn)
+            self.connected.notify_all()
+        if self.closed:
+            conn.close()
+        return conn
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+
+@ZI.implementer(IAsyncDriver)
+class GeatsDirect(object):
+    """
+    Driver to talk to Geats agents directly over sockets.
+
+    Its config options are:
+
+    * address: where to find a hypervisor's agent, with {node} replaced
+      by its node_id; "host:port" or "unix:/path" ({node}:7000).  A
+      hypervisor's definition can give its own as geats_address.
+    * connections: the most connections to keep open to each agent (2)
+    * connect_timeout: seconds to wait to connect (5)
+    * send_timeout: seconds to wait for an agent to take a request,
+      before giving up on its connection (30)
+    * backoff, max_backoff: seconds to wait before reconnecting after a
+      failed connect, doubling up to max_backoff (0.5, 30)
+    """
+    def __init__(self, manager, local_config):
+        self.config = local_config
+        self.address = local_config.get('address', '{node}:7000')
+        self.connections = int(local_config.get('connections', 2))
+        self.connect_timeout = float(local_config.get('connect_timeout', 5))
+        self.send_timeout = float(local_config.get('send_timeout', 30))
+        self.backoff = float(local_config.get('backoff', 0.5))
+        self.max_backoff = float(local_config.get('max_backoff', 30))
+        self.lock = Lock()
+        self.pools = {}
+
+    def cleanup(self):
+        with self.lock:
+            pools, self.pools = self.pools.values(), {}
+        for pool in pools:
+            pool.close()
+
+    def _address(self, node):
+        definition = getattr(node, "definition", None) or {}
+        return definition.get("geats_address", None) or self.address.format(node=node.node_id)
+
+    def _pool(self, node):
+        address = self._address(node)
+        with self.lock:
+            pool = self.pools.get(address, None)
+            if pool is None:
+                pool = self.pools[address] = HostPool(address, self.connections,
+                    self.connect_timeout, self.backoff, self.max_backoff, self.send_timeout)
+            return pool
+
+    def _call_async(self, action, node=None, timeout=60, **kwargs):
+        """Start a call, and return a Future for its data"""
+        if node is None:
+            return resolved(exception=DriverException("GeatsDirect needs a node to call %s on" % (action,)))
+        try:
+            future = self._pool(node).get().send(action, kwargs, timeout)
+        except DriverException as e:
+            return resolved(exception=e)
+        return chain(future, agent_result)
+
+    def _call(self, action, node=None, timeout=60, **kwargs):
+        return self._call_async(action, node, timeout, **kwargs).result()
+
+    def _call_single_async(self, action, node, vm, timeout=60, **kwargs):
+        if node is None:
+            raise TypeError, "node argument is required"
+        if vm is None:
+            raise TypeError, "vm argument is required"
+        return self._call_async(action, node, timeout, vm_name=vm.node_id, **kwargs)
+
+    def _call_single(self, action, node, vm, timeout=60, **kwargs):
+        return self._call_single_async(action, node, vm, timeout, **kwargs).result()
+
+    def _call_boolean_async(self, action, node, vm, timeout=60, **kwargs):
+        return chain(self._call_single_async(action, node, vm, timeout, **kwargs), lambda data: True)
+
+    def _call_boolean(self, action, node, vm, timeout=60, **kwargs):
+        return self._call_boolean_async(action, node, vm, timeout, **kwargs).result()
+
+    def provision_async(self, node, vm):
+        return self._call_single_async("provision", node, vm, definition=vm.definition)
+
+    def provision(self, node, vm):
+        """Request a node to define & provision a VM"""
+        return self.provision_async(node, vm).result()
+
+    def define_async(self, node, vm):
+        return self._call_single_async("define", node, vm, definition=vm.definition)
+
+    def define(self, node, vm):
+        """Request node to define a VM"""
+        return self.define_async(node, vm).result()
+
+    def undefine_async(self, node, vm):
+        return self._call_boolean_async("undefine", node, vm)
+
+    def undefine(self, node, vm):
+        """Request node to undefine a VM"""
+        return self.undefine_async(node, vm).result()
+
+    def deprovision_async(self, node, vm):
+        return self._call_boolean_async("deprovision", node, vm)
+
+    def deprovision(self, node, vm):
+        """Request node to undefine & deprovision a VM"""
+        return self.deprovision_async(node, vm).result()
+
+    def start_async(self, node, vm):
+        return self._call_boolean_async("start", node, vm, timeout=10)
+
+    def start(self, node, vm):
+        """Request node to start the VM"""
+        return self.start_async(node, vm).result()
+
+    def reboot_async(self, node, vm):
+        return self._call_boolean_async("reboot", node, vm, timeout=10)
+
+    def reboot(self, node, vm):
+        """Request node to reboot the VM"""
+        return self.reboot_async(node, vm).result()
+
+    def stop_async(self, node, vm):
+        return self._call_boolean_async("stop", node, vm, timeout=10)
+
+    def stop(self, node, vm):
+        """Request node to stop (forcefully) the VM"""
+        return self.stop_async(node, vm).result()
+
+    def shutdown_async(self, node, vm):
+        return self._call_boolean_async("shutdown", node, vm, timeout=10)
+
+    def shutdown(self, node, vm):
+        """Request node to shutdown (nicely) the VM"""
+        return self.shutdown_async(node, vm).result()
+
+    def info_async(self, node, vm):
+        def add_node(info):
+            if info:
+                info[u"node"] = unicode(node.node_id)
+            return info
+        return chain(self._call_single_async("info", node, vm, timeout=5), add_node)
+
+    def info(self, node, vm):
+        """Request information about the given VM from the node"""
+        return self.info_async(node, vm).result()
+
+    def status_async(self, node=None):
+        future = self._call_async("status", node, timeout=5)
+        return chain(future, lambda res: status_nodes(node.node_id, res))
+
+    def status(self, node=None):
+        """Request information about all VMs from the node"""
+        return self.status_async(node).result()
+
+    def migrate_async(self, node, vm, destination_node):
+        return resolved(NotImplemented)
+
+    def migrate(self, node, vm, destination_node):
+        """Request the node to migrate the given VM to the destination node"""
+        return NotImplemented
@@ -17,47 +17,117 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 #
 
-from ..exceptions import DriverException
+from ..exceptions import DriverException, DriverTimeoutException
+from ..utils.agent_pool import AgentPool, Latencies, agent_result
+from threading import Timer
 import subprocess
 import json
+import time
 import os
 
-def local_call(action, **kwargs):
-    p = subprocess.Popen(["geats_jsonagent"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    request = json.dumps({"action": action, "data": kwargs})
-    p.stdin.write(request)
-    p.stdin.close()
-    result = p.stdout.read()
-    exit_code = p.wait()
+def local_call(action, timeout=None, command=None, **kwargs):
+    """
+    Run geats_jsonagent (or command) for one call, and return its data.
+    If timeout seconds pass first, it's killed and DriverTimeoutException
+    is raised.
+    """
+    p = subprocess.Popen(command or ["geats_jsonagent"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    timer, expired = None, []
+    def expire():
+        expired.append(True)
+        p.kill()
+    if timeout is not None:
+        timer = Timer(timeout, expire)
+        timer.start()
+    write_error = None
+    try:
+        request = json.dumps({"action": action, "data": kwargs})
+        try:
+            p.stdin.write(request)
+            p.stdin.close()
+        except IOError as e:
+            # eg. EPIPE, if it exited (or was killed by expire) first
+            write_error = e
+        result = p.stdout.read()
+        exit_code = p.wait()
+    finally:
+        if timer:
+            timer.cancel()
+    if expired:
+        raise DriverTimeoutException("geats_jsonagent %s took longer than %ss" % (action, timeout))
+    if write_error is not None:
+        raise DriverException("Could not write to geats_jsonagent: %s" % (write_error,))
     if exit_code == 0:
-        jresult = json.loads(result)
-        assert type(jresult) == dict
-        if jresult.get("success", False):
-            return jresult.get("data", None)
-        else:
-            errorcode = jresult.get("errorcode", "undefined")
-            message = jresult.get("message", "check logs")
-            exceptionmsg = "%s: %s" % (errorcode, message)
-            raise DriverException(exceptionmsg)
+        return agent_result(json.loads(result))
     else:
         raise DriverException("geats_jsonagent exited with %d" % (exit_code,))
 
-
-
+def status_nodes(node_name, res):
+    """
+    Turn the data of a geats_jsonagent status reply from node_name into
+    the list of VM and hypervisor dicts returned by IDriver.status()
+    """
+    nodes = []
+    for vm in res["vms"].values():
+        vm[u"_parent"] = node_name
+        vm[u"_name"] = vm["definition"]["name"]
+        vm[u"_type"] = "vm"
+        nodes.append(vm)
+    # add hypervisor server
+    hv = res.get("status", {})
+    hv[u"_parent"] = None
+    hv[u"_name"] = node_name
+    hv[u"_type"] = "hv"
+    nodes.append(hv)
+    return nodes
 
 class GeatsLocal(object):
     """
     Driver to talk to a local Geats install.
+
+    By default each call runs geats_jsonagent afresh.  With pool_size
+    set in its config, it instead keeps up to that many agents running
+    with --serve (an AgentPool), until cleanup().  agent_command
+    replaces geats_jsonagent.
     """
     def __init__(self, manager, local_config):
         self.config = local_config
+        command = local_config.get('agent_command', None)
+        if isinstance(command, basestring):
+            command = command.split()
+        self.command = command or ["geats_jsonagent"]
+        pool_size = int(local_config.get('pool_size', 0))
+        if pool_size > 0:
+            self.pool = AgentPool(self.command, pool_size)
+            self.latencies = self.pool.latencies
+        else:
+            self.pool = None
+            self.latencies = Latencies()
+
+    def cleanup(self):
+        if self.pool:
+            self.pool.close()
+
+    def latency_percentiles(self, action=None, points=(50, 90, 99)):
+        """
+        Return a dict of percentile to seconds, over recent successful
+        calls of action, or of all calls
+        """
+        return self.latencies.percentiles(action, points)
+
+    def _local_call(self, action, timeout=60, **kwargs):
+        if self.pool:
+            return self.pool.call(action, timeout, **kwargs)
+        start = time.time()
+        result = local_call(action, timeout, self.command, **kwargs)
+        self.latencies.add(action, time.time() - start)
+        return result
 
     def _call(self, action, node=None, timeout=60, **kwargs):
-        return local_call(action, **kwargs)
+        return self._local_call(action, timeout, **kwargs)
 
     def _call_single(self, action, node, vm, timeout=60, **kwargs):
-        vm_name = vm.node_id
-        return local_call(action, vm_name=vm.node_id, **kwargs)
+        return self._local_call(action, timeout, vm_name=vm.node_id, **kwargs)
     _call_single_exc = _call_single
 
     def _call_boolean(self, action, node, vm, timeout=60, **kwargs):
@@ -108,25 +178,13 @@ class GeatsLocal(object):
         res = self._call("status", node, timeout=5)
         if len(res) == 0:
             raise DriverException("No results received for %s" % (node))
-        nodes = []
         node_name = os.uname()[1]
         if node is None:
             pass # just us, then
         elif node.node_id != node_name:
             # we only return information about the current node..
             raise DriverException("Cannot contact remote node '%s' using GeatsLocal driver" % (node.node_id,))
-        for vm in res["vms"].values():
-                vm[u"_parent"] = node_name
-                vm[u"_name"] = vm["definition"]["name"]
-                vm[u"_type"] = "vm"
-                nodes.append(vm)
-        # add hypervisor server
-        hv = res.get("status", {})
-        hv[u"_parent"] = None
-        hv[u"_name"] = node_name
-        hv[u"_type"] = "hv"
-        nodes.append(hv)
-        return nodes
+        return status_nodes(node_name, res)
 
     def migrate(self, node, vm, destination_node):
         """Request the node to migrate the given VM to the destination node"""
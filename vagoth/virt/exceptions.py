@@ -19,3 +19,6 @@
 
 class DriverException(RuntimeError):
     """Exception while calling a driver"""
+
+class DriverTimeoutException(DriverException):
+    """A driver call didn't finish before its deadline"""
@@ -25,6 +25,7 @@ class Hypervisor(Node):
 
     It inherits vagoth.Node_
     """
+    __slots__ = ()
 
     # FIXME, duplicated in VirtualMachine (but not really a Node thing)
     @property
@@ -35,8 +36,7 @@ class Hypervisor(Node):
     @state.setter
     def state(self, state):
         """Set the state attribute in the metadata"""
-        self._doc.registry.update_metadata(self.node_id, { "state": state, })
-        self.refresh()
+        self.refresh(self._manager.registry.update_metadata(self.node_id, { "state": state, }))
 
     @property
     def children(self):
@@ -52,8 +52,13 @@ class Hypervisor(Node):
 
     @property
     def driver(self):
-        """Return the driver for this hypervisor"""
-        return self._manager.config.make_factory("virt/drivers/%s" % (self.driver_name,), self._manager)
+        """Return the (shared) driver for this hypervisor"""
+        return self._manager.get_driver(self.driver_name)
+
+    @property
+    def async_driver(self):
+        """Return the (shared) IAsyncDriver for this hypervisor"""
+        return self._manager.get_async_driver(self.driver_name)
 
     def __str__(self):
         return self.name
@@ -18,12 +18,80 @@
 #
 
 import vagoth.exceptions
-from exceptions import DriverException
+from vagoth.interfaces.driver import IAsyncDriver
+from exceptions import DriverTimeoutException
+from threading import Thread
+from Queue import Queue, Empty
+from collections import deque
+import hashlib
 import logging
+import json
+import time
+
+class PollReport(object):
+    """
+    Timings from one Monitor.poll_nodes() run: the wall time, how long
+    each hypervisor's driver.status() took, and which ones timed out or
+    failed.
+    """
+    def __init__(self):
+        self.wall_time = 0.0
+        self.timings = {}
+        self.timeouts = []
+        self.errors = []
+        self.unreachable = []
+        self.changes = 0
+        self.unchanged = 0
+        # node_ids whose status was received, and which needed changes
+        self.polled = []
+        self.changed = []
+        # node_id -> how late its poll started, when run by MonitorDaemon
+        self.lag = {}
+
+    def slowest(self, count=5):
+        """Return the count slowest (node_id, seconds), slowest first"""
+        return sorted(self.timings.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    def worst_lag(self):
+        """Return the (node_id, seconds) whose poll started latest, or None"""
+        if not self.lag:
+            return None
+        return max(self.lag.items(), key=lambda item: item[1])
+
+    def __str__(self):
+        text = "Polled %d times in %.2fs (%d changes, %d unchanged, %d timed out, %d failed, %d unreachable); slowest: %s" % (
+            len(self.timings), self.wall_time, self.changes, self.unchanged,
+            len(self.timeouts), len(self.errors), len(self.unreachable),
+            ", ".join("%s %.2fs" % item for item in self.slowest()) or "none")
+        if self.lag:
+            text += "; worst lag: %s %.2fs" % self.worst_lag()
+        return text
 
 class Monitor(object):
     """
     For each node, call driver.status, and update VM state.
+
+    Config options:
+
+    * create_missing: add VMs found on a hypervisor but not in the registry
+    * poll_concurrency: how many driver.status() calls to run at once (10)
+    * poll_timeout: seconds to wait for each hypervisor's status (60)
+    * poll_mode: "each" to call driver.status(node) per hypervisor, or
+      "broadcast" to call driver.status() once per driver, for the
+      drivers which set broadcast_status = True (each)
+    * fingerprint_ignore: hypervisor status fields (eg. noisy counters)
+      to leave out of its fingerprint
+    * reconcile_every: reconcile a hypervisor every this many polls,
+      even if its status fingerprint hasn't changed (10)
+    * poll_async: call driver.status_async() for drivers which provide
+      IAsyncDriver, all at once rather than poll_concurrency at a time
+      on threads (true)
+
+    A hypervisor whose status has the same fingerprint as at its last
+    poll is skipped: nothing is compared or written for it.  The
+    fingerprints are kept by the Monitor, so only a long-lived Monitor
+    benefits, and changes made to the registry by others are picked up
+    by the next forced reconcile.
     """
     def __init__(self, manager, config):
         self.manager = manager
@@ -31,94 +99,389 @@ class Monitor(object):
             self.create_missing = True
         else:
             self.create_missing = False
+        self.poll_concurrency = max(1, int(config.get('poll_concurrency', 10)))
+        self.poll_timeout = float(config.get('poll_timeout', 60))
+        self.poll_mode = config.get('poll_mode', 'each')
+        if self.poll_mode not in ('each', 'broadcast'):
+            raise ValueError("Unknown poll_mode for Monitor: %s" % (self.poll_mode,))
+        fingerprint_ignore = config.get('fingerprint_ignore', [])
+        if isinstance(fingerprint_ignore, basestring):
+            fingerprint_ignore = [fingerprint_ignore]
+        self.fingerprint_ignore = set(["_name", "_type", "_parent"] + list(fingerprint_ignore))
+        self.reconcile_every = max(1, int(config.get('reconcile_every', 10)))
+        self.poll_async = config.get('poll_async', True) in ('true','yes',True)
+        # node_id -> (fingerprint, polls since it was last reconciled)
+        self._fingerprints = {}
+        # call name -> Thread, for calls which timed out but haven't returned
+        self._stragglers = {}
 
-    def create_vm(self, vm_name, vm_status, node):
+    def create_vm(self, vm_name, vm_status, node, manager=None):
         """
         Given the VM name, status, and the node it was found
         running on, call the provisioner to add it to the registry,
         then set the parent to the node.
+
+        manager may be a session (see Manager.session) to use instead
+        of self.manager, here and in the methods below.
         """
-        provisioner = self.manager.provisioner
+        manager = manager or self.manager
+        provisioner = manager.provisioner
         logging.info("Creating VM %r on %r: %r" % (vm_name, node, vm_status))
         provisioner.provision(vm_name, node_name=vm_name, node_type='vm',
             definition = vm_status['definition'],
-            metadata = { 'state': vm_name }
+            metadata = { 'state': vm_status['state'][0] }
         )
-        vm = self.manager.get_node(vm_name)
-        self.manager.registry.set_parent(vm_name, node.node_id)
-        return vm
+        manager.registry.set_parent(vm_name, node.node_id)
+        return manager.get_node(vm_name)
 
-    def unassign_vm(self, vm):
+    def unassign_vm(self, vm, manager=None):
         """
         Unassign the given VM (set its parent to None)
         """
-        self.manager.registry.set_parent(vm.node_id, None)
+        manager = manager or self.manager
+        manager.registry.set_parent(vm.node_id, None)
         vm.state = "unassigned"
 
-    def update_node(self, node, status):
+    def fingerprint(self, node, status):
         """
-        Given an iterable of VM statuses containing
-        node definitions, check whether the registry
-        is up to date, and if not, update it.
+        Return a stable hash of a hypervisor's status: its VMs' names and
+        states, and its own fields except those in fingerprint_ignore.
+        """
+        vms = []
+        node_status = {}
+        for record in status:
+            if record["_name"] == node.node_id:
+                node_status = dict((key, value) for key, value in record.items()
+                    if key not in self.fingerprint_ignore)
+            else:
+                vms.append((record["_name"], record["state"]))
+        vms.sort()
+        return hashlib.sha1(json.dumps([vms, node_status], sort_keys=True, default=repr)).hexdigest()
 
-        If self.create_missing is set, create missing
-        VMs.
+    def _unchanged(self, node, fingerprint):
+        """
+        Return True if the node's fingerprint is the same as last time and
+        it isn't due a forced reconcile, counting the poll either way.
+        """
+        previous, polls = self._fingerprints.get(node.node_id, (None, 0))
+        if fingerprint == previous and polls < self.reconcile_every:
+            self._fingerprints[node.node_id] = (fingerprint, polls + 1)
+            return True
+        return False
 
-        If a VM is not found on a node that it's
-        assigned to, it will be unassigned from that
-        node.
+    def reconcile(self, node, status, manager=None):
+        """
+        Compare a hypervisor's status (an iterable of VM statuses
+        containing node definitions, and the hypervisor's own status)
+        with the registry, and return the list of changes needed to
+        bring the registry up to date, without making them.
+
+        Each change is an (action, node_id, value) tuple:
+
+        * ("metadata", hv node_id, dict): the hypervisor's status has changed
+        * ("create", vm_name, vm_status): a VM is missing from the registry
+          (only if self.create_missing is set)
+        * ("assign", vm_name, None): a VM is running on the node but
+          isn't assigned to anything
+        * ("state", vm_name, state): a VM's state has changed
+        * ("unassign", vm_name, None): a VM is assigned to the node,
+          but isn't on it
+
+        With a prefetched session as the manager, this makes no
+        registry queries.
         """
-        vms = {}
+        manager = manager or self.manager
+        changes = []
+        vms = set()
         for vm_status in status:
             vm_name = vm_status["_name"]
             if vm_name == node.node_id:
-                # Update node's metadata based on node status
-                # FIXME: a little hacky
-                del vm_status["_name"]
-                del vm_status["_type"]
-                del vm_status["_parent"]
-                self.manager.registry.update_metadata(node.node_id, vm_status)
+                # the node's own status, less the record keys
+                node_status = dict((key, value) for key, value in vm_status.items()
+                    if key not in ("_name", "_type", "_parent"))
+                metadata = node.metadata
+                for key, value in node_status.items():
+                    if key not in metadata or metadata[key] != value:
+                        changes.append(("metadata", node.node_id, node_status))
+                        break
                 continue
-            vms[vm_name] = vm_status
+            vms.add(vm_name)
             vm_state, vm_target_state = vm_status["state"]
             try:
-                vm = self.manager.get_node(vm_name)
+                vm = manager.get_node(vm_name)
             except vagoth.exceptions.NodeNotFoundException:
                 if self.create_missing:
-                    vm = self.create_vm(vm_name, vm_status, node)
+                    changes.append(("create", vm_name, vm_status))
                 else:
                     logging.warn("VM {0} not found. Skipping.".format(vm_name))
-                    continue
-
-            # inconsistency detected:
-            # if VM is running on a node, but isn't assigned to it, then assign it
-            if vm and not vm.parent:
-                self.manager.registry.set_parent(vm_name, node.node_id)
-                logging.warn("Auto-assigning {0} to {1}".format(vm_name, node.node_id))
+                continue
 
-            # update state:
-            if vm and vm.parent == node:
-                if vm.state != vm_state:
-                    vm.state = vm_state
-                    logging.debug("Setting VM state for {0} to {1}".format(vm_name, vm_state))
+            parent_id = vm.parent_id
+            if parent_id is None:
+                # inconsistency detected:
+                # if VM is running on a node, but isn't assigned to it, then assign it
+                changes.append(("assign", vm_name, None))
+                parent_id = node.node_id
+            if parent_id == node.node_id and vm.state != vm_state:
+                changes.append(("state", vm_name, vm_state))
 
-        for vm in self.manager.get_nodes(parent=node.node_id):
+        for vm in manager.get_nodes(parent=node.node_id):
             # any VMs assigned to node, but not active?
             if vm.node_id not in vms:
-                logging.debug("Unassigning VM {0} from {1}".format(vm.node_id, node.node_id))
-                self.unassign_vm(vm)
+                changes.append(("unassign", vm.node_id, None))
+        return changes
+
+    def apply_changes(self, node, changes, manager=None):
+        """
+        Make the changes returned by reconcile() for the node, in one
+        registry batch.
+        """
+        manager = manager or self.manager
+        if not changes:
+            return
+        registry = manager.registry
+        with registry.batch():
+            for action, node_id, value in changes:
+                if action == "metadata":
+                    registry.update_metadata(node_id, value)
+                elif action == "create":
+                    self.create_vm(node_id, value, node, manager)
+                elif action == "assign":
+                    logging.warn("Auto-assigning {0} to {1}".format(node_id, node.node_id))
+                    registry.set_parent(node_id, node.node_id)
+                elif action == "state":
+                    logging.debug("Setting VM state for {0} to {1}".format(node_id, value))
+                    registry.update_metadata(node_id, {"state": value})
+                elif action == "unassign":
+                    logging.debug("Unassigning VM {0} from {1}".format(node_id, node.node_id))
+                    self.unassign_vm(manager.get_node(node_id), manager)
+                else:
+                    raise ValueError("Unknown change: %r" % (action,))
+
+    def update_node(self, node, status, manager=None):
+        """
+        Given an iterable of VM statuses containing
+        node definitions, check whether the registry
+        is up to date, and if not, update it.
+
+        If self.create_missing is set, create missing
+        VMs.
+
+        If a VM is not found on a node that it's
+        assigned to, it will be unassigned from that
+        node.
+
+        Returns the changes made (see reconcile).
+        """
+        changes = self.reconcile(node, status, manager)
+        self.apply_changes(node, changes, manager)
+        return changes
+
+    def _poll_status(self, calls):
+        """
+        Call driver.status(node) for each (name, driver, node) in calls,
+        at most poll_concurrency at a time, and yield (name, node, status,
+        exception, seconds) in the order they finish.  node may be None,
+        for a broadcast status call.
+
+        A call that hasn't finished after poll_timeout is yielded with a
+        DriverTimeoutException.  Its thread can't be stopped, so it is
+        left to finish (or not) in the background, and its result is
+        dropped; until it returns, its hypervisor isn't called again, and
+        is reported as timed out straight away.  So a hung hypervisor
+        holds at most one thread, and it doesn't count against
+        poll_concurrency, which is left for the healthy ones.
+
+        With poll_async, the calls to drivers providing IAsyncDriver are
+        all started at once with status_async(), and need no threads.
+        """
+        results = Queue()
+        def call(name, driver, node):
+            start = time.time()
+            try:
+                status, error = driver.status(node), None
+            except Exception as e:
+                logging.debug("Exception polling %s" % (name,), exc_info=True)
+                status, error = None, e
+            results.put((name, status, error, time.time() - start))
+
+        def call_async(name, driver, node):
+            start = time.time()
+            def done(future):
+                error = future.exception()
+                if error is not None:
+                    logging.debug("Exception polling %s: %s" % (name, error))
+                results.put((name, None if error else future.result(), error, time.time() - start))
+            try:
+                driver.status_async(node).add_done_callback(done)
+            except Exception as e:
+                results.put((name, None, e, time.time() - start))
+
+        def timed_out(name, reason):
+            return DriverTimeoutException("Timed out polling %s (%s)" % (name, reason))
+
+        pending = deque()
+        running = {} # name -> (node, deadline)
+        threads = {} # name -> Thread, for the running calls which have one
+        for name, driver, node in calls:
+            if self.poll_async and IAsyncDriver.providedBy(driver):
+                running[name] = (node, time.time() + self.poll_timeout)
+                call_async(name, driver, node)
+            else:
+                pending.append((name, driver, node))
+        while pending or running:
+            for name, thread in self._stragglers.items():
+                if not thread.is_alive():
+                    del self._stragglers[name]
+            while pending and len(threads) < self.poll_concurrency:
+                name, driver, node = pending.popleft()
+                if name in self._stragglers:
+                    yield name, node, None, timed_out(name, "its last poll is still running"), 0.0
+                    continue
+                running[name] = (node, time.time() + self.poll_timeout)
+                thread = threads[name] = Thread(target=call, args=(name, driver, node))
+                thread.daemon = True
+                thread.start()
+            if not running:
+                # the rest were all skipped, as still hung
+                break
+            next_deadline = min(deadline for node, deadline in running.values())
+            try:
+                name, status, error, seconds = results.get(timeout=max(0, next_deadline - time.time()))
+            except Empty:
+                now = time.time()
+                for name, (node, deadline) in running.items():
+                    if deadline <= now:
+                        del running[name]
+                        if name in threads:
+                            self._stragglers[name] = threads.pop(name)
+                        yield name, node, None, timed_out(name, "after %ss" % (self.poll_timeout,)), self.poll_timeout
+                continue
+            if name in running: # otherwise it already timed out
+                node, deadline = running.pop(name)
+                threads.pop(name, None)
+                yield name, node, status, error, seconds
+
+    def _group_status(self, status):
+        """
+        Split a broadcast status into a dict of hypervisor node_id to its
+        status (its own record and its VMs' records)
+        """
+        groups = {}
+        for record in status:
+            if record["_type"] == "hv":
+                node_id = record["_name"]
+            else:
+                node_id = record["_parent"]
+            groups.setdefault(node_id, []).append(record)
+        return groups
 
-    def poll_nodes(self):
+    def _hypervisors(self, session, node_ids):
         """
-        Poll each node individually (by calling driver.status(node)) and
-        call self.update_node with the returned status.
+        Return the hypervisor nodes to poll, fetching each one's VMs into
+        the session.  Without node_ids, that is all of them.
         """
-        for node in self.manager.get_nodes(node_type="hv"):
+        if node_ids is None:
+            return session.get_nodes(node_type="hv")
+        nodes = []
+        for node_id in sorted(node_ids):
+            try:
+                node = session.get_node(node_id)
+            except vagoth.exceptions.NodeNotFoundException:
+                logging.info("Hypervisor %s not found. Skipping." % (node_id,))
+                continue
+            if node.node_type != "hv":
+                continue
+            session.get_nodes_with_parent(node_id)
+            nodes.append(node)
+        return nodes
+
+    def poll_nodes(self, node_ids=None, session=None):
+        """
+        Poll the hypervisor nodes (by calling driver.status(node), up to
+        poll_concurrency at once) and call self.update_node with each
+        status as it arrives.  Returns a PollReport, which is also logged.
+
+        If node_ids is given, only those hypervisors are polled, and only
+        they and their VMs are fetched.  If session is given, it is used
+        instead of a new one, eg. one that's already been prefetched.
+
+        In broadcast mode, drivers with broadcast_status are called once
+        (driver.status()) for all of their hypervisors, and the replies
+        are split up by hypervisor.  A hypervisor which didn't reply is
+        reported as unreachable and left as it is.
+
+        The nodes are fetched up front into a session, so each status
+        is compared against that snapshot without going back to the
+        registry, and only the differences are written.  The registry is
+        only updated from this thread.
+        """
+        if session is None:
+            with self.manager.session() as session:
+                if node_ids is None:
+                    session.prefetch()
+                return self.poll_nodes(node_ids, session)
+        report = PollReport()
+        start = time.time()
+        calls = []
+        broadcasts = {} # call name -> {node_id: node}
+        for node in self._hypervisors(session, node_ids):
             driver = node.driver
-            if driver:
+            if not driver:
+                continue
+            if self.poll_mode == "broadcast" and getattr(driver, "broadcast_status", False):
+                name = "driver " + node.driver_name
+                if name not in broadcasts:
+                    broadcasts[name] = {}
+                    calls.append((name, driver, None))
+                broadcasts[name][node.node_id] = node
+            else:
+                calls.append((node.node_id, driver, node))
+        for name, node, status, error, seconds in self._poll_status(calls):
+            report.timings[name] = seconds
+            if error is not None:
+                if isinstance(error, DriverTimeoutException):
+                    logging.warn(error.message)
+                    report.timeouts.append(name)
+                else:
+                    logging.info("Error polling %s: %s" % (name, error))
+                    report.errors.append(name)
+                # reconcile these nodes in full when they come back
+                for node_id in broadcasts.get(name, [name]):
+                    self._fingerprints.pop(node_id, None)
+                continue
+            if node is not None:
+                updates = [(node, status)]
+            else:
+                groups = self._group_status(status)
+                updates = []
+                for node_id, node in sorted(broadcasts[name].items()):
+                    if node_id in groups:
+                        updates.append((node, groups[node_id]))
+                    else:
+                        logging.info("No status received from %s" % (node_id,))
+                        report.unreachable.append(node_id)
+                        self._fingerprints.pop(node_id, None)
+            for node, node_status in updates:
+                fingerprint = self.fingerprint(node, node_status)
+                if self._unchanged(node, fingerprint):
+                    report.polled.append(node.node_id)
+                    report.unchanged += 1
+                    continue
+                # at most one lock/save (or bulk request) per hypervisor
                 try:
-                    node_status = driver.status(node)
-                except DriverException as e:
-                    logging.info(e.message)
+                    changes = self.update_node(node, node_status, session)
+                except Exception:
+                    # eg. a registry conflict; carry on with the others
+                    logging.exception("Error updating %s" % (node.node_id,))
+                    report.errors.append(node.node_id)
+                    self._fingerprints.pop(node.node_id, None)
                     continue
-                self.update_node(node, node_status)
+                report.polled.append(node.node_id)
+                if changes:
+                    report.changes += len(changes)
+                    report.changed.append(node.node_id)
+                self._fingerprints[node.node_id] = (fingerprint, 1)
+        report.wall_time = time.time() - start
+        logging.info(str(report))
+        return report
@@ -0,0 +1,226 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+A long-running poller, which keeps one Monitor (and so one Manager and
+its drivers, and the Monitor's status fingerprints) and polls each
+hypervisor on its own schedule.
+
+It's started by "vagoth monitor --daemon", and reads its options from
+the virt/monitor config section, alongside the Monitor's own:
+
+* interval: seconds between polls of an idle hypervisor (60)
+* min_interval: seconds between polls of a busy hypervisor (10)
+* busy_period: a hypervisor is busy for this many seconds after a poll
+  found changes, or after poke() (300)
+* watch_interval: seconds between looking for VMs in a watch_states
+  state, whose hypervisors are then poked (10)
+* watch_states: the VM states set by actions in progress (starting,
+  stopping, shutting down, rebooting, defined)
+* max_interval: the most a failing hypervisor's interval is backed off
+  to, doubling from interval on each failure (600)
+* jitter: each interval is randomly varied by up to this fraction, so
+  that polls spread out (0.1)
+* rescan_interval: seconds between looking for added or removed
+  hypervisors (300)
+"""
+
+import heapq
+import logging
+import random
+import threading
+import time
+
+class HostSchedule(object):
+    """When a hypervisor is next due to be polled, and why"""
+    __slots__ = ("node_id", "due", "failures", "busy_until", "lag")
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.due = None
+        self.failures = 0
+        self.busy_until = 0
+        self.lag = 0.0
+
+class MonitorDaemon(object):
+    """
+    Poll hypervisors with a Monitor, each on its own interval.
+
+    The schedule is a heap of (due time, node_id).  Each pass polls
+    every hypervisor which is due, in one Monitor.poll_nodes() call,
+    and puts them back on the heap at their next due time.  A host's
+    lag is how late its last poll started.
+
+    Actions run in their own processes, so rather than being told about
+    them, the daemon looks in the registry every watch_interval for VMs
+    in one of watch_states (eg. "starting"), and pokes their hypervisors.
+    """
+    def __init__(self, monitor, config):
+        self.monitor = monitor
+        self.manager = monitor.manager
+        self.interval = float(config.get('interval', 60))
+        self.min_interval = float(config.get('min_interval', 10))
+        self.max_interval = float(config.get('max_interval', 600))
+        self.busy_period = float(config.get('busy_period', 300))
+        self.jitter = float(config.get('jitter', 0.1))
+        self.rescan_interval = float(config.get('rescan_interval', 300))
+        self.watch_interval = float(config.get('watch_interval', 10))
+        watch_states = config.get('watch_states',
+            ["starting", "stopping", "shutting down", "rebooting", "defined"])
+        if isinstance(watch_states, basestring):
+            watch_states = [watch_states]
+        self.watch_states = set(watch_states)
+        self.hosts = {}
+        self._heap = []
+        self._next_rescan = 0
+        self._next_watch = 0
+        self._stop = threading.Event()
+
+    def _schedule(self, host, due):
+        host.due = due
+        heapq.heappush(self._heap, (due, host.node_id))
+
+    def rescan(self, now=None, manager=None):
+        """Start polling new hypervisors now, and forget removed ones"""
+        now = now or time.time()
+        manager = manager or self.manager
+        node_ids = set(node.node_id for node in manager.get_nodes(node_type="hv"))
+        for node_id in node_ids.difference(self.hosts):
+            self._schedule(self.hosts.setdefault(node_id, HostSchedule(node_id)), now)
+        for node_id in set(self.hosts).difference(node_ids):
+            del self.hosts[node_id]
+        self._next_rescan = now + self.rescan_interval
+
+    def poke(self, node_id, now=None):
+        """
+        Poll node_id as soon as possible, and then often for busy_period,
+        eg. when watch() finds an action in progress on one of its VMs.
+        """
+        now = now or time.time()
+        host = self.hosts.get(node_id, None)
+        if host is None:
+            return
+        host.busy_until = now + self.busy_period
+        if host.due > now:
+            self._schedule(host, now)
+
+    def watch(self, now=None, manager=None):
+        """
+        Poke the hypervisors of VMs in one of watch_states, unless they're
+        already busy
+        """
+        now = now or time.time()
+        manager = manager or self.manager
+        node_ids = set()
+        for vm in manager.get_nodes(node_type="vm"):
+            if vm.parent_id and vm.metadata.get("state", None) in self.watch_states:
+                node_ids.add(vm.parent_id)
+        for node_id in node_ids:
+            host = self.hosts.get(node_id, None)
+            if host is not None and host.busy_until <= now:
+                self.poke(node_id, now)
+        self._next_watch = now + self.watch_interval
+
+    def next_interval(self, host, now):
+        """Return the seconds until host should next be polled"""
+        if host.failures:
+            interval = min(self.max_interval, self.interval * 2 ** min(host.failures, 16))
+        elif host.busy_until > now:
+            interval = self.min_interval
+        else:
+            interval = self.interval
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _pop_due(self, now):
+        """Return the hosts which are due by now, removing them from the heap"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, node_id = heapq.heappop(self._heap)
+            host = self.hosts.get(node_id, None)
+            # skip entries for removed hosts, or superseded by poke()
+            if host is not None and host.due == deadline:
+                due.append(host)
+        return due
+
+    def run_once(self, now=None):
+        """
+        Poll the hypervisors which are due, and reschedule them.
+        Returns the Monitor's PollReport, or None if nothing was due.
+
+        Each pass reads the registry through one session.  A pass which
+        watches for actions fetches every node once, and the poll uses
+        that; otherwise, only the due hypervisors and their VMs are read.
+        """
+        now = now or time.time()
+        with self.manager.session() as session:
+            if now >= self._next_watch:
+                session.prefetch()
+            if now >= self._next_rescan:
+                self.rescan(now, session)
+            if now >= self._next_watch:
+                self.watch(now, session)
+            return self._poll_due(now, session)
+
+    def _poll_due(self, now, session):
+        hosts = self._pop_due(now)
+        if not hosts:
+            return None
+        for host in hosts:
+            host.lag = now - host.due
+        try:
+            report = self.monitor.poll_nodes([host.node_id for host in hosts], session)
+            report.lag = dict((host.node_id, host.lag) for host in hosts)
+            polled, changed, finished = set(report.polled), set(report.changed), now + report.wall_time
+        except Exception:
+            logging.exception("Exception polling %s" % (", ".join(host.node_id for host in hosts),))
+            report, polled, changed, finished = None, set(), set(), now
+        for host in hosts:
+            if host.node_id in polled:
+                host.failures = 0
+                if host.node_id in changed:
+                    host.busy_until = finished + self.busy_period
+            else:
+                host.failures += 1
+            self._schedule(host, finished + self.next_interval(host, finished))
+        worst = max(hosts, key=lambda host: host.lag)
+        logging.info("Polled %d hosts; worst lag %.2fs (%s)" % (len(hosts), worst.lag, worst.node_id))
+        return report
+
+    def lag(self):
+        """Return a dict of node_id to how late its last poll started, in seconds"""
+        return dict((node_id, host.lag) for node_id, host in self.hosts.items())
+
+    def run(self):
+        """Poll until stop() is called"""
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                # eg. the registry is unavailable for a rescan
+                logging.exception("Exception in monitor daemon")
+                self._stop.wait(self.min_interval)
+                continue
+            wake = min(self._next_rescan, self._next_watch)
+            if self._heap:
+                wake = min(wake, self._heap[0][0])
+            self._stop.wait(max(0, wake - time.time()))
+
+    def stop(self):
+        """Ask run() to return, after any poll in progress"""
+        self._stop.set()
@@ -0,0 +1,199 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+A pool of long-lived geats_jsonagent processes, each started with
+--serve and answering one line-delimited JSON request at a time.
+"""
+
+from subprocess import Popen, PIPE
+from threading import Thread, Lock, Condition
+from collections import deque
+from Queue import Queue, Empty
+import json
+import time
+from ..exceptions import DriverException, DriverTimeoutException
+
+def agent_result(jresult):
+    """Return the data from a geats_jsonagent reply, or raise DriverException"""
+    assert type(jresult) == dict
+    if jresult.get("success", False):
+        return jresult.get("data", None)
+    errorcode = jresult.get("errorcode", "undefined")
+    message = jresult.get("message", "check logs")
+    raise DriverException("%s: %s" % (errorcode, message))
+
+class Latencies(object):
+    """
+    The durations of the last window calls, overall and per action, for
+    percentiles()
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = Lock()
+        self.samples = {None: deque(maxlen=window)}
+
+    def add(self, action, seconds):
+        with self.lock:
+            self.samples[None].append(seconds)
+            self.samples.setdefault(action, deque(maxlen=self.window)).append(seconds)
+
+    def percentiles(self, action=None, points=(50, 90, 99)):
+        """
+        Return a dict of each percentile in points to its latency in
+        seconds, for action or for all calls; empty if there were none
+        """
+        with self.lock:
+            samples = sorted(self.samples.get(action, ()))
+        if not samples:
+            return {}
+        # nearest rank
+        return dict((point, samples[max(0, int(round(point / 100.0 * len(samples))) - 1)])
+            for point in points)
+
+class AgentWorker(object):
+    """One "geats_jsonagent --serve" process, and a thread reading its replies"""
+    def __init__(self, command):
+        self.process = Popen(command + ["--serve"], stdin=PIPE, stdout=PIPE, close_fds=True)
+        self.replies = Queue()
+        reader = Thread(target=self._read)
+        reader.daemon = True
+        reader.start()
+
+    def _read(self):
+        for line in iter(self.process.stdout.readline, ""):
+            self.replies.put(line)
+        # EOF
+        self.replies.put(None)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass # already gone
+        self.process.wait()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+class AgentPool(object):
+    """
+    Up to size geats_jsonagent workers, each handling one call at a time.
+    Workers are started as they're needed and then reused.
+
+    A call which doesn't get a reply by its deadline kills its worker,
+    which is replaced by the next call needing one, and raises
+    DriverTimeoutException.  The time spent waiting for a free worker
+    counts towards the deadline too.
+
+    :param command: the agent command, without --serve (geats_jsonagent)
+    :param size: the most workers to run at once
+    """
+    def __init__(self, command=None, size=4):
+        self.command = command or ["geats_jsonagent"]
+        self.size = size
+        self.lock = Lock()
+        # notified when a worker is released or discarded
+        self.available = Condition(self.lock)
+        self.starts = 0
+        self.latencies = Latencies()
+        self._idle = deque()
+        self._running = 0
+        self._closed = False
+
+    def _acquire(self, deadline):
+        """Return an idle worker, starting one if there's room"""
+        with self.lock:
+            while True:
+                if self._idle:
+                    worker = self._idle.popleft()
+                    if worker.alive():
+                        return worker
+                    # it exited while idle
+                    worker.kill()
+                    self._running -= 1
+                    continue
+                if self._running < self.size:
+                    self._running += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DriverTimeoutException("No free %s worker" % (self.command[0],))
+                self.available.wait(remaining)
+        try:
+            worker = AgentWorker(self.command)
+        except OSError as e:
+            self._discard(None)
+            raise DriverException("Could not start %s: %s" % (self.command[0], e))
+        self.starts += 1
+        return worker
+
+    def _release(self, worker):
+        with self.lock:
+            if not self._closed:
+                self._idle.append(worker)
+                self.available.notify()
+                return
+        worker.close()
+        self._discard(None)
+
+    def _discard(self, worker):
+        if worker is not None:
+            worker.kill()
+        with self.lock:
+            self._running -= 1
+            self.available.notify()
+
+    def call(self, action, timeout=60, **kwargs):
+        """Make a geats_jsonagent call, and return its data"""
+        start = time.time()
+        deadline = start + timeout
+        worker = self._acquire(deadline)
+        try:
+            worker.process.stdin.write(json.dumps({"action": action, "data": kwargs}) + "\n")
+            worker.process.stdin.flush()
+            line = worker.replies.get(timeout=max(0, deadline - time.time()))
+        except IOError as e:
+            self._discard(worker)
+            raise DriverException("Could not write to %s: %s" % (self.command[0], e))
+        except Empty:
+            self._discard(worker)
+            raise DriverTimeoutException("%s %s took longer than %ss" % (self.command[0], action, timeout))
+        if line is None:
+            self._discard(worker)
+            raise DriverException("%s exited with %s" % (self.command[0], worker.process.returncode))
+        self._release(worker)
+        self.latencies.add(action, time.time() - start)
+        return agent_result(json.loads(line))
+
+    def close(self):
+        """Stop the idle workers; busy ones are stopped when their call finishes"""
+        with self.lock:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+        for worker in idle:
+            worker.close()
+            self._discard(None)
@@ -0,0 +1,252 @@
+#
+# Vagoth Cluster Management Framework
+# Copyright (C) 2013  Robert Thomson
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""
+Futures for asynchronous driver calls (see IAsyncDriver).
+
+A Future is completed by whoever holds it, eg. a connection's reader
+thread when the reply arrives, so an asynchronous call needs no thread
+of its own while it waits.  call_at() runs a function at a given time
+from one shared timer thread, to fail calls that miss their deadline.
+Executor runs blocking functions on a fixed number of threads.
+"""
+
+from ..exceptions import DriverTimeoutException
+from threading import Thread, Lock, Condition, Event
+from Queue import Queue
+import itertools
+import atexit
+import heapq
+import logging
+import time
+
+class Future(object):
+    """The result of a call which may not have finished yet"""
+    def __init__(self):
+        self._lock = Lock()
+        self._event = Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def _complete(self, result, exception):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._result, self._exception = result, exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run(callback)
+        return True
+
+    def _run(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logging.exception("Exception in future callback")
+
+    def set_result(self, result):
+        """Complete the future, unless it already is; returns whether it was"""
+        return self._complete(result, None)
+
+    def set_exception(self, exception):
+        """Fail the future, unless it's already complete; returns whether it was"""
+        return self._complete(None, exception)
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the future to complete, and return whether it has"""
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+        Return the result, or raise the exception, waiting up to timeout
+        seconds (or forever) for it, then raising DriverTimeoutException
+        """
+        if not self._event.wait(timeout):
+            raise DriverTimeoutException("No result within %ss" % (timeout,))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the exception the future failed with, or None"""
+        if not self._event.wait(timeout):
+            raise DriverTimeoutException("No result within %ss" % (timeout,))
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """Call callback(future) when it completes, or now if it has"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run(callback)
+
+def resolved(result=None, exception=None):
+    """Return a Future which is already complete"""
+    future = Future()
+    future._complete(result, exception)
+    return future
+
+def chain(future, func):
+    """
+    Return a Future for func(the result of future), which fails with
+    future's exception, or func's
+    """
+    chained = Future()
+    def done(future):
+        exception = future.exception()
+        if exception is not None:
+            chained.set_exception(exception)
+            return
+        try:
+            chained.set_result(func(future._result))
+        except Exception as e:
+            chained.set_exception(e)
+    future.add_done_callback(done)
+    return chained
+
+def gather(futures, timeout=None):
+    """
+    Wait for all the futures, and return a list with, for each in order,
+    its result or the exception it failed with.  Those still running
+    after timeout seconds get a DriverTimeoutException.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+    for future in futures:
+        remaining = None if deadline is None else max(0, deadline - time.time())
+        try:
+            results.append(future.result(remaining))
+        except Exception as e:
+            results.append(e)
+    return results
+
+class _Timer(object):
+    """One thread which runs functions at their given times"""
+    def __init__(self):
+        self._condition = Condition(Lock())
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+        self._stopped = False
+
+    def call_at(self, when, func):
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._counter), func))
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.time()):
+                    self._condition.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if self._stopped:
+                    return
+                when, count, func = heapq.heappop(self._heap)
+            try:
+                func()
+            except Exception:
+                logging.exception("Exception in timer")
+
+    def stop(self):
+        """Stop the thread, dropping anything still to run"""
+        with self._condition:
+            self._stopped = True
+            thread = self._thread
+            self._condition.notify()
+        if thread is not None:
+            thread.join()
+
+_timer = _Timer()
+call_at = _timer.call_at
+# rather than have the interpreter kill it mid-wait
+atexit.register(_timer.stop)
+
+def expire(future, timeout, message):
+    """
+    Fail future with DriverTimeoutException(message) if it hasn't
+    completed within timeout seconds; returns future
+    """
+    if timeout is not None:
+        call_at(time.time() + timeout, lambda: future.set_exception(DriverTimeoutException(message)))
+    return future
+
+class Executor(object):
+    """
+    Run functions on up to workers threads, which are started as
+    needed and kept until shutdown().
+    """
+    def __init__(self, workers=10):
+        self.workers = workers
+        self._lock = Lock()
+        self._queue = Queue()
+        self._threads = []
+        self._idle = 0
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs), and return a Future for its result"""
+        future = Future()
+        with self._lock:
+            self._queue.put((future, func, args, kwargs))
+            if self._idle > 0:
+                # an idle thread will take it
+                self._idle -= 1
+            elif len(self._threads) < self.workers:
+                thread = Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, func, args, kwargs = item
+            if not future.done(): # unless it already expired
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+            with self._lock:
+                self._idle += 1
+
+    def shutdown(self, timeout=None):
+        """
+        Stop the threads, after the functions already queued.  With a
+        timeout, wait at most that many seconds for them; any still busy
+        (eg. on a hung call) are left to exit with the interpreter.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(None)
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
@@ -18,14 +18,32 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 #
 
+"""
+Make mcollective RPC calls through the mc_json_rpc.rb helper, either
+by starting it for each call (mcollective_call), by starting it once
+for a list of calls (mcollective_call_many), or by keeping some running
+and sending them many requests (MCollectiveHelper).
+"""
+
 from subprocess import Popen, PIPE
 from os.path import abspath, dirname, join
+from threading import Thread, Lock
+from futures import Future, call_at, chain
+from ..exceptions import DriverTimeoutException
+import logging
 import json
+import time
+
+RUBY_SCRIPT = join(abspath(dirname(__file__)), "mc_json_rpc.rb")
 
 class MCollectiveException(Exception): pass
 
+class MCollectiveTimeout(MCollectiveException, DriverTimeoutException):
+    """No reply from the mcollective helper before the request's deadline"""
 
-def mcollective_call(agent, action, identity=None, timeout=None, **kwargs):
+
+def make_request(agent, action, identity=None, timeout=None, **kwargs):
+    """Return the request dict for mc_json_rpc.rb"""
     mcdict = {
         "agent": agent,
         "action": action,
@@ -35,9 +53,15 @@ def mcollective_call(agent, action, identity=None, timeout=None, **kwargs):
         mcdict["identity"] = identity
     if timeout is not None:
         mcdict["timeout"] = timeout
-    mcjson = json.dumps(mcdict)
-    ruby_script=join(abspath(dirname(__file__)), "mc_json_rpc.rb")
-    process = Popen([ruby_script, "-"], stdin=PIPE, stdout=PIPE)
+    return mcdict
+
+def spawn_call(request, command=None):
+    """
+    Start the helper (command, by default mc_json_rpc.rb), send it the
+    request and return its decoded reply
+    """
+    mcjson = json.dumps(request)
+    process = Popen((command or [RUBY_SCRIPT]) + ["-"], stdin=PIPE, stdout=PIPE)
     process.stdin.write(mcjson)
     process.stdin.close()
     result = process.stdout.read()
@@ -49,3 +73,225 @@ def mcollective_call(agent, action, identity=None, timeout=None, **kwargs):
         raise MCollectiveException(
             "mc-json-rpc.rb exited with {0}: {1}".format(
                 process.returncode, result))
+
+def mcollective_call(agent, action, identity=None, timeout=None, **kwargs):
+    """Make one mcollective call, in a new mc_json_rpc.rb process"""
+    return spawn_call(make_request(agent, action, identity, timeout, **kwargs))
+
+def mcollective_call_many(requests, timeout=None, command=None, processes=1):
+    """
+    Make several mcollective calls with up to processes helper processes,
+    so that they share their start-up and broker connections.  Each
+    helper runs its calls one after another, so with processes=1 they
+    aren't run in parallel.
+
+    :param requests: list of (agent, action, identity, arguments dict)
+    :param timeout: mcollective timeout for each call
+    :returns: a list with, for each request in order, its responses or
+        the MCollectiveException it failed with
+    """
+    helper = MCollectiveHelper(command, processes=min(processes, len(requests)))
+    try:
+        return helper.call_many(requests, timeout)
+    finally:
+        helper.close()
+
+def _reply_result(reply):
+    if "error" in reply:
+        raise MCollectiveException(reply["error"])
+    return reply["result"]
+
+class MCollectiveHelper(object):
+    """
+    Long-lived "mc_json_rpc.rb --serve" co-processes, so that calls
+    don't each pay for starting ruby, loading mcollective and connecting
+    to the broker.
+
+    call() is thread-safe: each request carries an id, and a reader
+    thread per helper hands each reply to the caller waiting for that
+    id.  A helper runs one request at a time (the mcollective client
+    isn't thread-safe), so up to processes helpers are kept: a request
+    goes to an idle helper, or starts a new one, or else queues on the
+    helper which will be free soonest.  If a helper exits, the calls
+    waiting on it fail and it is replaced when needed.
+
+    A request which misses its deadline has hung its helper, so the
+    helper is killed, failing the requests queued behind it rather than
+    leaving them to wait for it too.
+
+    :param command: the helper command, without --serve (mc_json_rpc.rb)
+    :param grace: seconds to wait for a reply beyond the mcollective
+        timeouts, for discovery and the helper itself
+    :param processes: the most helpers to run at once
+    """
+    def __init__(self, command=None, grace=10, processes=1):
+        self.command = command or [RUBY_SCRIPT]
+        self.grace = grace
+        self.size = max(1, processes)
+        self.lock = Lock()
+        self.processes = []
+        self.starts = 0
+        self._next_id = 0
+        # request id -> (Future, process, deadline)
+        self._pending = {}
+
+    def _start(self):
+        """Start a helper and its reader thread, and return it; called with the lock held"""
+        process = Popen(self.command + ["--serve"], stdin=PIPE, stdout=PIPE, close_fds=True)
+        self.processes.append(process)
+        self.starts += 1
+        reader = Thread(target=self._read, args=(process,))
+        reader.daemon = True
+        reader.start()
+        return process
+
+    def _read(self, process):
+        """Hand each reply from process to its caller, until it exits"""
+        for line in iter(process.stdout.readline, ""):
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                logging.warn("Bad reply from mcollective helper: %r" % (line,))
+                continue
+            with self.lock:
+                slot = self._pending.pop(reply.get("id", None), None)
+            if slot is not None:
+                slot[0].set_result(reply)
+        returncode = process.wait()
+        with self.lock:
+            self._forget(process)
+            for request_id, slot in self._pending.items():
+                if slot[1] is process:
+                    del self._pending[request_id]
+                    slot[0].set_result({"error": "mcollective helper exited with %s" % (returncode,)})
+
+    def _forget(self, process):
+        """Stop sending requests to process; called with the lock held"""
+        if process in self.processes:
+            self.processes.remove(process)
+
+    def _queued(self, process):
+        """Return the deadlines of the requests on process; called with the lock held"""
+        return [slot[2] for slot in self._pending.values() if slot[1] is process]
+
+    def _choose(self):
+        """Return the helper for the next request; called with the lock held"""
+        queues = [(max(self._queued(process) or [0]), process) for process in self.processes]
+        for ahead, process in queues:
+            if not ahead:
+                return process
+        if len(self.processes) < self.size:
+            return self._start()
+        return min(queues, key=lambda queue: queue[0])[1]
+
+    def _send(self, requests):
+        """
+        Send the request dicts to the helpers, tagging each with an id,
+        and return their (Future, process, deadline) slots.  As a helper
+        runs one request at a time, a request's deadline is its timeout
+        after the deadline of the one queued ahead of it.
+        """
+        slots = []
+        failed = []
+        with self.lock:
+            lines = {} # process -> lines to write to it
+            for request in requests:
+                process = self._choose()
+                self._next_id += 1
+                request["id"] = self._next_id
+                deadline = max(self._queued(process) + [time.time() + self.grace]) + request.get("timeout", 60)
+                slots.append(self._pending.setdefault(self._next_id, (Future(), process, deadline)))
+                lines.setdefault(process, []).append(json.dumps(request) + "\n")
+            for process, process_lines in lines.items():
+                try:
+                    process.stdin.write("".join(process_lines))
+                    process.stdin.flush()
+                except IOError as e:
+                    # it has died; the reader fails anything else waiting on it
+                    self._forget(process)
+                    for request in requests:
+                        if self._pending.get(request["id"], (None, None))[1] is process:
+                            failed.append((self._pending.pop(request["id"]), e))
+        for slot, e in failed:
+            slot[0].set_exception(MCollectiveException("Could not write to mcollective helper: %s" % (e,)))
+        return slots
+
+    def _wait(self, request, slot):
+        """
+        Return the result for a request sent by _send, or raise
+        MCollectiveException (MCollectiveTimeout if it timed out)
+        """
+        if not slot[0].wait(max(0, slot[2] - time.time())):
+            self._expire(request)
+        return _reply_result(slot[0].result())
+
+    def _expire(self, request):
+        """
+        Fail a request sent by _send, unless its reply has arrived, and
+        kill its helper
+        """
+        with self.lock:
+            slot = self._pending.pop(request["id"], None)
+            if slot is not None:
+                self._forget(slot[1])
+        if slot is None:
+            return
+        slot[0].set_exception(MCollectiveTimeout(
+            "Timed out waiting for mcollective %s/%s" % (request["agent"], request["action"])))
+        try:
+            slot[1].kill()
+        except OSError:
+            pass # it has already exited
+        slot[1].stdin.close()
+
+    def call(self, agent, action, identity=None, timeout=None, **kwargs):
+        """Make an mcollective call through the helper, like mcollective_call()"""
+        request = make_request(agent, action, identity, timeout, **kwargs)
+        slot, = self._send([request])
+        return self._wait(request, slot)
+
+    def call_async(self, agent, action, identity=None, timeout=None, **kwargs):
+        """
+        Send a call to the helper, like call(), and return a
+        vagoth.virt.utils.futures.Future for its result
+        """
+        request = make_request(agent, action, identity, timeout, **kwargs)
+        slot, = self._send([request])
+        call_at(slot[2], lambda: self._expire(request))
+        return chain(slot[0], _reply_result)
+
+    def call_many(self, requests, timeout=None):
+        """
+        Send several requests to the helper in one write, like
+        mcollective_call_many(), and wait for all of them.
+        """
+        requests = [make_request(agent, action, identity, timeout, **(arguments or {}))
+            for agent, action, identity, arguments in requests]
+        slots = self._send(requests)
+        results = []
+        for request, slot in zip(requests, slots):
+            try:
+                results.append(self._wait(request, slot))
+            except MCollectiveException as e:
+                results.append(e)
+        return results
+
+    def close(self, grace=5):
+        """
+        Stop the helpers, after they have finished any calls in flight;
+        those still running after grace seconds are killed
+        """
+        with self.lock:
+            processes, self.processes = self.processes, []
+        for process in processes:
+            process.stdin.close()
+        deadline = time.time() + grace
+        for process in processes:
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if process.poll() is None:
+                try:
+                    process.kill()
+                except OSError:
+                    pass # it has just exited
+                process.wait()
@@ -30,16 +30,72 @@
 # arguments, if provided, must be a dictionary of
 # key-value pairs to be passed in as arguments.
 #
+# With --serve, it stays running and reads one JSON request
+# per line from standard input, each with an "id".  Requests
+# are run one at a time, as the mcollective client isn't
+# thread-safe, and each reply is printed as one line,
+# {"id": id, "result": [...]} or {"id": id, "error": "..."}.
+# It exits when standard input is closed.
+#
 
 require 'mcollective'
 require 'json'
 
 include MCollective::RPC
 
+def mc_request(hash)
+  agent = hash['agent']
+  action = hash['action']
+  arguments = hash['arguments'] || {}
+  identity = hash['identity']
+  timeout = hash['timeout'] || 60
+
+  newargs = {}
+  arguments.each do |k,v|
+    if k[0..4] == "_SYM_" # a hack to support symbols
+      newargs[k[5..-1].to_sym] = v
+    else
+      newargs[k] = v
+    end
+  end
+
+  # don't let mcollective parse our own arguments
+  mc = rpcclient(agent, :options => MCollective::Util.default_options)
+  mc.progress = false
+  mc.timeout = timeout
+  if identity != nil
+    mc.identity_filter identity
+  else
+    mc.discover
+  end
+  result = mc.send(action, newargs).map{|r| r.results}
+  result
+end
+
 if ARGV.count == 0
-  $stderr.puts("Syntax: #{$0} [-|filename.json]")
+  $stderr.puts("Syntax: #{$0} [-|--serve|filename.json]")
   exit 1
 end
+
+if ARGV[0] == "--serve"
+  ARGV.shift
+  $stdout.sync = true
+  while line = $stdin.gets
+    hash = nil
+    begin
+      hash = JSON.load(line)
+      if hash.class != Hash or not hash['agent'] or not hash['action']
+        raise ArgumentError, "agent and action are required"
+      end
+      reply = {"id" => hash['id'], "result" => mc_request(hash)}
+    rescue Exception => e
+      reply = {"id" => (hash.class == Hash ? hash['id'] : nil), "error" => e.to_s}
+    end
+    $stdout.puts(JSON.dump(reply))
+  end
+  exit 0
+end
+
 if ARGV[0] == "-"
     hash = JSON.load($stdin.read())
 else
@@ -52,32 +108,8 @@ if hash.class != Hash
   exit 2
 end
 
-agent = hash['agent']
-action = hash['action']
-arguments = hash['arguments'] || {}
-identity = hash['identity']
-timeout = hash['timeout'] || 60
-
-newargs = {}
-arguments.each do |k,v|
-  if k[0..4] == "_SYM_" # a hack to support symbols
-    newargs[k[5..-1].to_sym] = v
-  else
-    newargs[k] = v
-  end
-end
-
-if agent and action
-    mc = rpcclient(agent)
-    mc.progress = false
-    mc.timeout = timeout
-    if identity != nil
-      mc.identity_filter identity
-    else
-      mc.discover
-    end
-    result = mc.send(action, newargs).map{|r| r.results}
-    puts JSON.dump(result)
+if hash['agent'] and hash['action']
+    puts JSON.dump(mc_request(hash))
     exit 0
 end
 
@@ -27,6 +27,7 @@ class VirtualMachine(Node):
 
     Each method requests the scheduler to execute the related action.
     """
+    __slots__ = ()
 
     @property
     def state(self):
@@ -36,8 +37,7 @@ class VirtualMachine(Node):
     @state.setter
     def state(self, state):
         """Set the state attribute in the metadata"""
-        self._doc.registry.update_metadata(self.node_id, { "state": state, })
-        self.refresh()
+        self.refresh(self._manager.registry.update_metadata(self.node_id, { "state": state, }))
 
     def start(self, hint=None):
         """Schedule the start action"""